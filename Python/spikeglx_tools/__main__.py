@@ -0,0 +1,7 @@
+# Run the spikeglx_tools command line, as in "python -m spikeglx_tools describe path/to/recordings".
+
+import sys
+
+from spikeglx_tools.cli import main
+
+sys.exit(main())
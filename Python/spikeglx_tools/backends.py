@@ -0,0 +1,151 @@
+# Execution backends for per-block computation: threads or processes.
+#
+# NumPy releases the GIL for big array operations, so a thread pool scales
+# well for those.  But the Python-level parts of our per-block work, and
+# NumPy operations on small pieces, hold the GIL and stop scaling after a
+# couple of threads.  Processes avoid that, but pickling big blocks to a
+# process pool costs more than the computation.
+#
+# A ProcessBackend avoids pickling blocks by keeping named arrays in
+# multiprocessing.shared_memory.  The caller fills input arrays, like a block
+# read from a .bin file, then runs a list of small tasks.  Each task runs a
+# module-level function in a worker process with the same named arrays,
+# attached zero-copy, and can write into shared output arrays or return
+# small results.  Shared buffers are reused from block to block, and
+# worker processes are reused from job to job.
+#
+# A ThreadBackend has the same interface, with plain arrays and threads, so
+# streaming stages can take a backend='thread' or backend='process' option
+# and use the same code for either.
+#
+# Task functions have the signature func(arrays, *task), where arrays is a
+# dict of the named arrays.  For the process backend, func must be defined at
+# module level so it can be pickled by reference.
+
+import atexit
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+
+_backends = {}
+
+# Shared memory attached in each worker process, by role and shared memory name.
+_worker_attached = {}
+
+
+class ThreadBackend():
+    """ Run tasks on a thread pool, with named arrays in ordinary memory."""
+
+    kind = 'thread'
+
+    def __init__(self, n_workers=4):
+        self.n_workers = max(n_workers, 1)
+        self.executor = ThreadPoolExecutor(max_workers=self.n_workers)
+        self.arrays = {}
+
+    def array(self, name, shape, dtype='int16'):
+        """ Return a named array to fill before calling run(), reusing memory from earlier calls when it fits."""
+        dtype = np.dtype(dtype)
+        n_bytes = int(np.prod(shape)) * dtype.itemsize
+        buffer = self.arrays.get(name)
+        if buffer is None or buffer.nbytes < n_bytes:
+            buffer = np.empty(max(n_bytes, 1), dtype='uint8')
+            self.arrays[name] = buffer
+        return buffer[:n_bytes].view(dtype).reshape(shape)
+
+    def run(self, func, tasks, arrays):
+        """ Call func(arrays, *task) for each task, concurrently, and return the results in order."""
+        return list(self.executor.map(lambda task: func(arrays, *task), tasks))
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class ProcessBackend():
+    """ Run tasks on a persistent process pool, with named arrays in shared memory."""
+
+    kind = 'process'
+
+    def __init__(self, n_workers=4):
+        self.n_workers = max(n_workers, 1)
+        self.executor = ProcessPoolExecutor(max_workers=self.n_workers)
+        self.shared = {}
+
+    def array(self, name, shape, dtype='int16'):
+        """ Return a named shared array to fill before calling run(), reusing shared memory when it fits."""
+        dtype = np.dtype(dtype)
+        n_bytes = int(np.prod(shape)) * dtype.itemsize
+        shm = self.shared.get(name)
+        if shm is None or shm.size < n_bytes:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            shm = shared_memory.SharedMemory(create=True, size=max(n_bytes, 1))
+            self.shared[name] = shm
+        return np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    def run(self, func, tasks, arrays):
+        """ Call func(arrays, *task) for each task in worker processes, and return the results in order.
+
+        The arrays dict must contain arrays from array(), which workers attach
+        by shared memory name instead of receiving copies.
+        """
+        specs = {name: (self.shared[name].name, array.shape, array.dtype.str) for (name, array) in arrays.items()}
+        futures = [self.executor.submit(_run_in_worker, func, specs, task) for task in tasks]
+        return [future.result() for future in futures]
+
+    def close(self):
+        self.executor.shutdown()
+        for shm in self.shared.values():
+            shm.close()
+            shm.unlink()
+        self.shared = {}
+
+
+def _run_in_worker(func, specs, task):
+    arrays = {}
+    for (role, (shm_name, shape, dtype)) in specs.items():
+        attached = _worker_attached.get(role)
+        if attached is None or attached.name != shm_name:
+            # The parent replaced this buffer with a bigger one.
+            if attached is not None:
+                attached.close()
+            attached = shared_memory.SharedMemory(name=shm_name)
+            _worker_attached[role] = attached
+        arrays[role] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=attached.buf)
+    return func(arrays, *task)
+
+
+def get_backend(backend='thread', n_workers=4):
+    """ Return a backend by kind, 'thread' or 'process', reusing an existing one with the same worker count.
+
+    Backends are kept for reuse across calls and closed at exit.  Since
+    named arrays are reused by each backend, callers should not use the same
+    backend from multiple threads at once.
+    """
+    if not isinstance(backend, str):
+        return backend
+    key = (backend, max(n_workers, 1))
+    if key not in _backends:
+        if backend == 'thread':
+            _backends[key] = ThreadBackend(n_workers)
+        elif backend == 'process':
+            _backends[key] = ProcessBackend(n_workers)
+        else:
+            raise Exception(f'Unknown backend: {backend}')
+    return _backends[key]
+
+
+def split_range(n, n_parts, multiple=1):
+    """ Split range(n) into up to n_parts (start, end) pairs, with inner edges on multiples of multiple."""
+    n_units = int(np.ceil(n / multiple))
+    edges = np.linspace(0, n_units, max(min(n_parts, n_units), 1) + 1).astype('int64') * multiple
+    edges[-1] = n
+    return [(int(edges[ii]), int(edges[ii + 1])) for ii in range(len(edges) - 1) if edges[ii + 1] > edges[ii]]
+
+
+@atexit.register
+def _close_backends():
+    for backend in _backends.values():
+        backend.close()
+    _backends.clear()
@@ -0,0 +1,211 @@
+# A process-wide LRU cache of raw blocks, for interactive reading.
+#
+# Interactive sessions read overlapping windows of the same recordings over
+# and over, and each read goes back to disk.  This cache keeps recently read
+# pieces of .bin files in memory, up to a byte budget, shared by all readers
+# in the process and safe to use from many threads.
+#
+# Files are cached in a fixed grid of pieces: groups of chans_per_group
+# consecutive saved channels, by blocks of consecutive samples.  Each piece
+# is keyed by (file identity, channel group, block index), where the file
+# identity includes its size and modification time, so a rewritten file
+# won't be served from stale pieces.  Pieces are read-only int16 arrays.
+#
+# read_window() assembles any window of channels and samples from cached
+# pieces, loading the missing ones.  Threads that need the same missing piece
+# at the same time wait for one load instead of each reading it.
+#
+# The cache is opt-in.  window_service.py reads raw windows through it, and
+# the streaming readers use it with reader='cached' for blocks.iter_blocks
+# and read_bin_ben, or for all of them with blocks.default_reader = 'cached'.
+# window_service.py also keeps its min/max tiles in a BlockCache of its own.
+# By default streaming readers don't use it, since a one-pass scan of a whole
+# file would only evict the pieces interactive readers are reusing.
+# makeMemMapRaw always maps the file directly.
+#
+# The cache gets cache_budget_fraction of the memory budget from blocks.py,
+# and blocks.set_memory_budget() resizes it along with the budget.
+
+import threading
+from collections import OrderedDict
+from pathlib import Path
+import numpy as np
+
+from . import blocks
+
+# Cache pieces of this many channels by about this many bytes.
+chans_per_group = 64
+piece_bytes = 4 * 1024 * 1024
+
+# Memmaps of recently used files, by file identity.
+_memmaps = OrderedDict()
+_memmaps_lock = threading.Lock()
+max_memmaps = 32
+
+
+class BlockCache():
+    """ Thread-safe LRU cache of read-only arrays, with a byte budget and hit, miss, and eviction counts."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.entries = OrderedDict()
+        self.loading = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ Return the cached array for key, or None, counting a hit or miss."""
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key):
+        """ Like get(), without counting or reordering."""
+        with self.lock:
+            return self.entries.get(key)
+
+    def get_or_load(self, key, load):
+        """ Return the cached array for key, or call load() to get it and cache the result."""
+        while True:
+            with self.lock:
+                value = self.entries.get(key)
+                if value is not None:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                event = self.loading.get(key)
+                if event is None:
+                    self.loading[key] = threading.Event()
+                    self.misses += 1
+                    break
+            # Another thread is loading this key, so wait for it and look again.
+            event.wait()
+
+        try:
+            value = load()
+            self.put(key, value)
+            return value
+        finally:
+            with self.lock:
+                self.loading.pop(key).set()
+
+    def put(self, key, value):
+        """ Cache a read-only array for key, evicting the least recently used entries to fit the budget."""
+        value.flags.writeable = False
+        with self.lock:
+            if key in self.entries:
+                self.n_bytes -= self.entries.pop(key).nbytes
+            if value.nbytes > self.max_bytes:
+                return
+            self.entries[key] = value
+            self.n_bytes += value.nbytes
+            while self.n_bytes > self.max_bytes:
+                (_, evicted) = self.entries.popitem(last=False)
+                self.n_bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def resize(self, max_bytes):
+        """ Change the byte budget, evicting as needed."""
+        with self.lock:
+            self.max_bytes = max_bytes
+            while self.n_bytes > self.max_bytes and self.entries:
+                (_, evicted) = self.entries.popitem(last=False)
+                self.n_bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.n_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'n_entries': len(self.entries),
+                'n_bytes': self.n_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+# The process-wide cache, sized from the memory budget.
+cache_budget_fraction = 0.25
+cache = BlockCache(int(blocks.memory_budget_bytes * cache_budget_fraction))
+
+
+def file_identity(bin_file):
+    """ Return (absolute path, size, modification time) for a file."""
+    bin_path = Path(bin_file).absolute()
+    stat = bin_path.stat()
+    return (str(bin_path), stat.st_size, stat.st_mtime_ns)
+
+
+def memmap_for(identity, bin_file, meta):
+    """ Return a memmap of a file, reusing one from a recent call."""
+    with _memmaps_lock:
+        if identity in _memmaps:
+            _memmaps.move_to_end(identity)
+            return _memmaps[identity]
+    raw_data = blocks.memmap_bin(bin_file, meta)
+    with _memmaps_lock:
+        _memmaps[identity] = raw_data
+        while len(_memmaps) > max_memmaps:
+            _memmaps.popitem(last=False)
+    return raw_data
+
+
+def samp_per_piece():
+    return max(1, piece_bytes // (2 * chans_per_group))
+
+
+def read_window(bin_file, meta, chan_list=None, samp_0=0, samp_end=None):
+    """ Read raw int16 [n_chan, n_samp] for samples [samp_0, samp_end) of chan_list, through the cache.
+
+    The chan_list keyword arg selects saved-channel indices, default all.
+    samp_0 and samp_end are clipped to the extent of the file.
+    """
+    (n_chan, n_file_samp) = blocks.file_shape(meta)
+    chans = np.arange(n_chan) if chan_list is None else np.asarray(chan_list, dtype='int64')
+    samp_0 = int(np.clip(samp_0, 0, n_file_samp))
+    samp_end = n_file_samp if samp_end is None else int(np.clip(samp_end, samp_0, n_file_samp))
+
+    identity = file_identity(bin_file)
+    raw_data = memmap_for(identity, bin_file, meta)
+    piece_samp = samp_per_piece()
+    data = np.empty((len(chans), samp_end - samp_0), dtype='int16')
+    if samp_end <= samp_0:
+        return data
+
+    chan_groups = chans // chans_per_group
+    for group in np.unique(chan_groups):
+        rows = np.flatnonzero(chan_groups == group)
+        group_chans = chans[rows] - group * chans_per_group
+        chan_0 = int(group) * chans_per_group
+        for piece in range(samp_0 // piece_samp, (samp_end - 1) // piece_samp + 1):
+            piece_samp_0 = piece * piece_samp
+
+            def load():
+                return np.array(raw_data[chan_0:chan_0 + chans_per_group, piece_samp_0:piece_samp_0 + piece_samp])
+
+            values = cache.get_or_load((identity, int(group), piece), load)
+            first = max(samp_0, piece_samp_0)
+            last = min(samp_end, piece_samp_0 + values.shape[1])
+            data[rows, first - samp_0:last - samp_0] = values[group_chans, first - piece_samp_0:last - piece_samp_0]
+    return data
+
+
+def set_cache_bytes(max_bytes=None):
+    """ Change the byte budget of the process-wide cache, by default to its share of the memory budget."""
+    if max_bytes is None:
+        max_bytes = int(blocks.memory_budget_bytes * cache_budget_fraction)
+    cache.resize(max_bytes)
@@ -0,0 +1,313 @@
+# Walk through a SpikeGLX .bin file in blocks of consecutive samples.
+#
+# SpikeGLX writes samples interleaved by channel: all channels for sample 0,
+# then all channels for sample 1, and so on.  So a block of consecutive
+# samples across all channels is one contiguous byte range of the file, and
+# reading the file block by block is a sequential scan.
+#
+# Each block is returned as a view of shape [n_chan, n_samp] into a memmap
+# of the .bin file, just like slicing the result of makeMemMapRaw.  Nothing
+# is read from disk until the caller touches the values.
+#
+# Memmaps rely on page faults to read the file, which can mean many small
+# reads.  On network storage these cost far more than large sequential
+# reads.  So iter_blocks can also use a BufferedBlockReader, which reads each
+# block with one big os.preadv into a small pool of reusable, page-aligned
+# buffers.  A background thread reads ahead into free buffers and hints the
+# kernel with posix_fadvise, while the caller works on the current block.
+# Blocks are still [n_chan, n_samp] int16 views, now of a buffer instead of
+# a memmap, and are valid until the caller asks for the next block.
+#
+# Choose with iter_blocks(..., reader='buffered'), or for all callers of
+# iter_blocks by setting blocks.default_reader = 'buffered'.  For
+# interactive use, reader='cached' assembles blocks from the process-wide
+# LRU cache in block_cache.py, so repeated reads don't go back to disk.
+# The cache is opt-in: the default 'memmap' reader doesn't use it.
+#
+# Block sizes come from a memory budget shared by all readers and stages.
+# samp_per_block_for derives samples per block from the budget, nSavedChans,
+# how many bytes of working memory a stage needs per value, and how many
+# blocks are in memory at once.  So 385-channel files get short blocks and
+# 2-channel NI files get long ones.  Set the budget with set_memory_budget()
+# or the SPIKEGLX_TOOLS_MEMORY_MB environment variable.
+
+import mmap
+import os
+import queue
+import sys
+import threading
+import time
+import warnings
+import numpy as np
+
+# Total bytes that block-sized arrays may use at once, across workers.
+memory_budget_bytes = int(float(os.environ.get('SPIKEGLX_TOOLS_MEMORY_MB', 1024)) * 1024 * 1024)
+
+# Raw blocks no bigger than this, since bigger blocks don't read any faster.
+default_block_bytes = 64 * 1024 * 1024
+
+# How iter_blocks reads when the caller doesn't say: 'memmap', 'buffered', or 'cached'.
+default_reader = 'memmap'
+
+# Totals over all BufferedBlockReaders in this process, for read_stats().
+_read_totals = {'n_bytes': 0, 'read_secs': 0.0, 'n_blocks': 0}
+_read_totals_lock = threading.Lock()
+
+
+def file_shape(meta):
+    """ Return (n_chan, n_file_samp) for the .bin file described by meta."""
+    n_chan = int(meta["nSavedChans"])
+    n_file_samp = int(int(meta["fileSizeBytes"]) / (2 * n_chan))
+    return (n_chan, n_file_samp)
+
+
+def set_memory_budget(budget_bytes=None, block_bytes=None):
+    """ Set the memory budget and the largest raw block size for all readers, in bytes.
+
+    This also resizes the process-wide block cache to its share of the new budget.
+    """
+    global memory_budget_bytes, default_block_bytes
+    if budget_bytes:
+        memory_budget_bytes = int(budget_bytes)
+    if block_bytes:
+        default_block_bytes = int(block_bytes)
+
+    # block_cache imports this module, so only resize it if it's already imported.
+    block_cache = sys.modules.get(f'{__package__}.block_cache')
+    if block_cache is not None:
+        block_cache.set_cache_bytes()
+
+
+def samp_per_block_for(meta, block_bytes=None, n_blocks=1, work_bytes=0, reader=None):
+    """ Choose a number of samples per block.
+
+    With block_bytes given, blocks are about block_bytes of raw data.
+
+    Otherwise, blocks fit the memory budget: n_blocks of them in memory at
+    once, each needing its raw int16 data (times the number of buffers per
+    reader) plus work_bytes of working memory per value, like 4 for a float32
+    copy.  Raw blocks are also limited to default_block_bytes.
+
+    The reader keyword arg is the reader the blocks will be read with, as
+    for iter_blocks, by default blocks.default_reader.
+    """
+    n_chan = int(meta["nSavedChans"])
+    if block_bytes:
+        return max(1, int(block_bytes // (2 * n_chan)))
+
+    raw_copies = BufferedBlockReader.default_n_buffers if (reader or default_reader) == 'buffered' else 1
+    bytes_per_samp = n_chan * max(n_blocks, 1) * (2 * raw_copies + work_bytes)
+    samp_per_block = min(memory_budget_bytes // bytes_per_samp, default_block_bytes // (2 * n_chan))
+    return max(1, int(samp_per_block))
+
+
+def memmap_bin(bin_file, meta):
+    """ Like datafile.makeMemMapRaw, but quiet.
+
+    Raises ValueError if the file is shorter than fileSizeBytes from its
+    .meta, and warns if it's longer, since either way it may be a bad copy.
+    Use verify.verify_bin to check the SHA1 as well.
+    """
+    (n_chan, n_file_samp) = file_shape(meta)
+    file_size = os.stat(bin_file).st_size
+    expected_size = int(meta['fileSizeBytes'])
+    if file_size < n_file_samp * 2 * n_chan:
+        raise ValueError(f'{bin_file} has {file_size} bytes, fewer than the {expected_size} expected from its .meta')
+    if file_size > expected_size:
+        warnings.warn(f'{bin_file} has {file_size} bytes, more than the {expected_size} expected from its .meta')
+    return np.memmap(bin_file, dtype='int16', mode='r', shape=(n_chan, n_file_samp), offset=0, order='F')
+
+
+def iter_blocks(bin_file, meta, samp_0=0, n_samp=None, samp_per_block=None, reader=None):
+    """ Yield (block_samp_0, block) pairs covering samples samp_0 up through samp_0 + n_samp.
+
+    Each block is an int16 view with shape [n_chan, block_n_samp].  All blocks
+    have samp_per_block samples except possibly the last one.  The default
+    samp_per_block comes from samp_per_block_for(meta, reader=reader).
+
+    The reader keyword arg is 'memmap' for views of a memmap, 'buffered'
+    for views of a BufferedBlockReader buffer, which are only valid until the
+    next block, or 'cached' for arrays read through block_cache.  The
+    default is blocks.default_reader.
+
+    As with read_bin_ben, samp_0 and n_samp are clipped to the extent of the file.
+    """
+    (_, n_file_samp) = file_shape(meta)
+    if n_samp is None:
+        n_samp = n_file_samp
+    samp_0 = max(int(samp_0), 0)
+    n_samp = max(0, min(int(n_samp), n_file_samp - samp_0))
+    reader = reader or default_reader
+    if not samp_per_block:
+        samp_per_block = samp_per_block_for(meta, reader=reader)
+
+    if n_samp < 1:
+        return
+
+    if reader == 'buffered':
+        with BufferedBlockReader(bin_file, meta, samp_per_block) as buffered:
+            yield from buffered.blocks(samp_0, n_samp)
+        return
+
+    samp_end = samp_0 + n_samp
+    if reader == 'cached':
+        # Imported here since block_cache builds on this module.
+        from . import block_cache
+        for block_samp_0 in range(samp_0, samp_end, samp_per_block):
+            block_samp_end = min(block_samp_0 + samp_per_block, samp_end)
+            yield (block_samp_0, block_cache.read_window(bin_file, meta, None, block_samp_0, block_samp_end))
+        return
+
+    raw_data = memmap_bin(bin_file, meta)
+    for block_samp_0 in range(samp_0, samp_end, samp_per_block):
+        block_samp_end = min(block_samp_0 + samp_per_block, samp_end)
+        yield (block_samp_0, raw_data[:, block_samp_0:block_samp_end])
+
+
+class BufferedBlockReader():
+    """ Read blocks of a .bin file with large sequential reads into reusable buffers.
+
+    Use as a context manager, and iterate over blocks(samp_0, n_samp).  Each
+    block is a view of a pool buffer, so it's only valid until the next block
+    is requested.  Copy it to keep it longer.
+    """
+
+    default_n_buffers = 3
+
+    def __init__(self, bin_file, meta, samp_per_block=None, n_buffers=default_n_buffers, readahead=True):
+        (self.n_chan, self.n_file_samp) = file_shape(meta)
+        self.samp_per_block = samp_per_block or samp_per_block_for(meta, reader='buffered')
+        self.n_buffers = max(n_buffers, 2)
+        self.readahead = readahead
+        self.bytes_per_samp = 2 * self.n_chan
+        # Anonymous mmaps are page-aligned, which suits direct and network reads.
+        self.buffers = [mmap.mmap(-1, self.samp_per_block * self.bytes_per_samp) for _ in range(self.n_buffers)]
+        self.fd = os.open(bin_file, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        # Like a memmap, refuse a file shorter than its .meta says, instead of returning stale buffer contents.
+        file_size = os.fstat(self.fd).st_size
+        if file_size < self.n_file_samp * self.bytes_per_samp:
+            os.close(self.fd)
+            self.fd = None
+            raise ValueError(f'{bin_file} has {file_size} bytes, fewer than the {self.n_file_samp * self.bytes_per_samp} expected from its .meta')
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        self.n_bytes = 0
+        self.read_secs = 0.0
+        self.start_time = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def read_into(self, buffer, samp_0, n_samp):
+        """ Read n_samp samples starting at samp_0 into buffer, returning the number of bytes read.
+
+        Raises ValueError if the file ends before all the samples are read.
+        """
+        view = memoryview(buffer)[:n_samp * self.bytes_per_samp]
+        offset = samp_0 * self.bytes_per_samp
+        start = time.perf_counter()
+        n_read = 0
+        while n_read < len(view):
+            if hasattr(os, 'preadv'):
+                n = os.preadv(self.fd, [view[n_read:]], offset + n_read)
+            else:
+                os.lseek(self.fd, offset + n_read, os.SEEK_SET)
+                n = os.readv(self.fd, [view[n_read:]])
+            if n == 0:
+                break
+            n_read += n
+        seconds = time.perf_counter() - start
+
+        self.n_bytes += n_read
+        self.read_secs += seconds
+        with _read_totals_lock:
+            _read_totals['n_bytes'] += n_read
+            _read_totals['read_secs'] += seconds
+            _read_totals['n_blocks'] += 1
+        if n_read < len(view):
+            raise ValueError(f'Short read at sample {samp_0}: got {n_read} of {len(view)} bytes, file may be truncated')
+        return n_read
+
+    def block_view(self, buffer, n_samp):
+        """ View the first n_samp samples of a buffer as int16 [n_chan, n_samp], without copying."""
+        return np.frombuffer(buffer, dtype='int16', count=n_samp * self.n_chan).reshape((n_samp, self.n_chan)).T
+
+    def blocks(self, samp_0=0, n_samp=None):
+        """ Yield (block_samp_0, block) pairs like iter_blocks, reading ahead on a background thread."""
+        if n_samp is None:
+            n_samp = self.n_file_samp
+        samp_0 = max(int(samp_0), 0)
+        samp_end = samp_0 + max(0, min(int(n_samp), self.n_file_samp - samp_0))
+        ranges = [(block_samp_0, min(block_samp_0 + self.samp_per_block, samp_end) - block_samp_0)
+                  for block_samp_0 in range(samp_0, samp_end, self.samp_per_block)]
+
+        if not self.readahead:
+            for (block_samp_0, block_n_samp) in ranges:
+                self.read_into(self.buffers[0], block_samp_0, block_n_samp)
+                yield (block_samp_0, self.block_view(self.buffers[0], block_n_samp))
+            return
+
+        free = queue.Queue()
+        for buffer in self.buffers:
+            free.put(buffer)
+        filled = queue.Queue()
+        stop = threading.Event()
+
+        def read_ahead():
+            try:
+                for (index, (block_samp_0, block_n_samp)) in enumerate(ranges):
+                    buffer = free.get()
+                    if stop.is_set():
+                        return
+                    if hasattr(os, 'posix_fadvise') and index + 1 < len(ranges):
+                        # Let the kernel start on the block after this one.
+                        (next_samp_0, next_n_samp) = ranges[index + 1]
+                        os.posix_fadvise(self.fd, next_samp_0 * self.bytes_per_samp, next_n_samp * self.bytes_per_samp, os.POSIX_FADV_WILLNEED)
+                    self.read_into(buffer, block_samp_0, block_n_samp)
+                    filled.put((block_samp_0, block_n_samp, buffer))
+            except Exception as e:
+                filled.put(e)
+
+        thread = threading.Thread(target=read_ahead, daemon=True)
+        thread.start()
+        try:
+            for _ in ranges:
+                item = filled.get()
+                if isinstance(item, Exception):
+                    raise item
+                (block_samp_0, block_n_samp, buffer) = item
+                yield (block_samp_0, self.block_view(buffer, block_n_samp))
+                # The caller asked for the next block, so this buffer is free again.
+                free.put(buffer)
+        finally:
+            stop.set()
+            free.put(None)
+            thread.join()
+
+    def stats(self):
+        """ Return a dict with bytes read, seconds spent reading, and achieved MB/s."""
+        elapsed = time.perf_counter() - self.start_time
+        return {
+            'n_bytes': self.n_bytes,
+            'read_secs': self.read_secs,
+            'elapsed_secs': elapsed,
+            'read_mb_per_sec': self.n_bytes / 1e6 / max(self.read_secs, 1e-9),
+        }
+
+
+def read_stats(reset=False):
+    """ Return totals over all BufferedBlockReaders: bytes, blocks, read seconds, and MB/s while reading."""
+    with _read_totals_lock:
+        stats = dict(_read_totals)
+        if reset:
+            _read_totals.update({'n_bytes': 0, 'read_secs': 0.0, 'n_blocks': 0})
+    stats['read_mb_per_sec'] = stats['n_bytes'] / 1e6 / max(stats['read_secs'], 1e-9)
+    return stats
@@ -0,0 +1,95 @@
+# Find the SpikeGLX files that make up a run, and cache their metadata.
+#
+# SpikeGLX names files by run, gate, trigger, and stream, like:
+#   data_path/rec_g0/rec_g0_t0.nidq.bin
+#   data_path/rec_g0/rec_g0_imec0/rec_g0_t0.imec0.ap.bin
+#   data_path/rec_g0/rec_g0_imec0/rec_g0_t0.imec0.lf.bin
+#
+# A catalog is a list of dicts, one per .meta file found for a run, with the
+# gate, trigger, and stream parsed from the file name, plus a few typed
+# values parsed from the .meta: sample rate, channel count, first sample,
+# file size, and sample count.  This is enough to plan work on the files
+# without touching any .bin data.
+#
+# Parsed .meta files are cached by path, size, and modification time, so
+# building a catalog again for the same files is cheap.
+
+import os
+import re
+from pathlib import Path
+
+from . import datafile
+
+_meta_cache = {}
+
+file_name_pattern = re.compile(r'^(?P<run>.+)_g(?P<g>\d+)_t(?P<t>\d+)\.(?P<stream>.+)\.meta$')
+
+
+def read_meta_cached(meta_file):
+    """ Return (meta, typed) for a .meta file, using a cached parse when the file hasn't changed.
+
+    meta is the dict of strings from datafile.readMeta.
+    typed is a dict of a few values parsed to numbers.
+    """
+    meta_path = Path(meta_file)
+    stat = meta_path.stat()
+    key = (str(meta_path), stat.st_size, stat.st_mtime_ns)
+    if key in _meta_cache:
+        return _meta_cache[key]
+
+    meta = datafile.readMeta(meta_path.with_suffix('.bin'))
+    n_chan = int(meta['nSavedChans'])
+    file_size_bytes = int(meta['fileSizeBytes'])
+    typed = {
+        'type': meta['typeThis'],
+        'sample_rate': datafile.SampRate(meta),
+        'n_chan': n_chan,
+        'first_sample': int(meta.get('firstSample', 0)),
+        'file_size_bytes': file_size_bytes,
+        'n_samp': file_size_bytes // (2 * n_chan),
+    }
+    _meta_cache[key] = (meta, typed)
+    return (meta, typed)
+
+
+def find_meta_files(path):
+    """ Yield .meta files in and below path, using os.scandir for speed."""
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                yield from find_meta_files(entry.path)
+            elif entry.name.endswith('.meta'):
+                yield Path(entry.path)
+
+
+def catalog_run(data_path, run_name):
+    """ Return a catalog of the files in one SpikeGLX run, sorted by stream, gate, and trigger.
+
+    Each entry is a dict with 'run', 'g', 't', 'stream', 'meta_file',
+    'bin_file', and 'meta', plus the typed values from read_meta_cached.
+    """
+    catalog = []
+    data_path = Path(data_path)
+    with os.scandir(data_path) as entries:
+        gate_dirs = [Path(entry.path) for entry in entries if entry.is_dir() and entry.name.startswith(f'{run_name}_g')]
+
+    for gate_dir in gate_dirs:
+        for meta_file in find_meta_files(gate_dir):
+            match = file_name_pattern.match(meta_file.name)
+            if not match or match['run'] != run_name:
+                continue
+            (meta, typed) = read_meta_cached(meta_file)
+            entry = {
+                'run': run_name,
+                'g': int(match['g']),
+                't': int(match['t']),
+                'stream': match['stream'],
+                'meta_file': meta_file,
+                'bin_file': meta_file.with_suffix('.bin'),
+                'meta': meta,
+            }
+            entry.update(typed)
+            catalog.append(entry)
+
+    catalog.sort(key=lambda entry: (entry['stream'], entry['g'], entry['t']))
+    return catalog
@@ -0,0 +1,210 @@
+# Write and read a channel-major copy of a SpikeGLX .bin file.
+#
+# SpikeGLX .bin files are sample-interleaved (order='F' in makeMemMapRaw).
+# Reading one channel over a whole recording touches every page of the file,
+# so a 7GB AP file costs 7GB of I/O just to get at the sync channel.
+#
+# A channel-major copy stores all samples of channel 0, then all samples
+# of channel 1, and so on.  Optionally, the copy can be tiled in time:
+# tiles of tile_samp samples each, and within each tile all samples of
+# channel 0, then channel 1, etc.  Either way, a long single-channel read
+# becomes one (or one per tile) large sequential read.
+#
+# The copy is written next to the original with the extension ".cmbin",
+# so it's not picked up by searches for "*.bin".  A small ".cmmeta" sidecar
+# of key=value pairs records the layout and the identity of the original:
+# fileSizeBytes and fileSHA1 from its .meta, plus the size and modification
+# time of the .bin itself, so a rewritten .bin invalidates the copy.
+#
+# Readers of a few channels use read_channels or iter_channel_blocks, which
+# prefer a valid copy and otherwise read the original.  These back the sync
+# reads in timebase.py, the digital word reads in digital_events.py, and
+# read_bin_ben(..., chan_list=...), for example NI analog or LF channels.
+# makeMemMapRaw and the block readers in blocks.py still map the original
+# .bin, since their callers expect sample-interleaved data.
+
+import os
+from pathlib import Path
+import numpy as np
+
+from . import blocks
+from .cli_wrappers import read_key_value_pairs
+
+
+def channel_major_paths(bin_file):
+    """ Return (cmbin_file, cmmeta_file) paths for the channel-major copy of bin_file."""
+    bin_path = Path(bin_file)
+    cmbin_file = bin_path.with_suffix('.cmbin')
+    cmmeta_file = bin_path.with_suffix('.cmmeta')
+    return (cmbin_file, cmmeta_file)
+
+
+def write_channel_major(bin_file, meta, tile_samp=None, samp_per_block=None):
+    """ Write a channel-major copy of the given .bin file, with bounded memory.
+
+    This is an out-of-core transpose.  It reads the .bin file sequentially in
+    blocks of samp_per_block samples across all channels.  Each block is
+    transposed in memory to channel-major order, then each channel's row is
+    written out as one contiguous run.  Memory use is about two blocks,
+    regardless of file size.
+
+    The tile_samp keyword arg is None by default, for a fully channel-major
+    copy.  If tile_samp is given, the copy is tiled in time with tile_samp
+    samples per tile, and the final tile is zero-padded to full size.
+
+    Returns the path to the new .cmbin file.
+    """
+    (n_chan, n_file_samp) = blocks.file_shape(meta)
+    (cmbin_file, cmmeta_file) = channel_major_paths(bin_file)
+    bin_stat = Path(bin_file).stat()
+
+    if not samp_per_block:
+        # The block is transposed and padded into tiles, both int16.
+        samp_per_block = blocks.samp_per_block_for(meta, work_bytes=4)
+    if tile_samp:
+        # Keep blocks aligned to whole tiles.
+        samp_per_block = max(tile_samp, (samp_per_block // tile_samp) * tile_samp)
+        n_tiles = int(np.ceil(n_file_samp / tile_samp))
+        cm_n_samp = n_tiles * tile_samp
+    else:
+        tile_samp = 0
+        cm_n_samp = n_file_samp
+
+    print(f'Writing channel-major copy of {Path(bin_file).name} ({n_chan} channels, {n_file_samp} samples)')
+
+    temp_file = cmbin_file.with_suffix('.cmbin.partial')
+    with open(temp_file, 'wb') as f:
+        f.truncate(n_chan * cm_n_samp * 2)
+        for (block_samp_0, block) in blocks.iter_blocks(bin_file, meta, samp_per_block=samp_per_block):
+            block_n_samp = block.shape[1]
+            transposed = np.ascontiguousarray(block)
+            if tile_samp:
+                tile_0 = block_samp_0 // tile_samp
+                n_block_tiles = int(np.ceil(block_n_samp / tile_samp))
+                padded = np.zeros((n_chan, n_block_tiles * tile_samp), dtype='int16')
+                padded[:, :block_n_samp] = transposed
+                # Tiles are contiguous and consecutive, so the whole block is one write.
+                tiled = padded.reshape(n_chan, n_block_tiles, tile_samp).transpose(1, 0, 2)
+                f.seek(tile_0 * n_chan * tile_samp * 2)
+                f.write(np.ascontiguousarray(tiled).tobytes())
+            else:
+                for chan in range(n_chan):
+                    f.seek((chan * cm_n_samp + block_samp_0) * 2)
+                    f.write(transposed[chan].tobytes())
+    os.replace(temp_file, cmbin_file)
+
+    cm_info = {
+        'nSavedChans': n_chan,
+        'nFileSamp': n_file_samp,
+        'tileSamp': tile_samp,
+        'srcFileSizeBytes': meta['fileSizeBytes'],
+        'srcFileSHA1': meta.get('fileSHA1', ''),
+        'srcBinSizeBytes': bin_stat.st_size,
+        'srcBinMtimeNs': bin_stat.st_mtime_ns,
+    }
+    with open(cmmeta_file, 'w') as f:
+        for key, value in cm_info.items():
+            f.write(f'{key}={value}\n')
+
+    return cmbin_file
+
+
+def read_channel_major_info(bin_file, meta):
+    """ Return the sidecar info for a valid channel-major copy of bin_file, or None.
+
+    The copy counts as valid if it was made from a file with the same size and
+    SHA1 as recorded in meta, and with the same size and modification time as
+    the .bin file now, and if the .cmbin file has the expected size.
+    """
+    (cmbin_file, cmmeta_file) = channel_major_paths(bin_file)
+    if not cmbin_file.exists() or not cmmeta_file.exists():
+        return None
+
+    cm_info = read_key_value_pairs(cmmeta_file)
+    if cm_info.get('srcFileSizeBytes') != meta['fileSizeBytes']:
+        return None
+    if cm_info.get('srcFileSHA1') != meta.get('fileSHA1', ''):
+        return None
+    bin_stat = Path(bin_file).stat()
+    if cm_info.get('srcBinSizeBytes') != str(bin_stat.st_size) or cm_info.get('srcBinMtimeNs') != str(bin_stat.st_mtime_ns):
+        return None
+
+    n_chan = int(cm_info['nSavedChans'])
+    n_file_samp = int(cm_info['nFileSamp'])
+    tile_samp = int(cm_info['tileSamp'])
+    if tile_samp:
+        cm_n_samp = int(np.ceil(n_file_samp / tile_samp)) * tile_samp
+    else:
+        cm_n_samp = n_file_samp
+    if cmbin_file.stat().st_size != n_chan * cm_n_samp * 2:
+        return None
+
+    cm_info['cmbin_file'] = cmbin_file
+    cm_info['cm_n_samp'] = cm_n_samp
+    return cm_info
+
+
+def read_channels(bin_file, meta, chan_list, samp_0=0, n_samp=None):
+    """ Read raw int16 samples for a few channels over a long span of time.
+
+    Returns an array with dimensions [len(chan_list), n_samp].
+
+    If a valid channel-major copy of bin_file exists, read from that, which
+    costs I/O proportional to the number of channels requested.  Otherwise,
+    fall back to a strided read of the original .bin.  The results are the
+    same either way.
+
+    As with read_bin_ben, samp_0 and n_samp are clipped to the extent of the file.
+    """
+    (samp_0, n_samp) = clip_range(meta, samp_0, n_samp)
+    return _read_channels(bin_file, meta, read_channel_major_info(bin_file, meta), list(chan_list), samp_0, n_samp)
+
+
+def iter_channel_blocks(bin_file, meta, chan_list, samp_0=0, n_samp=None, samp_per_block=None):
+    """ Yield (block_samp_0, block) pairs like blocks.iter_blocks, for just the channels in chan_list.
+
+    Blocks are arrays [len(chan_list), block_n_samp] from read_channels,
+    checking once for a valid channel-major copy.
+    """
+    (samp_0, n_samp) = clip_range(meta, samp_0, n_samp)
+    if not samp_per_block:
+        samp_per_block = blocks.samp_per_block_for(meta)
+    chan_list = list(chan_list)
+    cm_info = read_channel_major_info(bin_file, meta)
+    samp_end = samp_0 + n_samp
+    for block_samp_0 in range(samp_0, samp_end, samp_per_block):
+        block_n_samp = min(samp_per_block, samp_end - block_samp_0)
+        yield (block_samp_0, _read_channels(bin_file, meta, cm_info, chan_list, block_samp_0, block_n_samp))
+
+
+def clip_range(meta, samp_0, n_samp):
+    """ Clip samp_0 and n_samp to the extent of the file, returning (samp_0, n_samp)."""
+    (_, n_file_samp) = blocks.file_shape(meta)
+    if n_samp is None:
+        n_samp = n_file_samp
+    samp_0 = max(int(samp_0), 0)
+    n_samp = max(0, min(int(n_samp), n_file_samp - samp_0))
+    return (samp_0, n_samp)
+
+
+def _read_channels(bin_file, meta, cm_info, chan_list, samp_0, n_samp):
+    samp_end = samp_0 + n_samp
+    if cm_info is None:
+        raw_data = blocks.memmap_bin(bin_file, meta)
+        return np.ascontiguousarray(raw_data[chan_list, samp_0:samp_end])
+
+    n_chan = int(cm_info['nSavedChans'])
+    tile_samp = int(cm_info['tileSamp'])
+    cm_n_samp = cm_info['cm_n_samp']
+    if tile_samp:
+        n_tiles = cm_n_samp // tile_samp
+        cm_data = np.memmap(cm_info['cmbin_file'], dtype='int16', mode='r', shape=(n_tiles, n_chan, tile_samp))
+        tile_0 = samp_0 // tile_samp
+        tile_end = int(np.ceil(samp_end / tile_samp))
+        tiles = cm_data[tile_0:tile_end][:, chan_list, :]
+        flat = tiles.transpose(1, 0, 2).reshape(len(chan_list), -1)
+        first = samp_0 - tile_0 * tile_samp
+        return np.ascontiguousarray(flat[:, first:first + n_samp])
+    else:
+        cm_data = np.memmap(cm_info['cmbin_file'], dtype='int16', mode='r', shape=(n_chan, cm_n_samp))
+        return np.ascontiguousarray(cm_data[chan_list, samp_0:samp_end])
@@ -0,0 +1,158 @@
+# Command line entry point for spikeglx_tools, with subcommands.
+#
+# Each subcommand imports what it needs only when it runs.  Module level
+# imports here are just the standard library, so commands start quickly
+# and metadata-only commands don't pay for matplotlib or other heavy
+# imports.
+#
+# From the command line:
+#   python -m spikeglx_tools describe path/to/recordings
+#   python -m spikeglx_tools summarize path/to/recordings --start 0 --duration 30
+#   python -m spikeglx_tools sync-edges path/to/recordings --output-dir edges
+#   python -m spikeglx_tools verify path/to/recordings
+#   python -m spikeglx_tools catgt spikeglx_data rec 3 0 --streams "-ni -ap -lf" --dest products
+#   python -m spikeglx_tools tprime sync_imec0.txt --from sync_ni.txt events_ni.txt
+#   python -m spikeglx_tools batch sessions.json --state batch/state.json
+#
+# Or use the spikeglx-tools script next to the spikeglx_tools package, the
+# same way.
+
+import argparse
+import sys
+
+
+def describe(args):
+    from . import datafile
+    from .summary import describe_ni, describe_im
+    from .verify import find_bin_files
+
+    for bin_file in find_bin_files(args.paths):
+        meta = datafile.readMeta(bin_file)
+        if meta['typeThis'] == 'nidq':
+            describe_ni(meta, bin_file)
+        else:
+            describe_im(meta, bin_file)
+    return 0
+
+
+def summarize(args):
+    from .summary import plot_recording_summary
+
+    plot_recording_summary(args.rec_dir, args.start, args.duration, args.glob, cache_dir=args.cache_dir, samp_per_chunk=args.samp_per_chunk)
+    return 0
+
+
+def sync_edges(args):
+    from pathlib import Path
+    from . import datafile
+    from .cli_wrappers import write_floats
+    from .timebase import sync_edges
+    from .verify import find_bin_files
+
+    for bin_file in find_bin_files(args.paths):
+        meta = datafile.readMeta(bin_file)
+        times = sync_edges(bin_file, meta) / datafile.SampRate(meta)
+        print(f'{bin_file.name}: {len(times)} sync edges')
+        if args.output_dir:
+            out_path = Path(args.output_dir)
+            out_path.mkdir(parents=True, exist_ok=True)
+            edges_file = out_path.joinpath(f'{bin_file.stem}.sync_edges.txt')
+            write_floats(edges_file, times)
+            print(f'Wrote {edges_file}')
+    return 0
+
+
+def verify(argv):
+    from . import verify
+
+    return verify.main(argv)
+
+
+def catgt(args):
+    from .cli_wrappers import catgt
+
+    catgt(args.data_path, args.run_name, args.g, args.t, args.streams, options=args.options,
+          output_path=args.dest, dry_run=args.dry_run, which_runit=args.runit)
+    return 0
+
+
+def tprime(args):
+    from .cli_wrappers import tprime
+
+    from_streams = [(from_args + [None])[:3] for from_args in args.from_streams]
+    tprime(args.to_stream, from_streams, sync_period=args.sync_period, dry_run=args.dry_run, which_runit=args.runit)
+    return 0
+
+
+def batch(argv):
+    from . import scheduler
+
+    return scheduler.main(argv)
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(prog='spikeglx-tools', description='Tools for SpikeGLX recordings.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    describe_parser = subparsers.add_parser('describe', help='print interpreted metadata for .bin files')
+    describe_parser.add_argument('paths', nargs='+', help='.bin files or folders to search for .bin files')
+    describe_parser.set_defaults(func=describe)
+
+    summarize_parser = subparsers.add_parser('summarize', help='plot a summary of each .bin file in a recording folder')
+    summarize_parser.add_argument('rec_dir', help='folder to search for .bin files')
+    summarize_parser.add_argument('--start', type=float, default=0, help='start time in seconds')
+    summarize_parser.add_argument('--duration', type=float, default=30, help='duration in seconds')
+    summarize_parser.add_argument('--glob', default='**/*.bin', help='pattern for finding .bin files')
+    summarize_parser.add_argument('--cache-dir', default=None, help='folder for cached per-file summaries')
+    summarize_parser.add_argument('--samp-per-chunk', type=int, default=None, help='samples per min/max chunk')
+    summarize_parser.set_defaults(func=summarize)
+
+    sync_parser = subparsers.add_parser('sync-edges', help='find sync edge times in .bin files')
+    sync_parser.add_argument('paths', nargs='+', help='.bin files or folders to search for .bin files')
+    sync_parser.add_argument('--output-dir', default=None, help='folder for writing edge times, one per line, in seconds')
+    sync_parser.set_defaults(func=sync_edges)
+
+    # These pass their arguments through to their own modules' parsers, in main().
+    subparsers.add_parser('verify', help='check .bin files against fileSizeBytes and fileSHA1', add_help=False)
+
+    catgt_parser = subparsers.add_parser('catgt', help='run CatGT')
+    catgt_parser.add_argument('data_path', help='folder where SpikeGLX wrote data')
+    catgt_parser.add_argument('run_name', help='SpikeGLX run name, like "rec"')
+    catgt_parser.add_argument('g', help='gate index or range, like "0" or "0:1"')
+    catgt_parser.add_argument('t', help='trigger index or range, like "0" or "0:7"')
+    catgt_parser.add_argument('--streams', default='-ni -ap -lf', help='CatGT stream flags, like "-ni -ap -lf"')
+    catgt_parser.add_argument('--options', default='', help='other CatGT options, like "-prb_fld -prb=0:1"')
+    catgt_parser.add_argument('--dest', default=None, help='folder for CatGT output')
+    catgt_parser.add_argument('--runit', default=None, help='path to the CatGT runit script')
+    catgt_parser.add_argument('--dry-run', action='store_true', help='parse and print without running CatGT')
+    catgt_parser.set_defaults(func=catgt)
+
+    tprime_parser = subparsers.add_parser('tprime', help='run TPrime')
+    tprime_parser.add_argument('to_stream', help='file of sync edge times for the reference stream')
+    tprime_parser.add_argument('--from', dest='from_streams', nargs='+', action='append', required=True,
+                               metavar='FILE', help='edges_file events_file [out_file] for a stream to align, repeatable')
+    tprime_parser.add_argument('--sync-period', type=float, default=1.0, help='sync pulse period in seconds')
+    tprime_parser.add_argument('--runit', default=None, help='path to the TPrime runit script')
+    tprime_parser.add_argument('--dry-run', action='store_true', help='parse and print without running TPrime')
+    tprime_parser.set_defaults(func=tprime)
+
+    subparsers.add_parser('batch', help='run processing stages for many sessions, resuming from a state file', add_help=False)
+
+    return parser
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    passthrough = {'verify': verify, 'batch': batch}
+    if argv and argv[0] in passthrough:
+        return passthrough[argv[0]](argv[1:])
+
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    if args.command == 'tprime' and any(len(from_args) not in (2, 3) for from_args in args.from_streams):
+        parser.error('each --from takes edges_file events_file [out_file]')
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
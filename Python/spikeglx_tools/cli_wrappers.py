@@ -13,6 +13,12 @@ def read_floats(file_path):
         floats = [float(line.strip()) for line in f if not line.isspace()]
     return floats
 
+def write_floats(file_path, values):
+    "Write floats to a text file with one float value per line, as read by read_floats."
+
+    with open(file_path, 'w') as f:
+        f.writelines(f'{value:.6f}\n' for value in values)
+
 def read_key_value_pairs(file_path, separator='='):
     """ Read a file of key-value pairs into a dict.
 
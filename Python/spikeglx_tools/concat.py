@@ -0,0 +1,189 @@
+# Present several trigger files as one continuous recording, without copying.
+#
+# CatGT's -t=0:7 concatenation and -supercat rewrite every sample, which
+# doubles disk usage and takes as long as a full copy.  A ConcatRecording
+# instead keeps a memmap of each .bin file and a plan of where each file
+# lands in the concatenated recording, from gaps.plan_stream.  Gaps between
+# files read as zeros, and overlapping samples are trimmed.
+#
+# Slicing a ConcatRecording resolves the requested samples to segments of
+# the underlying memmaps.  A slice within one file is a view with no
+# copying, and slices across files are assembled from per-file views.
+# Either way, results have the same shape as slicing one big array: an
+# integer channel or sample index drops that dimension.
+#
+# When a physical file is needed, export() writes one using
+# os.copy_file_range (or sendfile) for the bulk data, so the bytes move
+# kernel-side without passing through Python.
+
+import os
+from pathlib import Path
+import numpy as np
+
+from . import blocks
+from . import datafile_ben
+from .gaps import plan_run
+
+
+class ConcatRecording():
+    """ A sliceable [n_chan, n_samp] int16 view over the files of a concatenation plan.
+
+    Create from a plan made by gaps.plan_stream, or with ConcatRecording.from_run().
+    """
+
+    def __init__(self, plan):
+        self.plan = plan
+        self.meta = plan[0]['meta']
+        self.n_chan = plan[0]['n_chan']
+        self.sample_rate = plan[0]['sample_rate']
+        for step in plan:
+            if step['n_chan'] != self.n_chan:
+                raise Exception(f'Channel count {step["n_chan"]} in {step["bin_file"]} does not match {self.n_chan}')
+
+        self.memmaps = [blocks.memmap_bin(step['bin_file'], step['meta']) for step in plan]
+        self.starts = np.array([step['out_offset'] for step in plan], dtype='int64')
+        self.lengths = np.array([step['n_samp'] - step['trim'] for step in plan], dtype='int64')
+        self.n_samp = int((self.starts + self.lengths).max()) if plan else 0
+        self.shape = (self.n_chan, self.n_samp)
+        self.dtype = np.dtype('int16')
+
+    @classmethod
+    def from_run(cls, data_path, run_name, stream, fill_gaps=True):
+        """ Build a ConcatRecording for one stream of a run, like 'nidq' or 'imec0.ap'."""
+        plans = plan_run(data_path, run_name, streams=[stream], fill_gaps=fill_gaps)
+        if stream not in plans:
+            raise Exception(f'No files found for stream {stream} of run {run_name} in {data_path}')
+        return cls(plans[stream])
+
+    def segments(self, samp_0, samp_end):
+        """ Resolve samples [samp_0, samp_end) to a list of (out_samp_0, view, n) tuples, without copying.
+
+        Each view is [n_chan, n] from one file's memmap.  Gaps have view None.
+        """
+        samp_0 = max(int(samp_0), 0)
+        samp_end = min(int(samp_end), self.n_samp)
+        segments = []
+        position = samp_0
+        for (index, step) in enumerate(self.plan):
+            file_start = int(self.starts[index])
+            file_end = file_start + int(self.lengths[index])
+            if file_end <= position or file_start >= samp_end:
+                continue
+            if file_start > position:
+                segments.append((position, None, file_start - position))
+                position = file_start
+            first = position - file_start + step['trim']
+            last = min(file_end, samp_end) - file_start + step['trim']
+            segments.append((position, self.memmaps[index][:, first:last], last - first))
+            position += last - first
+        if position < samp_end:
+            segments.append((position, None, samp_end - position))
+        return segments
+
+    def __len__(self):
+        return self.n_chan
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        (chans, samples) = key
+
+        # Read integer indices as one-element slices, then drop their dimensions at the end.
+        drop = []
+        if isinstance(chans, (int, np.integer)):
+            chan = int(np.arange(self.n_chan)[chans])
+            chans = slice(chan, chan + 1)
+            drop.append(0)
+        if isinstance(samples, (int, np.integer)):
+            samp = int(np.arange(self.n_samp)[samples])
+            samples = slice(samp, samp + 1)
+            drop.append(1)
+        if not isinstance(samples, slice) or samples.step not in (None, 1):
+            raise Exception('ConcatRecording supports only contiguous sample slices')
+        (samp_0, samp_end, _) = samples.indices(self.n_samp)
+
+        segments = self.segments(samp_0, samp_end)
+        if len(segments) == 1 and segments[0][1] is not None:
+            data = segments[0][1][chans, :]
+        else:
+            n_rows = np.arange(self.n_chan)[chans].size
+            data = np.zeros((n_rows, max(samp_end - samp_0, 0)), dtype='int16')
+            for (out_samp_0, view, n) in segments:
+                if view is not None:
+                    data[:, out_samp_0 - samp_0:out_samp_0 - samp_0 + n] = view[chans, :]
+
+        if drop:
+            data = data[tuple(0 if axis in drop else slice(None) for axis in range(2))]
+        return data
+
+    def export(self, out_file):
+        """ Write the concatenated recording to a new .bin and .meta pair.
+
+        Bulk data moves with os.copy_file_range where available, falling back
+        to os.sendfile, then plain reads and writes.  Gaps are left as holes
+        in the output file, which read as zeros.
+
+        The new .meta has updated fileSizeBytes and fileTimeSecs.  fileSHA1 is
+        removed, since it would require reading all the data.
+        """
+        out_path = Path(out_file)
+        bytes_per_samp = 2 * self.n_chan
+        with open(out_path, 'wb') as out_f:
+            out_f.truncate(self.n_samp * bytes_per_samp)
+            out_fd = out_f.fileno()
+            for (index, step) in enumerate(self.plan):
+                with open(step['bin_file'], 'rb') as in_f:
+                    copy_range(in_f.fileno(), out_fd,
+                               step['trim'] * bytes_per_samp,
+                               int(self.starts[index]) * bytes_per_samp,
+                               int(self.lengths[index]) * bytes_per_samp)
+
+        updates = {
+            'fileSizeBytes': self.n_samp * bytes_per_samp,
+            'fileTimeSecs': f'{self.n_samp / self.sample_rate:.6f}',
+            'firstSample': self.plan[0]['first_sample'],
+            'fileSHA1': None,
+        }
+        datafile_ben.write_meta_like(self.plan[0]['bin_file'], out_path, updates)
+        return out_path
+
+
+def copy_range(in_fd, out_fd, in_offset, out_offset, count):
+    """ Copy count bytes between file descriptors at the given offsets, kernel-side when possible.
+
+    Raises ValueError if the input ends before count bytes are copied.
+    """
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while count > 0:
+                n = os.copy_file_range(in_fd, out_fd, count, in_offset, out_offset)
+                if n == 0:
+                    break
+                (count, in_offset, out_offset) = (count - n, in_offset + n, out_offset + n)
+            if count == 0:
+                return
+        except OSError:
+            pass
+
+    if hasattr(os, 'sendfile'):
+        try:
+            os.lseek(out_fd, out_offset, os.SEEK_SET)
+            while count > 0:
+                n = os.sendfile(out_fd, in_fd, in_offset, count)
+                if n == 0:
+                    break
+                (count, in_offset, out_offset) = (count - n, in_offset + n, out_offset + n)
+            if count == 0:
+                return
+        except OSError:
+            pass
+
+    buffer_bytes = 16 * 1024 * 1024
+    while count > 0:
+        chunk = os.pread(in_fd, min(count, buffer_bytes), in_offset)
+        if not chunk:
+            break
+        os.pwrite(out_fd, chunk, out_offset)
+        (count, in_offset, out_offset) = (count - len(chunk), in_offset + len(chunk), out_offset + len(chunk))
+    if count > 0:
+        raise ValueError(f'Input ended at byte {in_offset}, with {count} bytes left to copy, file may be truncated')
@@ -2,61 +2,349 @@
 # up through nSamp samples (or as much as is available).
 #
 # To limit memory usage, read the data in chunks of fixed
-# number of samples.  For each chunk, keep only the min and
-# max.
+# number of samples.  For each chunk, keep only a few
+# representative values, chosen by mode:
+#   - 'minmax' (default): the min and the max
+#   - 'median': the median
+#   - 'percentile': the values at each of the given percentiles,
+#      for example (5, 95) for a robust envelope
 #
 # Min and max have property of being actual, raw sample
 # values from the binary data.  This facilitates downstream
 # processing that makes assumptions about possible values
 # or their encodings (for example, digital words).  Other
 # summary stats, like mean, lack this property.  Median
-# would also have this property, but it's slower to compute.
+# and percentiles also have this property: they're chosen
+# as the sample nearest the requested rank within each chunk.
+# They use np.argpartition over many chunks at once, so they
+# cost only a small factor more than min and max.
 #
-# Return an array of mins and maxes from all chunks
-# in the specified range.  Also return a corresponding
-# array of sample numbers where the mins and maxs occured.
+# Return an array of values from all chunks in the specified
+# range.  Also return a corresponding array of sample numbers
+# where the values occured.
 #
-# Both retuned arrays have dimensions [n_chan, 2 * n_chunks],
-# where n_chunks = ceil(n_samp / samp_per_chunk).
+# Both retuned arrays have dimensions [n_chan, n_values * n_chunks],
+# where n_chunks = ceil(n_samp / samp_per_chunk) and n_values is 2 for
+# 'minmax', 1 for 'median', and len(percentiles) for 'percentile'.
+# Values for each chunk are adjacent, in the order listed above.
+#
+# By default samp_per_chunk is 100, or more if needed to keep the
+# returned arrays within half of the memory budget from blocks.py, so
+# that a summary of any size file fits in memory.  Blocks are sized
+# from the rest of the budget.
+#
+# Chunks are read in large blocks, and with n_workers > 1 separate
+# shards of the range are read concurrently on a thread pool.
+# With backend='process', blocks are read in order into shared memory
+# instead, and pieces of each block are summarized by a pool of worker
+# processes, which write into shared output arrays.
+#
+# The reader arg chooses how blocks are read, 'memmap', 'buffered', or 'cached',
+# as for blocks.iter_blocks.
+#
+# The chan_list arg selects saved channels to read, by default all of them.
+# Returned rows follow chan_list.  Selected channels are read with
+# channel_major.iter_channel_blocks, which uses a valid channel-major copy of
+# the file when one exists, so reading a few channels costs I/O for just
+# those channels.
 #
 # IMPORTANT: samp_0 and n_samp must be integers.
 
+import re
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+from pathlib import Path
+
+from . import datafile
+from . import blocks
+from . import backends
+from .channel_major import iter_channel_blocks
+
+
+def read_bin_ben(samp_0, n_samp, meta, bin_file, samp_per_chunk=None, mode='minmax', percentiles=(5, 95), n_workers=1, backend='thread', reader=None, chan_list=None):
+    n_file_samp = int(int(meta["fileSizeBytes"]) / (2 * int(meta["nSavedChans"])))
+    n_chan = int(meta["nSavedChans"]) if chan_list is None else len(chan_list)
 
-def read_bin_ben(samp_0, n_samp, meta, bin_file, samp_per_chunk=100):
-    n_chan = int(meta["nSavedChans"])
-    n_file_samp = int(int(meta["fileSizeBytes"]) / (2 * n_chan))
+    def read_blocks(block_samp_0, block_n_samp, samp_per_block):
+        if chan_list is None:
+            return blocks.iter_blocks(bin_file, meta, block_samp_0, block_n_samp, samp_per_block, reader)
+        return iter_channel_blocks(bin_file, meta, chan_list, block_samp_0, block_n_samp, samp_per_block)
 
     samp_0 = max(samp_0, 0)
-    n_samp = min(n_samp, n_file_samp - samp_0)
+    n_samp = max(min(n_samp, n_file_samp - samp_0), 0)
+    n_values = values_per_chunk(mode, percentiles)
+    if not samp_per_chunk:
+        samp_per_chunk = budget_samp_per_chunk(n_chan, n_samp, n_values)
+    n_chunks = int(np.ceil(n_samp / samp_per_chunk))
+
+    # As in the original chunk-by-chunk version, the last chunk
+    # is a full chunk if the file has enough samples.
+    samp_end = min(samp_0 + n_chunks * samp_per_chunk, n_file_samp)
+
+    # Split whole chunks into shards, and each shard into blocks of whole chunks.
+    # Selection for medians and percentiles needs an int64 index per sample.
+    work_bytes = 2 if mode == 'minmax' else 16
+    # Blocks get the half of the budget not used for results.
+    n_blocks = 1 if backend != 'thread' else max(1, min(n_workers, n_chunks))
+    chunks_per_block = max(1, blocks.samp_per_block_for(meta, n_blocks=2 * n_blocks, work_bytes=work_bytes, reader=reader) // samp_per_chunk)
+    if backend != 'thread':
+        runner = backends.get_backend(backend, n_workers)
+        results = [summarize_block_with(runner, block, block_samp_0, samp_per_chunk, mode, percentiles)
+                   for (block_samp_0, block) in read_blocks(samp_0, samp_end - samp_0, chunks_per_block * samp_per_chunk)]
+        return concatenate_results(results, n_chan)
+
+    n_shards = max(1, min(n_workers, n_chunks))
+    shard_edges = np.linspace(0, n_chunks, n_shards + 1).astype('int64')
+
+    def read_shard(shard):
+        shard_samp_0 = samp_0 + int(shard_edges[shard]) * samp_per_chunk
+        shard_samp_end = min(samp_0 + int(shard_edges[shard + 1]) * samp_per_chunk, samp_end)
+        results = [summarize_chunks(block, block_samp_0, samp_per_chunk, mode, percentiles)
+                   for (block_samp_0, block) in read_blocks(shard_samp_0, shard_samp_end - shard_samp_0, chunks_per_block * samp_per_chunk)]
+        return results
+
+    if n_shards > 1:
+        with ThreadPoolExecutor(max_workers=n_shards) as executor:
+            shard_results = list(executor.map(read_shard, range(n_shards)))
+    else:
+        shard_results = [read_shard(0)]
+
+    results = [result for shard_result in shard_results for result in shard_result]
+    return concatenate_results(results, n_chan)
+
+
+# Choose samples per chunk: 100, or more if needed so that values and
+# indices for n_samp samples stay within half of the memory budget.
+# Each value costs 8 bytes, plus 8 for its index, and results are
+# held twice while being concatenated.
+def budget_samp_per_chunk(n_chan, n_samp, n_values=2, min_samp_per_chunk=100):
+    output_bytes = n_chan * n_values * n_samp * 32
+    return max(min_samp_per_chunk, int(np.ceil(output_bytes / (blocks.memory_budget_bytes / 2))))
+
+
+def concatenate_results(results, n_chan):
+    if not results:
+        return (np.zeros((n_chan, 0)), np.zeros((n_chan, 0), dtype='int64'))
+
+    values = np.concatenate([result[0] for result in results], axis=1)
+    indices = np.concatenate([result[1] for result in results], axis=1)
+    return (values, indices)
+
+
+# Summarize one block with an execution backend from backends.get_backend.
+# The block is copied into the backend's shared 'data' array once, then
+# pieces of whole chunks are summarized by the backend's workers, each
+# writing its own columns of the shared 'values' and 'indices' arrays.
+def summarize_block_with(runner, block, samp_0, samp_per_chunk=100, mode='minmax', percentiles=(5, 95)):
+    n_chan, n_samp = block.shape
+    n_values = values_per_chunk(mode, percentiles)
+    n_chunks = int(np.ceil(n_samp / samp_per_chunk))
+
+    arrays = {
+        'data': runner.array('data', (n_chan, n_samp), 'int16'),
+        'values': runner.array('values', (n_chan, n_values * n_chunks), 'float64'),
+        'indices': runner.array('indices', (n_chan, n_values * n_chunks), 'int64'),
+    }
+    np.copyto(arrays['data'], block)
+    tasks = [(start, end, samp_0, samp_per_chunk, mode, tuple(percentiles))
+             for (start, end) in backends.split_range(n_samp, runner.n_workers, samp_per_chunk)]
+    runner.run(_summarize_task, tasks, arrays)
+    return (arrays['values'].copy(), arrays['indices'].copy())
+
+
+def _summarize_task(arrays, start, end, samp_0, samp_per_chunk, mode, percentiles):
+    n_values = values_per_chunk(mode, percentiles)
+    (values, indices) = summarize_chunks(arrays['data'][:, start:end], samp_0 + start, samp_per_chunk, mode, percentiles)
+    column = (start // samp_per_chunk) * n_values
+    arrays['values'][:, column:column + values.shape[1]] = values
+    arrays['indices'][:, column:column + indices.shape[1]] = indices
+
+
+# How many values summarize_chunks keeps per chunk, by mode.
+def values_per_chunk(mode='minmax', percentiles=(5, 95)):
+    if mode == 'minmax':
+        return 2
+    elif mode == 'median':
+        return 1
+    else:
+        return len(percentiles)
+
+
+# Dispatch to min_max_chunks or percentile_chunks, by mode.
+def summarize_chunks(data, samp_0, samp_per_chunk=100, mode='minmax', percentiles=(5, 95)):
+    if mode == 'minmax':
+        return min_max_chunks(data, samp_0, samp_per_chunk)
+    elif mode == 'median':
+        return percentile_chunks(data, samp_0, samp_per_chunk, [50])
+    elif mode == 'percentile':
+        return percentile_chunks(data, samp_0, samp_per_chunk, percentiles)
+    else:
+        raise Exception(f'Unknown decimation mode: {mode}')
+
+
+# Compute the same mins, maxes, and sample numbers as read_bin_ben,
+# for a block of raw data that's already in memory, with dimensions
+# [n_chan, n_samp].  The block starts at file sample number samp_0.
+#
+# Chunks are aligned to the start of the block, so to get the same
+# results as read_bin_ben over a longer span, each block but the last
+# should contain a whole number of chunks.
+def min_max_chunks(data, samp_0, samp_per_chunk=100):
+    n_chan, n_samp = data.shape
+    n_full = n_samp // samp_per_chunk
+    n_chunks = int(np.ceil(n_samp / samp_per_chunk))
+
+    values = np.zeros((n_chan, 2 * n_chunks))
+    indices = np.zeros((n_chan, 2 * n_chunks), dtype='int64')
+
+    if n_full:
+        # View full chunks as [n_chan, n_full, samp_per_chunk] and reduce along the last axis.
+        chunked = data[:, :n_full * samp_per_chunk].reshape(n_chan, n_full, samp_per_chunk)
+        min_inds = chunked.argmin(2)
+        max_inds = chunked.argmax(2)
+        chunk_starts = np.arange(n_full) * samp_per_chunk + samp_0
+        values[:, 0:2 * n_full:2] = np.take_along_axis(chunked, min_inds[..., None], 2)[..., 0]
+        values[:, 1:2 * n_full:2] = np.take_along_axis(chunked, max_inds[..., None], 2)[..., 0]
+        indices[:, 0:2 * n_full:2] = min_inds + chunk_starts
+        indices[:, 1:2 * n_full:2] = max_inds + chunk_starts
+
+    if n_chunks > n_full:
+        # One partial chunk at the end.
+        last = data[:, n_full * samp_per_chunk:]
+        last_samp_0 = samp_0 + n_full * samp_per_chunk
+        min_ind = last.argmin(1)
+        max_ind = last.argmax(1)
+        values[:, -2] = last[np.arange(n_chan), min_ind]
+        values[:, -1] = last[np.arange(n_chan), max_ind]
+        indices[:, -2] = min_ind + last_samp_0
+        indices[:, -1] = max_ind + last_samp_0
+
+    return (values, indices)
+
+
+# Like min_max_chunks, but return the sample values at the given
+# percentiles within each chunk, and their sample numbers.  Each value
+# is the sample with rank round(p / 100 * (n - 1)) among the n samples
+# of its chunk, which is an actual raw sample value.
+#
+# This uses np.argpartition on the block viewed as
+# [n_chan, n_chunks, samp_per_chunk], which is a linear-time
+# selection, rather than a full sort of each chunk.
+def percentile_chunks(data, samp_0, samp_per_chunk=100, percentiles=(5, 95)):
+    n_chan, n_samp = data.shape
+    n_full = n_samp // samp_per_chunk
     n_chunks = int(np.ceil(n_samp / samp_per_chunk))
+    n_values = len(percentiles)
 
-    output_size = (n_chan, 2 * n_chunks)
-    values = np.zeros(output_size)
-    indices = np.zeros(output_size, dtype='int64')
-
-    for ii in range(n_chunks):
-        chunk_samp_0 = ii * samp_per_chunk + samp_0
-        chunk_n_samp = min(samp_per_chunk, n_file_samp - chunk_samp_0)
-        chunk_size = (n_chan, chunk_n_samp)
-        chunk_offset = chunk_samp_0 * 2 * n_chan
-        chunk_data = np.memmap(bin_file, dtype='int16', mode='r', shape=chunk_size, offset=chunk_offset, order='F')
-
-        # TODO: can probably simplify indexing here and below using [] notation!
-        min_inds = chunk_data.argmin(1, keepdims=True)
-        mins = np.take_along_axis(chunk_data, min_inds, 1)
-        min_samps = min_inds + chunk_samp_0
-
-        max_inds = chunk_data.argmax(1, keepdims=True)
-        maxes = np.take_along_axis(chunk_data, max_inds, 1)
-        max_samps = max_inds + chunk_samp_0
-
-        result_start = np.ones((n_chan, 1), dtype='int64') * (ii * 2)
-        result_end = result_start + 1
-        np.put_along_axis(values, result_start, mins, 1)
-        np.put_along_axis(values, result_end, maxes, 1)
-        np.put_along_axis(indices, result_start, min_samps, 1)
-        np.put_along_axis(indices, result_end, max_samps, 1)
+    values = np.zeros((n_chan, n_values * n_chunks))
+    indices = np.zeros((n_chan, n_values * n_chunks), dtype='int64')
+
+    def select(chunked, chunk_samp_0):
+        chunk_n_samp = chunked.shape[2]
+        ranks = sorted(set(int(round(p / 100 * (chunk_n_samp - 1))) for p in percentiles))
+        partitioned = np.argpartition(chunked, ranks, axis=2)
+        chunk_values = np.zeros(chunked.shape[:2] + (n_values,))
+        chunk_indices = np.zeros(chunked.shape[:2] + (n_values,), dtype='int64')
+        for (ii, p) in enumerate(percentiles):
+            rank = int(round(p / 100 * (chunk_n_samp - 1)))
+            inds = partitioned[:, :, rank]
+            chunk_values[:, :, ii] = np.take_along_axis(chunked, inds[..., None], 2)[..., 0]
+            chunk_indices[:, :, ii] = inds + chunk_samp_0[None, :]
+        return (chunk_values.reshape(n_chan, -1), chunk_indices.reshape(n_chan, -1))
+
+    if n_full:
+        chunked = np.asarray(data[:, :n_full * samp_per_chunk]).reshape(n_chan, n_full, samp_per_chunk)
+        chunk_starts = np.arange(n_full) * samp_per_chunk + samp_0
+        (full_values, full_indices) = select(chunked, chunk_starts)
+        values[:, :n_values * n_full] = full_values
+        indices[:, :n_values * n_full] = full_indices
+
+    if n_chunks > n_full:
+        # One partial chunk at the end.
+        last = np.asarray(data[:, n_full * samp_per_chunk:])[:, None, :]
+        last_samp_0 = np.array([samp_0 + n_full * samp_per_chunk])
+        (last_values, last_indices) = select(last, last_samp_0)
+        values[:, n_values * n_full:] = last_values
+        indices[:, n_values * n_full:] = last_indices
 
     return (values, indices)
-    
\ No newline at end of file
+
+
+# Write a .meta file to go with a new .bin file, based on the .meta of an
+# existing .bin file.  Keys and values in updates replace or add to the
+# original entries, and keys with value None are removed.  The original
+# order of entries and any leading '~' on tags are preserved.
+def write_meta_like(src_bin_file, out_bin_file, updates):
+    src_meta_file = Path(src_bin_file).with_suffix('.meta')
+    out_meta_file = Path(out_bin_file).with_suffix('.meta')
+    updates = dict(updates)
+
+    lines = []
+    with open(src_meta_file) as f:
+        for line in f.read().splitlines():
+            if '=' not in line:
+                continue
+            [tag, value] = line.split('=', maxsplit=1)
+            key = tag[1:] if tag.startswith('~') else tag
+            if key in updates:
+                value = updates.pop(key)
+                if value is None:
+                    continue
+            lines.append(f'{tag}={value}')
+
+    for key, value in updates.items():
+        if value is not None:
+            lines.append(f'{key}={value}')
+
+    with open(out_meta_file, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return out_meta_file
+
+
+# Format original channel IDs, as from OriginalChans, in the style of the
+# snsSaveChanSubset meta entry, for example "0:383,768".
+def format_chan_subset(chans):
+    ranges = []
+    for chan in chans:
+        chan = int(chan)
+        if ranges and chan == ranges[-1][1] + 1:
+            ranges[-1][1] = chan
+        else:
+            ranges.append([chan, chan])
+    return ','.join(f'{first}:{last}' if last > first else f'{first}' for (first, last) in ranges)
+
+
+# Keep only some entries of a meta map value like snsChanMap or snsShankMap,
+# which look like a header in parentheses followed by one parenthesized
+# entry per channel, for example "(384,384,1)(AP0;0:0)(AP1;1:1)...".
+def subset_meta_map(map_value, entry_indices):
+    entries = re.findall(r'\(([^)]*)\)', map_value)
+    header = entries[0]
+    channel_entries = entries[1:]
+    kept = [channel_entries[i] for i in entry_indices if i < len(channel_entries)]
+    return ''.join(f'({entry})' for entry in [header] + kept)
+
+
+# Return the multiplicative factors that datafile.GainCorrectNI or
+# datafile.GainCorrectIM would apply to each of the saved-channel indices in
+# chan_list, as an array with one element per channel.  This converts summary
+# values (like min, max, or RMS) to volts without building a full-size float
+# array.
+def chan_conv_factors(chan_list, meta):
+    f_i2v = datafile.Int2Volts(meta)
+    convs = np.ones(len(chan_list))
+    if meta['typeThis'] == 'imec':
+        chans = datafile.OriginalChans(meta)
+        (ap_gain, lf_gain) = datafile.ChanGainsIM(meta)
+        n_ap = len(ap_gain)
+        for (i, chan) in enumerate(chan_list):
+            k = chans[chan]  # acquisition index
+            if k < n_ap:
+                convs[i] = f_i2v / ap_gain[k]
+            elif k < 2 * n_ap:
+                convs[i] = f_i2v / lf_gain[k - n_ap]
+    else:
+        (n_mn, n_ma, _, _) = datafile.ChannelCountsNI(meta)
+        for (i, chan) in enumerate(chan_list):
+            convs[i] = f_i2v / datafile.ChanGainNI(chan, n_mn, n_ma, meta)
+    return convs
@@ -0,0 +1,167 @@
+# Decode every line of every digital word into a table of events, in one pass.
+#
+# ExtractDigital unpacks one word into a dense uint8 array per line, per
+# sample.  For behavioral digital lines we only want the transitions, for all
+# lines of all XD words from ChannelCountsNI (or the imec SY word).
+#
+# This reads just the digital word channels, block by block.  XOR between
+# each sample and the one before it (carrying the last sample over from the
+# previous block) gives the bits that changed.  Only samples with changes
+# are expanded into per-line events, so memory is proportional to the number
+# of transitions, not the number of samples.
+#
+# The result is a table of events with columns:
+#   - 'sample' -- file sample number where a line took its new state
+#   - 'word' -- zero-based digital word index, as dwReq for ExtractDigital
+#   - 'line' -- zero-based line (bit) within the word
+#   - 'new_state' -- 0 or 1
+# sorted by sample, then word, then line.
+#
+# Optionally, this also decodes a strobed value: on each rising edge of a
+# strobe line, read a number from a set of data lines, where the first data
+# line is the least significant bit.
+
+import numpy as np
+
+from . import datafile
+from .channel_major import read_channels
+from .pipeline import BlockConsumer
+
+# Read the digital word channels in pieces of this many samples.
+digital_samp_per_read = 4 * 1024 * 1024
+
+
+def digital_word_channels(meta):
+    """ Return saved-channel indices of the digital words in a file, NI XD words or the imec SY word."""
+    if meta['typeThis'] == 'imec':
+        (AP, LF, SY) = datafile.ChannelCountsIM(meta)
+        return list(range(AP + LF, AP + LF + SY))
+    (MN, MA, XA, DW) = datafile.ChannelCountsNI(meta)
+    return list(range(MN + MA + XA, MN + MA + XA + DW))
+
+
+class DigitalDecoder():
+    """ Turn consecutive blocks of digital words, [n_words, n_samp], into events.
+
+    The strobe keyword arg is an optional (word, line) for a strobe line.
+    The strobe_data keyword arg is (word, lines) for the data lines to read
+    on each rising edge of the strobe, by default all other lines of the
+    strobe's word.
+    """
+
+    def __init__(self, n_words, strobe=None, strobe_data=None):
+        self.n_words = n_words
+        self.previous = None
+        self.initial = None
+        self.events = []
+        self.strobe = strobe
+        if strobe is not None and strobe_data is None:
+            strobe_data = (strobe[0], [line for line in range(16) if line != strobe[1]])
+        self.strobe_data = strobe_data
+        self.strobe_samples = []
+        self.strobe_values = []
+
+    def process(self, block_samp_0, words):
+        words = np.asarray(words).view('uint16')
+        if not words.shape[1]:
+            return
+        if self.previous is None:
+            self.previous = words[:, 0].copy()
+            self.initial = words[:, 0].copy()
+
+        # Changed bits, sample-major: [n_samp, n_words].
+        changed = words.T.copy()
+        changed[0] ^= self.previous
+        changed[1:] ^= words.T[:-1]
+        (samp_index, word_index) = np.nonzero(changed)
+        if samp_index.size:
+            bits = (changed[samp_index, word_index][:, None] >> np.arange(16, dtype='uint16')) & 1
+            (event_index, line) = np.nonzero(bits)
+            samples = samp_index[event_index]
+            word = word_index[event_index]
+            new_state = (words[word, samples] >> line.astype('uint16')) & 1
+            self.events.append((samples + block_samp_0, word, line, new_state))
+
+            if self.strobe is not None:
+                (strobe_word, strobe_line) = self.strobe
+                rising = (word == strobe_word) & (line == strobe_line) & (new_state == 1)
+                strobe_samples = samples[rising]
+                (data_word, data_lines) = self.strobe_data
+                data = words[data_word, strobe_samples].astype('int64')
+                values = np.zeros(len(strobe_samples), dtype='int64')
+                for (bit, data_line) in enumerate(data_lines):
+                    values |= ((data >> data_line) & 1) << bit
+                self.strobe_samples.append(strobe_samples + block_samp_0)
+                self.strobe_values.append(values)
+
+        self.previous = words[:, -1].copy()
+
+    def result(self):
+        """ Return a dict with the event table columns, 'initial' word values, and strobe results if requested."""
+        if self.events:
+            (samples, word, line, new_state) = [np.concatenate(column) for column in zip(*self.events)]
+        else:
+            (samples, word, line, new_state) = [np.zeros(0, dtype='int64')] * 4
+        result = {
+            'sample': samples.astype('int64'),
+            'word': word.astype('int16'),
+            'line': line.astype('uint8'),
+            'new_state': new_state.astype('uint8'),
+            'initial': self.initial if self.initial is not None else np.zeros(self.n_words, dtype='uint16'),
+        }
+        if self.strobe is not None:
+            result['strobe_sample'] = np.concatenate(self.strobe_samples) if self.strobe_samples else np.zeros(0, dtype='int64')
+            result['strobe_value'] = np.concatenate(self.strobe_values) if self.strobe_values else np.zeros(0, dtype='int64')
+        return result
+
+
+def decode_digital_events(bin_file, meta, samp_0=0, n_samp=None, strobe=None, strobe_data=None):
+    """ Decode events for all lines of all digital words in a .bin file.
+
+    Only the digital word channels are read, with channel_major.read_channels,
+    which uses a channel-major copy of the file when one exists.
+
+    Returns a dict from DigitalDecoder.result(), plus 'time' in seconds from
+    the start of the file for each event, and 'channels' with the saved-channel
+    index of each word.
+    """
+    channels = digital_word_channels(meta)
+    decoder = DigitalDecoder(len(channels), strobe, strobe_data)
+    n_file_samp = int(int(meta['fileSizeBytes']) / (2 * int(meta['nSavedChans'])))
+    if n_samp is None:
+        n_samp = n_file_samp
+    samp_0 = max(int(samp_0), 0)
+    samp_end = min(samp_0 + int(n_samp), n_file_samp)
+
+    if channels:
+        for read_samp_0 in range(samp_0, samp_end, digital_samp_per_read):
+            words = read_channels(bin_file, meta, channels, read_samp_0, min(digital_samp_per_read, samp_end - read_samp_0))
+            decoder.process(read_samp_0, words)
+
+    result = decoder.result()
+    result['time'] = result['sample'] / datafile.SampRate(meta)
+    result['channels'] = channels
+    return result
+
+
+class DigitalEventsConsumer(BlockConsumer):
+    """ Decode digital events during a pipeline pass, like decode_digital_events."""
+
+    def __init__(self, strobe=None, strobe_data=None):
+        self.strobe = strobe
+        self.strobe_data = strobe_data
+
+    def start(self, meta, n_chan, samp_0, n_samp):
+        self.meta = meta
+        self.channels = digital_word_channels(meta)
+        self.decoder = DigitalDecoder(len(self.channels), self.strobe, self.strobe_data)
+
+    def consume(self, block_samp_0, block):
+        if self.channels:
+            self.decoder.process(block_samp_0, block[self.channels, :])
+
+    def finish(self):
+        result = self.decoder.result()
+        result['time'] = result['sample'] / datafile.SampRate(self.meta)
+        result['channels'] = self.channels
+        return result
@@ -0,0 +1,99 @@
+# Event-related averages (ERP, spike-triggered average) without keeping every snippet.
+#
+# Event times might come from CatGT -xa/-xd extraction, or from TPrime after
+# aligning to this stream, for example:
+#   event_times = read_floats(info['from_streams'][0][2])
+#
+# Snippets are read in time-ordered batches with snippets.iter_snippet_batches,
+# and each batch is added into running sum and sum-of-squares buffers for
+# its condition.  So memory stays proportional to
+# n_conditions * n_chan * window length, plus one batch.
+#
+# Windows that run off either end of the file only count the samples that
+# exist, so each sample offset has its own count of contributing events.
+
+import numpy as np
+
+from . import datafile
+from .snippets import iter_snippet_batches, window_offsets
+
+
+class EventAverager():
+    """ Running per-condition sums for event-related mean and SEM.
+
+    Call add() with batches of snippets shaped [n_batch, n_chan, n_samp]
+    (NaN where samples are missing) and their condition indices, then
+    result() to get mean and SEM.  Averagers over separate sets of events
+    can be combined with merge().
+    """
+
+    def __init__(self, n_conditions, n_chan, n_samp):
+        self.sum = np.zeros((n_conditions, n_chan, n_samp), dtype='float64')
+        self.sum_sq = np.zeros((n_conditions, n_chan, n_samp), dtype='float64')
+        self.count = np.zeros((n_conditions, n_samp), dtype='int64')
+
+    def add(self, snippets, condition_indices):
+        condition_indices = np.asarray(condition_indices)
+        for condition in np.unique(condition_indices):
+            selected = snippets[condition_indices == condition].astype('float64')
+            present = ~np.isnan(selected)
+            selected[~present] = 0
+            self.sum[condition] += selected.sum(axis=0)
+            self.sum_sq[condition] += np.einsum('ecs,ecs->cs', selected, selected)
+            # Missing samples are missing on all channels at once.
+            self.count[condition] += present[:, 0, :].sum(axis=0)
+
+    def merge(self, other):
+        self.sum += other.sum
+        self.sum_sq += other.sum_sq
+        self.count += other.count
+        return self
+
+    def result(self):
+        """ Return (mean, sem, count), with mean and sem shaped [n_conditions, n_chan, n_samp]."""
+        count = self.count[:, None, :].astype('float64')
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self.sum / count
+            variance = (self.sum_sq - self.sum * mean) / (count - 1)
+            sem = np.sqrt(np.maximum(variance, 0) / count)
+        return (mean, sem, self.count)
+
+
+def event_related_average(bin_file, meta, event_times, conditions=None, chan_list=None, window=(-0.5, 0.5), batch_size=None):
+    """ Compute per-condition event-related mean and SEM, in volts, in one time-ordered pass.
+
+    The event_times positional arg is in seconds from the start of bin_file.
+
+    The conditions keyword arg gives a condition label for each event.
+    By default all events share one condition.
+
+    The chan_list keyword arg selects saved-channel indices, default all.
+    The window keyword arg is (t_before, t_after) in seconds relative to each event.
+
+    Returns a dict with:
+    - 'conditions' -- the unique condition labels, in sorted order
+    - 'times' -- window sample times in seconds relative to the event
+    - 'mean' and 'sem' -- arrays [n_conditions, n_chan, n_samp] in volts
+    - 'count' -- number of events contributing to each condition and sample
+    """
+    event_times = np.asarray(event_times, dtype='float64')
+    if conditions is None:
+        conditions = np.zeros(len(event_times), dtype='int64')
+    (labels, condition_indices) = np.unique(np.asarray(conditions), return_inverse=True)
+
+    n_chan = int(meta['nSavedChans']) if chan_list is None else len(chan_list)
+    offsets = window_offsets(meta, window)
+    averager = EventAverager(len(labels), n_chan, len(offsets))
+
+    batches = iter_snippet_batches(bin_file, meta, event_times, chan_list, window, batch_size, pad_value=np.nan, volts=True)
+    for (event_indices, snippets) in batches:
+        averager.add(snippets, condition_indices[event_indices])
+
+    (mean, sem, count) = averager.result()
+    return {
+        'conditions': labels,
+        'times': offsets / datafile.SampRate(meta),
+        'mean': mean,
+        'sem': sem,
+        'count': count,
+    }
@@ -0,0 +1,229 @@
+# Export a preprocessed binary file ready for spike sorting, in one pass.
+#
+# Our sorting prep used to be CatGT (filter + CAR), then another script to
+# drop the sync channel and re-save.  That's two full writes of every probe.
+# This does the channel selection, optional band-pass filter, optional common
+# average reference (CAR), and output type conversion in one streaming stage.
+#
+# The work is split three ways, with bounded queues in between:
+#   - a reader thread reads blocks from the .bin, in order
+#   - a pool of compute workers filter and re-reference blocks independently
+#   - the calling thread writes finished blocks in order
+#
+# With backend='process', blocks are instead read in order into shared
+# memory, and each block is split by sample range among worker processes
+# from backends.py, which write into a shared output block.
+#
+# Blocks are read with a small margin of extra samples on each side, so each
+# block can be filtered on its own and the results still match filtering
+# the whole recording at once.  Blocks, and the pieces of each block given
+# to worker processes, start on multiples of the filter's FFT frame from
+# filters.fir_frame_size.  So every output sample comes from the same FFT
+# either way, and both backends write identical bytes.
+#
+# Alongside the binary, this writes a channel map JSON file with chanMap, xc,
+# yc, kcoords, and n_chan, derived from snsShankMap (or snsGeomMap).  This is
+# the probe format that Kilosort reads.  chanMap gives the 0-based rows of
+# the exported file, and the other lists are in the same order.
+
+import json
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+
+from . import datafile
+from . import blocks
+from . import backends
+from . import geometry
+from .filters import fir_taps, fir_frame_size, fir_valid, common_average_reference
+
+
+def read_with_margin(raw_data, chan_list, samp_0, samp_end, margin, out=None):
+    """ Read samples [samp_0 - margin, samp_end + margin) of chan_list, zero-padded past the file edges.
+
+    The out keyword arg can be an int16 array to fill, instead of allocating a new one.
+    """
+    n_file_samp = raw_data.shape[1]
+    if out is None:
+        data = np.zeros((len(chan_list), samp_end - samp_0 + 2 * margin), dtype='int16')
+    else:
+        data = out
+        data[:] = 0
+    read_0 = max(samp_0 - margin, 0)
+    read_end = min(samp_end + margin, n_file_samp)
+    data[:, read_0 - (samp_0 - margin):read_end - (samp_0 - margin)] = raw_data[chan_list, read_0:read_end]
+    return data
+
+
+def write_channel_map(meta, chan_list, map_file):
+    """ Write a Kilosort-style probe JSON for the exported channels.
+
+    Each site is listed by its 0-based row in the exported file, in chanMap,
+    with its coordinates at the same index in xc, yc, and kcoords.
+    """
+    geometry_info = geometry.probe_geometry(meta)
+    n_neural = len(geometry_info['x'])
+    rows = [row for (row, chan) in enumerate(chan_list) if chan < n_neural]
+    neural = [chan_list[row] for row in rows]
+    probe = {
+        'chanMap': rows,
+        'chanMap0ind': rows,
+        'xc': geometry_info['x'][neural].tolist(),
+        'yc': geometry_info['y'][neural].tolist(),
+        'kcoords': geometry_info['shank'][neural].tolist(),
+        'connected': geometry_info['connected'][neural].tolist(),
+        'n_chan': len(chan_list),
+    }
+    with open(map_file, 'w') as f:
+        json.dump(probe, f)
+    return map_file
+
+
+def preprocess(data, taps, car, out_dtype):
+    """ Filter, re-reference, and convert one block read with read_with_margin, returning [n_samp, n_chan] in file order."""
+    if taps is not None:
+        processed = fir_valid(data, taps)
+    else:
+        processed = data.astype('float32')
+    if car:
+        processed = common_average_reference(processed, use_median=(car == 'median'))
+    if out_dtype == np.dtype('int16'):
+        processed = np.clip(np.round(processed), -32768, 32767)
+    # Write in file order, samples interleaved by channel.
+    return np.ascontiguousarray(processed.T, dtype=out_dtype)
+
+
+def _preprocess_task(arrays, start, end, taps, margin, car, out_dtype):
+    data = arrays['data'][:, start:end + 2 * margin]
+    arrays['out'][start:end, :] = preprocess(data, taps, car, np.dtype(out_dtype))
+
+
+def export_binary(bin_file, out_file, chan_list=None, band=None, car=None, dtype='int16',
+                  samp_per_block=None, n_workers=4, max_pending=None, backend='thread'):
+    """ Write a preprocessed copy of an imec .bin file for spike sorting, plus a channel map.
+
+    The chan_list keyword arg selects saved-channel indices, by default all
+    AP and LF channels, excluding SY, from ChannelCountsIM.
+
+    The band keyword arg is an optional (low, high) band-pass in Hz.
+    Either value may be None for a high-pass or low-pass.
+
+    The car keyword arg is None by default.  It can be 'median' or 'mean'
+    to subtract the across-channel median or mean from each sample.
+
+    The dtype keyword arg is the output sample type.  'int16' values are
+    rounded and clipped.  Other types, like 'float32', are written as-is.
+    Values stay in raw ADC units either way.
+
+    The backend keyword arg is 'thread' by default, or 'process' to
+    compute on worker processes with blocks in shared memory.
+
+    Returns a dict with the output paths and a few stats.
+    """
+    bin_path = Path(bin_file)
+    out_path = Path(out_file)
+    meta = datafile.readMeta(bin_path)
+    if chan_list is None:
+        (AP, LF, _) = datafile.ChannelCountsIM(meta)
+        chan_list = range(AP + LF)
+    chan_list = np.asarray(chan_list, dtype='int64')
+    out_dtype = np.dtype(dtype)
+
+    if band is not None:
+        taps = fir_taps(datafile.SampRate(meta), band[0], band[1])
+        margin = (len(taps) - 1) // 2
+        (_, frame_samp) = fir_frame_size(taps)
+    else:
+        taps = None
+        margin = 0
+        frame_samp = 1
+
+    (_, n_file_samp) = blocks.file_shape(meta)
+    if not max_pending:
+        max_pending = 2 * max(n_workers, 1)
+    if not samp_per_block:
+        # Pending blocks, each with a float32 FFT workspace about 8 times the raw size.
+        samp_per_block = blocks.samp_per_block_for(meta, n_blocks=max_pending + n_workers, work_bytes=32)
+    # Start blocks on filter frames, as for fir_valid.
+    samp_per_block = max(frame_samp, (samp_per_block // frame_samp) * frame_samp)
+    raw_data = blocks.memmap_bin(bin_path, meta)
+
+    def compute(data):
+        return preprocess(data, taps, car, out_dtype)
+
+    pending = queue.Queue(maxsize=max_pending)
+    reader_error = []
+    stop = threading.Event()
+
+    def put_pending(item):
+        # Give up if the writer has stopped, instead of waiting forever for room in the queue.
+        while not stop.is_set():
+            try:
+                pending.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read_blocks(executor):
+        try:
+            for block_samp_0 in range(0, n_file_samp, samp_per_block):
+                block_samp_end = min(block_samp_0 + samp_per_block, n_file_samp)
+                data = read_with_margin(raw_data, chan_list, block_samp_0, block_samp_end, margin)
+                if not put_pending(executor.submit(compute, data)):
+                    return
+        except Exception as e:
+            reader_error.append(e)
+        finally:
+            put_pending(None)
+
+    print(f'Exporting {len(chan_list)} channels of {bin_path.name} to {out_path.name} (band {band}, CAR {car}, {out_dtype})')
+    start = time.perf_counter()
+    n_bytes = 0
+    if backend != 'thread':
+        runner = backends.get_backend(backend, n_workers)
+        with open(out_path, 'wb') as f:
+            for block_samp_0 in range(0, n_file_samp, samp_per_block):
+                block_samp_end = min(block_samp_0 + samp_per_block, n_file_samp)
+                n_samp = block_samp_end - block_samp_0
+                arrays = {
+                    'data': runner.array('data', (len(chan_list), n_samp + 2 * margin), 'int16'),
+                    'out': runner.array('out', (n_samp, len(chan_list)), out_dtype),
+                }
+                read_with_margin(raw_data, chan_list, block_samp_0, block_samp_end, margin, out=arrays['data'])
+                tasks = [(start, end, taps, margin, car, out_dtype.str) for (start, end) in backends.split_range(n_samp, runner.n_workers, frame_samp)]
+                runner.run(_preprocess_task, tasks, arrays)
+                f.write(memoryview(arrays['out']).cast('B'))
+                n_bytes += arrays['out'].nbytes
+    else:
+        with open(out_path, 'wb') as f, ThreadPoolExecutor(max_workers=max(n_workers, 1)) as executor:
+            reader = threading.Thread(target=read_blocks, args=(executor,), daemon=True)
+            reader.start()
+            try:
+                while True:
+                    future = pending.get()
+                    if future is None:
+                        break
+                    out_block = future.result()
+                    f.write(out_block.tobytes())
+                    n_bytes += out_block.nbytes
+            finally:
+                stop.set()
+                reader.join()
+        if reader_error:
+            raise reader_error[0]
+
+    map_file = write_channel_map(meta, chan_list, out_path.with_suffix('.chanmap.json'))
+    seconds = time.perf_counter() - start
+    print(f'Wrote {n_bytes / 1e6:.1f} MB in {seconds:.2f}s ({n_bytes / 1e6 / max(seconds, 1e-9):.1f} MB/s)')
+    return {
+        'out_file': str(out_path),
+        'map_file': str(map_file),
+        'n_chan': len(chan_list),
+        'n_samp': n_file_samp,
+        'dtype': str(out_dtype),
+        'seconds': seconds,
+    }
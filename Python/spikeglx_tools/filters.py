@@ -0,0 +1,221 @@
+# Streaming FIR filters for blocks of SpikeGLX data, using only numpy.
+#
+# Filters are linear-phase windowed-sinc FIRs.  They're applied with FFT
+# convolution to all channels of a block at once.  A StreamingFir keeps the
+# last few input samples of each block, so that filtering block by block
+# gives the same result as filtering the whole recording at once.
+#
+# A linear-phase FIR delays its output by (n_taps - 1) / 2 samples.
+# StreamingFir compensates for this, so output samples line up with input
+# samples: the first block comes out a little short, and flush() returns the
+# remaining samples at the end.
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def fir_taps(sample_rate, low_hz=None, high_hz=None, n_taps=None):
+    """ Design a windowed-sinc FIR filter.
+
+    Give low_hz for a high-pass, high_hz for a low-pass, or both for a band-pass.
+
+    The n_taps keyword arg is chosen from the narrowest transition band if
+    omitted, with transition bands about half the corner frequency wide
+    (capped at 1kHz).  n_taps is always odd, for a whole-sample delay.
+    """
+    if not n_taps:
+        corners = [f for f in (low_hz, high_hz) if f]
+        transition_hz = min(min(corners) / 2, 1000.0)
+        n_taps = int(np.ceil(3.3 * sample_rate / transition_hz))
+    n_taps = n_taps | 1
+
+    nyquist = sample_rate / 2
+    t = np.arange(n_taps) - (n_taps - 1) / 2
+
+    def low_pass(cutoff_hz):
+        cutoff = cutoff_hz / nyquist
+        return cutoff * np.sinc(cutoff * t)
+
+    if high_hz and high_hz < nyquist:
+        taps = low_pass(high_hz)
+    else:
+        taps = np.zeros(n_taps)
+        taps[(n_taps - 1) // 2] = 1.0
+    if low_hz:
+        taps = taps - low_pass(low_hz)
+
+    taps = taps * np.hamming(n_taps)
+    if high_hz and not low_hz:
+        # Unity gain at DC for a low-pass.
+        taps = taps / taps.sum()
+    return taps
+
+
+class StreamingFir():
+    """ Apply FIR taps to consecutive blocks [n_chan, n_samp] along the time axis.
+
+    Output is float32 and aligned with the input: process() returns
+    outputs for the input samples seen so far, except for the last
+    delay samples, which come out with the next block or from flush().
+    """
+
+    def __init__(self, taps, n_chan):
+        self.taps = np.asarray(taps, dtype='float64')
+        self.n_taps = len(self.taps)
+        self.delay = (self.n_taps - 1) // 2
+        self.history = np.zeros((n_chan, self.n_taps - 1), dtype='float32')
+        self.to_skip = self.delay
+
+    def convolve(self, block):
+        n_samp = block.shape[1]
+        extended = np.concatenate([self.history, np.asarray(block, dtype='float32')], axis=1)
+        n_fft = 1 << int(np.ceil(np.log2(extended.shape[1])))
+        spectrum = np.fft.rfft(extended, n_fft, axis=1) * np.fft.rfft(self.taps, n_fft)[None, :]
+        filtered = np.fft.irfft(spectrum, n_fft, axis=1)[:, self.n_taps - 1:self.n_taps - 1 + n_samp]
+        self.history = extended[:, extended.shape[1] - (self.n_taps - 1):].copy()
+        return filtered.astype('float32')
+
+    def process(self, block):
+        """ Filter the next block and return aligned float32 output, possibly shorter than block."""
+        filtered = self.convolve(block)
+        if self.to_skip:
+            skip = min(self.to_skip, filtered.shape[1])
+            self.to_skip -= skip
+            filtered = filtered[:, skip:]
+        return filtered
+
+    def flush(self):
+        """ Return the remaining aligned output at the end of the data."""
+        # Feeding delay zeros pushes out the last delay outputs,
+        # minus any that still belong to the initial delay.
+        padding = np.zeros((self.history.shape[0], self.delay), dtype='float32')
+        filtered = self.convolve(padding)[:, self.to_skip:]
+        self.to_skip = 0
+        return filtered
+
+
+class StreamingDecimator():
+    """ Low-pass filter consecutive blocks [n_chan, n_samp] and keep every factor-th sample.
+
+    Output sample n lines up with input sample phase + n * factor, counting
+    from the first input sample, like decimating the output of a StreamingFir.
+    This is a polyphase filter: the input is split into factor phases at
+    the output rate, and each tap adds a slice of one phase.  So only the
+    kept output samples are computed, at n_taps / factor multiply-adds per
+    input sample, instead of filtering every input sample and discarding
+    most of them.
+    """
+
+    def __init__(self, taps, n_chan, factor, phase=0):
+        self.taps = np.asarray(taps, dtype='float32')
+        self.factor = int(factor)
+        self.delay = (len(self.taps) - 1) // 2
+        # Input samples still needed, starting with delay zeros before the first sample.
+        self.pending = np.zeros((n_chan, self.delay), dtype='float32')
+        # Position in pending of the input sample for the next output sample.
+        self.next_center = self.delay + int(phase)
+
+    def decimate(self, final):
+        pending = self.pending
+        n_pending = pending.shape[1]
+        if final:
+            # Zeros after the last sample, as for StreamingFir.flush().
+            pending = np.concatenate([pending, np.zeros((pending.shape[0], self.delay), dtype='float32')], axis=1)
+
+        # Each output needs delay input samples after its center.
+        last_center = pending.shape[1] - 1 - self.delay
+        n_out = max(0, (last_center - self.next_center) // self.factor + 1)
+        out = np.zeros((pending.shape[0], n_out), dtype='float32')
+        if n_out:
+            # Split the input into factor phases, each contiguous at the output rate.
+            phases = [np.ascontiguousarray(pending[:, phase::self.factor]) for phase in range(self.factor)]
+            scratch = np.empty_like(out)
+            for (k, tap) in enumerate(self.taps):
+                (first, phase) = divmod(self.next_center + self.delay - k, self.factor)
+                np.multiply(phases[phase][:, first:first + n_out], tap, out=scratch)
+                out += scratch
+
+        # Keep what the next output needs, from delay samples before its center.
+        next_center = self.next_center + n_out * self.factor
+        keep_from = min(next_center - self.delay, n_pending)
+        self.pending = self.pending[:, keep_from:].copy()
+        self.next_center = next_center - keep_from
+        return out
+
+    def process(self, block):
+        """ Add the next block and return float32 output samples that are ready, possibly none."""
+        self.pending = np.concatenate([self.pending, np.asarray(block, dtype='float32')], axis=1)
+        return self.decimate(final=False)
+
+    def flush(self):
+        """ Return the remaining output samples at the end of the data."""
+        return self.decimate(final=True)
+
+
+def fir_frame_size(taps):
+    """ Return (n_fft, frame_samp) for fir_valid: its FFT size, and the output samples from each FFT."""
+    n_taps = len(taps)
+    n_fft = 1 << int(np.ceil(np.log2(8 * n_taps)))
+    return (n_fft, n_fft - (n_taps - 1))
+
+
+def fir_valid(data, taps):
+    """ Filter a block [n_chan, n_samp] that includes (n_taps - 1) / 2 extra samples at each end.
+
+    Returns aligned float32 output for the samples between the extra ones,
+    with n_taps - 1 fewer samples than data.  This lets separate blocks be
+    filtered independently, for example on different threads.
+
+    Output is computed in frames of frame_samp samples from fir_frame_size,
+    each with one fixed-size FFT.  So blocks that start on a multiple of
+    frame_samp, counting from the same sample, give exactly the same output
+    values however the data is split up, except that a block that ends
+    partway through a frame must be the last one.
+    """
+    n_taps = len(taps)
+    (n_chan, n_data) = data.shape
+    n_out = max(n_data - (n_taps - 1), 0)
+    (n_fft, frame_samp) = fir_frame_size(taps)
+    n_frames = max(1, int(np.ceil(n_out / frame_samp)))
+
+    # Zero-pad the last frame, then view overlapping frames of n_fft input samples.
+    padded = np.zeros((n_chan, n_frames * frame_samp + n_taps - 1), dtype='float32')
+    padded[:, :n_data] = data
+    frames = sliding_window_view(padded, n_fft, axis=1)[:, ::frame_samp, :]
+    spectrum = np.fft.rfft(frames, axis=2) * np.fft.rfft(taps, n_fft)[None, None, :]
+    filtered = np.fft.irfft(spectrum, n_fft, axis=2)[:, :, n_taps - 1:]
+    return filtered.reshape((n_chan, n_frames * frame_samp))[:, :n_out].astype('float32')
+
+
+def iter_filtered_blocks(block_iter, taps, chan_list=None):
+    """ Filter blocks from blocks.iter_blocks() and yield aligned (samp_0, filtered) pairs.
+
+    The chan_list keyword arg selects saved-channel indices to filter, default all.
+    The filtered blocks are float32 in raw units, with dimensions [n_chan, n_samp].
+    """
+    fir = None
+    out_samp_0 = None
+    for (block_samp_0, block) in block_iter:
+        if chan_list is not None:
+            block = block[chan_list, :]
+        if fir is None:
+            fir = StreamingFir(taps, block.shape[0])
+            out_samp_0 = block_samp_0
+        filtered = fir.process(block)
+        if filtered.shape[1]:
+            yield (out_samp_0, filtered)
+            out_samp_0 += filtered.shape[1]
+
+    if fir is not None:
+        filtered = fir.flush()
+        if filtered.shape[1]:
+            yield (out_samp_0, filtered)
+
+
+def common_average_reference(block, use_median=True):
+    """ Subtract the across-channel median (or mean) from each sample of a float block."""
+    if use_median:
+        reference = np.median(block, axis=0, keepdims=True)
+    else:
+        reference = block.mean(axis=0, keepdims=True)
+    return block - reference
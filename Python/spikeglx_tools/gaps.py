@@ -0,0 +1,108 @@
+# Find gaps and overlaps between the trigger files of a run, using only .meta files.
+#
+# CatGT concatenation (-t=0:7, -supercat) deals with gaps between trigger
+# files, but we'd rather know about missing samples before a long CatGT run.
+# Each file's firstSample says where it starts in its stream's sample clock,
+# and fileSizeBytes / nSavedChans says how many samples it has.  Comparing
+# consecutive files in each stream gives the gaps (positive) and overlaps
+# (negative) between them.
+#
+# The resulting plan gives the sample offset of each file in a concatenated
+# output, and can be written in the style of CatGT's _ct_offsets.txt file,
+# with lines like "smp_imec0.ap: 0 9269958 ..." and "sec_imec0.ap: 0 308.998610 ...".
+
+from pathlib import Path
+import numpy as np
+
+from .catalog import catalog_run
+
+
+def plan_stream(entries, fill_gaps=True):
+    """ Plan the concatenation of one stream's catalog entries, in gate and trigger order.
+
+    With fill_gaps True, each file lands at its firstSample relative to the
+    first file, so gaps will be zero-filled, and overlapping samples are
+    trimmed from the start of the later file.  With fill_gaps False, files
+    are butted together, ignoring gaps and overlaps.
+
+    Returns a list of dicts, one per file, with the catalog entry values plus:
+    - 'gap_before' -- samples missing (positive) or overlapping (negative) before this file
+    - 'trim' -- samples to skip at the start of this file
+    - 'out_offset' -- sample number in the concatenated output where this file's kept samples start
+    """
+    plan = []
+    expected_next = None
+    out_end = 0
+    for entry in entries:
+        step = dict(entry)
+        if expected_next is None:
+            gap = 0
+            run_first = entry['first_sample']
+        else:
+            gap = entry['first_sample'] - expected_next
+
+        if fill_gaps:
+            trim = min(max(-gap, 0), entry['n_samp'])
+            out_offset = entry['first_sample'] - run_first + trim
+        else:
+            trim = 0
+            out_offset = out_end
+
+        step['gap_before'] = gap
+        step['trim'] = trim
+        step['out_offset'] = out_offset
+        plan.append(step)
+
+        expected_next = entry['first_sample'] + entry['n_samp']
+        out_end = max(out_end, out_offset + entry['n_samp'] - trim)
+    return plan
+
+
+def plan_run(data_path, run_name, streams=None, fill_gaps=True):
+    """ Plan concatenation for every stream in a run, from .meta files only.
+
+    Returns a dict of plans from plan_stream, keyed by stream name like 'nidq' or 'imec0.ap'.
+    """
+    catalog = catalog_run(data_path, run_name)
+    by_stream = {}
+    for entry in catalog:
+        if streams is None or entry['stream'] in streams:
+            by_stream.setdefault(entry['stream'], []).append(entry)
+    return {stream: plan_stream(entries, fill_gaps) for (stream, entries) in by_stream.items()}
+
+
+def print_plan(plans):
+    """ Print a summary of gaps and overlaps for each stream."""
+    for (stream, plan) in plans.items():
+        sample_rate = plan[0]['sample_rate']
+        gaps = np.array([step['gap_before'] for step in plan[1:]], dtype='int64')
+        total_samp = plan[-1]['out_offset'] + plan[-1]['n_samp'] - plan[-1]['trim']
+        print(f'\n{stream}: {len(plan)} files, {total_samp} samples ({total_samp / sample_rate:.3f}s) concatenated')
+        for step in plan:
+            gap = step['gap_before']
+            if gap > 0:
+                note = f'GAP of {gap} samples ({gap / sample_rate:.6f}s)'
+            elif gap < 0:
+                note = f'OVERLAP of {-gap} samples ({-gap / sample_rate:.6f}s)'
+            else:
+                note = 'contiguous'
+            print(f'  g{step["g"]} t{step["t"]}: first sample {step["first_sample"]}, {step["n_samp"]} samples, at {step["out_offset"]}: {note}')
+        if gaps.size:
+            print(f'  {np.count_nonzero(gaps > 0)} gaps totaling {gaps[gaps > 0].sum()} samples, {np.count_nonzero(gaps < 0)} overlaps totaling {-gaps[gaps < 0].sum()} samples')
+
+
+def write_offsets_file(plans, offsets_file):
+    """ Write concatenation offsets in the style of CatGT's _ct_offsets.txt.
+
+    For each stream there's a line of sample offsets and a line of offsets in
+    seconds, one per input file.  These can be read back with
+    cli_wrappers.read_key_value_pairs(offsets_file, ':').
+    """
+    with open(offsets_file, 'w') as f:
+        for (stream, plan) in plans.items():
+            sample_rate = plan[0]['sample_rate']
+            samples = '\t'.join(str(step['out_offset']) for step in plan)
+            seconds = '\t'.join(f'{step["out_offset"] / sample_rate:.6f}' for step in plan)
+            f.write(f'sec_{stream}:\t{seconds}\n')
+            f.write(f'smp_{stream}:\t{samples}\n')
+    return Path(offsets_file)
@@ -0,0 +1,63 @@
+# Probe geometry and channel maps from imec .meta entries.
+#
+# The ~snsShankMap entry gives the (shank, column, row, used) of each saved
+# neural channel, for example "(1,2,480)(0:0:0:1)(0:1:0:1)(0:0:1:1)...".
+# Newer SpikeGLX versions also write ~snsGeomMap, with (shank, x, z, used)
+# in microns.  When there's no snsGeomMap, column and row indices are
+# converted to microns using NP 1.0 pitches, ignoring stagger.
+
+import re
+import numpy as np
+
+# Approximate NP 1.0 site pitch, for snsShankMap column and row indices.
+default_col_pitch_um = 32.0
+default_row_pitch_um = 20.0
+
+
+def map_entries(map_value):
+    """ Split a meta map value into its header and per-channel entries, without parentheses."""
+    entries = re.findall(r'\(([^)]*)\)', map_value)
+    return (entries[0], entries[1:])
+
+
+def probe_geometry(meta):
+    """ Return a dict of per-neural-channel arrays 'shank', 'x', 'y', and 'connected'.
+
+    Arrays have one element per saved neural (AP or LF) channel, in saved order.
+    x and y are in microns.
+    """
+    if 'snsGeomMap' in meta:
+        (header, entries) = map_entries(meta['snsGeomMap'])
+        header_parts = header.split(',')
+        shank_sep = float(header_parts[2]) if len(header_parts) > 2 else 0.0
+        parts = np.array([[float(v) for v in entry.split(':')] for entry in entries]).reshape(-1, 4)
+        shank = parts[:, 0].astype('int64')
+        x = parts[:, 1] + shank * shank_sep
+        y = parts[:, 2]
+        connected = parts[:, 3] > 0
+    else:
+        (_, entries) = map_entries(meta['snsShankMap'])
+        parts = np.array([[int(v) for v in entry.split(':')] for entry in entries]).reshape(-1, 4)
+        shank = parts[:, 0]
+        x = parts[:, 1] * default_col_pitch_um
+        y = parts[:, 2] * default_row_pitch_um
+        connected = parts[:, 3] > 0
+    return {'shank': shank, 'x': x, 'y': y, 'connected': connected}
+
+
+def channel_neighbors(meta, chan_list, n_neighbors):
+    """ For each channel in chan_list, return indices into chan_list of its n_neighbors nearest sites.
+
+    Each channel is its own first neighbor.  Distances use probe_geometry,
+    and sites on different shanks are treated as far apart.
+    """
+    geometry = probe_geometry(meta)
+    chan_list = np.asarray(chan_list, dtype='int64')
+    x = geometry['x'][chan_list]
+    y = geometry['y'][chan_list]
+    shank = geometry['shank'][chan_list]
+    distance = np.hypot(x[:, None] - x[None, :], y[:, None] - y[None, :])
+    distance[shank[:, None] != shank[None, :]] = np.inf
+    np.fill_diagonal(distance, -1)
+    n_neighbors = min(n_neighbors, len(chan_list))
+    return np.argsort(distance, axis=1, kind='stable')[:, :n_neighbors]
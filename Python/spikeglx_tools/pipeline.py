@@ -0,0 +1,267 @@
+# Read a SpikeGLX .bin file once and feed each block to many consumers.
+#
+# Decimation, sync extraction, QC stats, and integrity checks each want a
+# full pass over the same big file.  Rather than read the file N times, a
+# pipeline reads it once, in large blocks, and hands each block to all of
+# the registered consumers.
+#
+# Each block is read into memory once, with one big read into a buffer
+# from a small pool, as in blocks.BufferedBlockReader.  Consumers all receive
+# the same read-only view of that buffer with dimensions [n_chan, n_samp],
+# like slices of the makeMemMapRaw array, so there's no copying at all.
+#
+# By default each consumer runs on its own worker thread with a queue of
+# pending blocks.  A buffer goes back to the pool once every consumer is
+# done with it, and the reader waits for a free buffer, which bounds memory
+# use to a few blocks, regardless of file size.
+
+import abc
+import queue
+import threading
+import numpy as np
+
+from . import blocks
+from . import datafile_ben
+from .qc_stats import ChannelStats, adc_rails
+
+
+class BlockConsumer(abc.ABC):
+    """ Base class for things that consume blocks from a pipeline.
+
+    Subclasses override consume() and finish(), and optionally start().
+    Each consumer receives every block exactly once, in file order.
+    Blocks are only valid during consume(), so copy anything to keep.
+
+    The block_multiple attribute asks the pipeline to make all blocks
+    except the last one a multiple of this many samples.
+    """
+
+    block_multiple = 1
+
+    def start(self, meta, n_chan, samp_0, n_samp):
+        """ Called once before any blocks, with the extent of the pass."""
+        pass
+
+    @abc.abstractmethod
+    def consume(self, block_samp_0, block):
+        """ Called once per block, in order.  The block is read-only."""
+
+    def finish(self):
+        """ Called once after the last block.  The return value is the consumer's result."""
+        return None
+
+
+class MinMaxConsumer(BlockConsumer):
+    """ Collect chunked mins and maxes, like read_bin_ben."""
+
+    def __init__(self, samp_per_chunk=100):
+        self.samp_per_chunk = samp_per_chunk
+        self.block_multiple = samp_per_chunk
+        self.values = []
+        self.indices = []
+
+    def consume(self, block_samp_0, block):
+        (values, indices) = datafile_ben.min_max_chunks(block, block_samp_0, self.samp_per_chunk)
+        self.values.append(values)
+        self.indices.append(indices)
+
+    def finish(self):
+        if not self.values:
+            return (np.zeros((0, 0)), np.zeros((0, 0), dtype='int64'))
+        return (np.concatenate(self.values, axis=1), np.concatenate(self.indices, axis=1))
+
+
+class StatsConsumer(BlockConsumer):
+    """ Accumulate QC ChannelStats and return their summary in volts."""
+
+    def __init__(self, flat_secs=1.0):
+        self.flat_secs = flat_secs
+
+    def start(self, meta, n_chan, samp_0, n_samp):
+        self.meta = meta
+        self.rails = adc_rails(meta)
+        self.stats = ChannelStats(n_chan)
+
+    def consume(self, block_samp_0, block):
+        self.stats = self.stats.merge(ChannelStats.from_block(block, self.rails))
+
+    def finish(self):
+        return self.stats.summary(self.meta, flat_secs=self.flat_secs)
+
+
+class DigitalEdgesConsumer(BlockConsumer):
+    """ Find rising and falling edges of one digital line, like ExtractDigital.
+
+    Returns a dict with arrays of file sample numbers for 'rising' and
+    'falling' edges, and the digital channel index 'channel'.  If the file
+    has no digital word dw_req, the channel is None and there are no edges.
+    """
+
+    def __init__(self, dw_req, d_line):
+        self.dw_req = dw_req
+        self.d_line = d_line
+        self.rising = []
+        self.falling = []
+        self.previous = None
+        self.channel = None
+
+    def start(self, meta, n_chan, samp_0, n_samp):
+        # Imported here since digital_events builds on this module.
+        from .digital_events import digital_word_channels
+
+        channels = digital_word_channels(meta)
+        self.channel = channels[self.dw_req] if self.dw_req < len(channels) else None
+
+    def consume(self, block_samp_0, block):
+        if self.channel is None:
+            return
+
+        line = ((block[self.channel].view('uint16') >> self.d_line) & 1).astype('int8')
+        if self.previous is None:
+            self.previous = line[0]
+        steps = np.diff(line, prepend=self.previous)
+        self.rising.append(np.flatnonzero(steps > 0) + block_samp_0)
+        self.falling.append(np.flatnonzero(steps < 0) + block_samp_0)
+        self.previous = line[-1]
+
+    def finish(self):
+        return {
+            'channel': self.channel,
+            'rising': np.concatenate(self.rising) if self.rising else np.zeros(0, dtype='int64'),
+            'falling': np.concatenate(self.falling) if self.falling else np.zeros(0, dtype='int64'),
+        }
+
+
+class CallbackConsumer(BlockConsumer):
+    """ Call func(block_samp_0, block) for each block and collect the return values in a list."""
+
+    def __init__(self, func):
+        self.func = func
+        self.results = []
+
+    def consume(self, block_samp_0, block):
+        self.results.append(self.func(block_samp_0, block))
+
+    def finish(self):
+        return self.results
+
+
+class _SharedBuffer():
+    """ A pool buffer in use by several consumers, freed when the last one is done with it."""
+
+    def __init__(self, buffer, n_users, free):
+        self.buffer = buffer
+        self.n_users = n_users
+        self.free = free
+        self.lock = threading.Lock()
+
+    def done(self):
+        with self.lock:
+            self.n_users -= 1
+            if self.n_users == 0:
+                self.free.put(self.buffer)
+
+
+class _ConsumerWorker():
+    """ Feed one consumer from a queue on its own thread."""
+
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self.pending = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            (block_samp_0, block, shared) = item
+            if self.error is None:
+                try:
+                    self.consumer.consume(block_samp_0, block)
+                except Exception as e:
+                    self.error = e
+            # Free the buffer even after an error, so the reader doesn't wait forever.
+            shared.done()
+
+    def put(self, item):
+        self.pending.put(item)
+
+    def join(self):
+        self.pending.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def aligned_samp_per_block(meta, consumers, samp_per_block=None, n_buffers=1):
+    """ Choose a block size that's a multiple of every consumer's block_multiple.
+
+    By default, blocks are sized so that n_buffers of them fit the memory budget from blocks.py.
+    """
+    multiple = 1
+    for consumer in consumers:
+        multiple = int(np.lcm(multiple, consumer.block_multiple))
+    if not samp_per_block:
+        block_bytes = min(blocks.memory_budget_bytes // max(n_buffers, 1), blocks.default_block_bytes)
+        samp_per_block = blocks.samp_per_block_for(meta, block_bytes=block_bytes)
+    return max(multiple, (samp_per_block // multiple) * multiple)
+
+
+def run_pipeline(bin_file, meta, consumers, samp_0=0, n_samp=None, samp_per_block=None, threaded=True, max_pending=2):
+    """ Read bin_file once and feed every block to each of the given consumers.
+
+    Returns a list of consumer results, from each consumer's finish(),
+    in the same order as consumers.
+
+    The threaded keyword arg is True by default, to run each consumer on its
+    own worker thread, with the reader up to max_pending blocks ahead of the
+    slowest consumer.  If False, run all consumers one after the other on the
+    calling thread, while a background thread reads ahead.
+
+    As with read_bin_ben, samp_0 and n_samp are clipped to the extent of the file.
+    """
+    (n_chan, n_file_samp) = blocks.file_shape(meta)
+    if n_samp is None:
+        n_samp = n_file_samp
+    samp_0 = max(int(samp_0), 0)
+    n_samp = max(0, min(int(n_samp), n_file_samp - samp_0))
+    # Each buffer is one block, shared by all consumers.
+    n_buffers = max_pending + 1 if threaded else blocks.BufferedBlockReader.default_n_buffers
+    samp_per_block = aligned_samp_per_block(meta, consumers, samp_per_block, n_buffers)
+
+    for consumer in consumers:
+        consumer.start(meta, n_chan, samp_0, n_samp)
+
+    with blocks.BufferedBlockReader(bin_file, meta, samp_per_block, n_buffers=n_buffers) as reader:
+        if not (threaded and consumers):
+            for (block_samp_0, block) in reader.blocks(samp_0, n_samp):
+                block.flags.writeable = False
+                for consumer in consumers:
+                    consumer.consume(block_samp_0, block)
+        else:
+            free = queue.Queue()
+            for buffer in reader.buffers:
+                free.put(buffer)
+            workers = [_ConsumerWorker(consumer) for consumer in consumers]
+            try:
+                samp_end = samp_0 + n_samp
+                for block_samp_0 in range(samp_0, samp_end, samp_per_block):
+                    block_n_samp = min(samp_per_block, samp_end - block_samp_0)
+                    # Read from disk once, here, and share the read-only result.
+                    buffer = free.get()
+                    reader.read_into(buffer, block_samp_0, block_n_samp)
+                    block = reader.block_view(buffer, block_n_samp)
+                    block.flags.writeable = False
+                    shared = _SharedBuffer(buffer, len(workers), free)
+                    for worker in workers:
+                        if worker.error is not None:
+                            raise worker.error
+                        worker.put((block_samp_0, block, shared))
+            finally:
+                for worker in workers:
+                    worker.join()
+
+    return [consumer.finish() for consumer in consumers]
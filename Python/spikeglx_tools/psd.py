@@ -0,0 +1,141 @@
+# Per-channel power spectral density over whole recordings, with Welch's method.
+#
+# This is for finding noisy channels and line noise in LF and AP data.
+# The recording is read block by block.  Each block is cut into overlapping
+# segments on all channels at once, as a strided [n_chan, n_seg, nfft] view.
+# Segments are detrended, windowed, and transformed with one rFFT along the
+# time axis, and their power is added into a running sum.
+#
+# Segments can span block boundaries: the tail of each block is carried over
+# to the next, so the result is the same for any block size.
+#
+# Power is converted to volts^2/Hz with the same per-channel factors as
+# GainCorrectIM and GainCorrectNI.  Optionally, power is also summed in
+# coarse time bins for a low-resolution spectrogram.
+
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from . import datafile
+from . import blocks
+from .datafile_ben import chan_conv_factors
+
+
+class _GroupWelch():
+    """ Accumulate Welch power for one group of channels, carrying samples across blocks."""
+
+    def __init__(self, rows, nfft, step, window, n_bins):
+        self.rows = rows
+        self.nfft = nfft
+        self.step = step
+        self.window = window.astype('float32')
+        self.carry = np.zeros((len(rows), 0), dtype='float32')
+        self.power = np.zeros((len(rows), nfft // 2 + 1), dtype='float64')
+        self.bin_power = np.zeros((n_bins, len(rows), nfft // 2 + 1), dtype='float64') if n_bins else None
+
+    def process(self, data, buffer_samp_0, bin_samp):
+        buffer = np.concatenate([self.carry, data[self.rows, :].astype('float32')], axis=1)
+        n_seg = (buffer.shape[1] - self.nfft) // self.step + 1 if buffer.shape[1] >= self.nfft else 0
+        if n_seg < 1:
+            self.carry = buffer
+            return 0
+
+        segments = sliding_window_view(buffer, self.nfft, axis=1)[:, 0:n_seg * self.step:self.step, :]
+        segments = segments - segments.mean(axis=2, keepdims=True)
+        spectra = np.fft.rfft(segments * self.window, axis=2)
+        power = spectra.real ** 2 + spectra.imag ** 2
+        self.power += power.sum(axis=1)
+
+        if self.bin_power is not None:
+            centers = buffer_samp_0 + np.arange(n_seg) * self.step + self.nfft // 2
+            bins = np.minimum(centers // bin_samp, self.bin_power.shape[0] - 1)
+            for bin_index in np.unique(bins):
+                self.bin_power[bin_index] += power[:, bins == bin_index, :].sum(axis=1)
+
+        self.carry = buffer[:, n_seg * self.step:].copy()
+        return n_seg
+
+
+def welch_psd(bin_file, meta, chan_list=None, nfft=4096, overlap=0.5, samp_0=0, n_samp=None,
+              spectrogram_secs=None, samp_per_block=None, chans_per_group=64, n_workers=4):
+    """ Estimate the power spectral density of each channel over a whole recording.
+
+    The chan_list keyword arg selects saved-channel indices, default all.
+
+    The nfft keyword arg is the segment length in samples, and overlap is
+    the fraction of overlap between consecutive segments.  Segments use a
+    Hann window and have their mean removed.
+
+    The spectrogram_secs keyword arg is None by default.  If given, also
+    return power in coarse time bins of this many seconds.
+
+    Returns a dict with:
+    - 'freqs' -- frequencies in Hz, [n_freq]
+    - 'psd' -- one-sided power spectral density in volts^2/Hz, [n_chan, n_freq]
+    - 'n_segments' -- number of segments averaged
+    - 'spectrogram' -- PSD per time bin, [n_bins, n_chan, n_freq], if requested
+    - 'spectrogram_times' -- start time of each bin in seconds from samp_0, if requested
+    """
+    (n_chan, n_file_samp) = blocks.file_shape(meta)
+    if chan_list is None:
+        chan_list = range(n_chan)
+    chan_list = np.asarray(chan_list, dtype='int64')
+
+    if n_samp is None:
+        n_samp = n_file_samp
+    samp_0 = max(int(samp_0), 0)
+    n_samp = max(0, min(int(n_samp), n_file_samp - samp_0))
+
+    sample_rate = datafile.SampRate(meta)
+    step = max(1, int(round(nfft * (1 - overlap))))
+    window = np.hanning(nfft + 2)[1:-1]
+
+    if spectrogram_secs:
+        bin_samp = max(1, int(round(spectrogram_secs * sample_rate)))
+        n_bins = max(1, int(np.ceil(n_samp / bin_samp)))
+    else:
+        bin_samp = None
+        n_bins = 0
+
+    groups = [_GroupWelch(np.arange(start, min(start + chans_per_group, len(chan_list))), nfft, step, window, n_bins)
+              for start in range(0, len(chan_list), chans_per_group)]
+
+    if not samp_per_block:
+        # A copy of the block, plus float32 segments and their spectra.
+        samp_per_block = blocks.samp_per_block_for(meta, work_bytes=32)
+    samp_per_block = max(samp_per_block, nfft)
+
+    n_segments = 0
+    with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as executor:
+        for (block_samp_0, block) in blocks.iter_blocks(bin_file, meta, samp_0, n_samp, samp_per_block):
+            data = np.array(block[chan_list, :])
+            # Segment positions relative to samp_0, accounting for carried samples.
+            buffer_samp_0 = block_samp_0 - samp_0 - groups[0].carry.shape[1]
+            counts = list(executor.map(lambda group: group.process(data, buffer_samp_0, bin_samp), groups))
+            n_segments += counts[0]
+
+    # One-sided density scaling, then convert raw units to volts.
+    scale = np.full(nfft // 2 + 1, 2.0 / (sample_rate * np.sum(window ** 2)))
+    scale[0] /= 2
+    if nfft % 2 == 0:
+        scale[-1] /= 2
+    convs = chan_conv_factors(chan_list, meta)
+    volts_sq = (convs ** 2)[:, None]
+
+    power = np.concatenate([group.power for group in groups], axis=0)
+    result = {
+        'freqs': np.fft.rfftfreq(nfft, 1 / sample_rate),
+        'psd': power * scale[None, :] * volts_sq / max(n_segments, 1),
+        'n_segments': n_segments,
+    }
+
+    if n_bins:
+        bin_power = np.concatenate([group.bin_power for group in groups], axis=1)
+        # Normalize each bin by its own segment count.
+        centers = np.arange(n_segments) * step + nfft // 2
+        bin_counts = np.bincount(np.minimum(centers // bin_samp, n_bins - 1), minlength=n_bins)
+        result['spectrogram'] = bin_power * scale[None, None, :] * volts_sq[None, :, :] / np.maximum(bin_counts, 1)[:, None, None]
+        result['spectrogram_times'] = np.arange(n_bins) * bin_samp / sample_rate
+
+    return result
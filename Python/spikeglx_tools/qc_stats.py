@@ -0,0 +1,240 @@
+# Per-channel QC statistics for SpikeGLX .bin files, in one pass.
+#
+# For each channel this computes:
+#   - mean and RMS
+#   - min and max
+#   - counts of samples at the low and high rails of the ADC
+#   - percent of samples clipped at either rail
+#   - the longest run of identical consecutive samples, for flat-line detection
+#
+# Stats are accumulated block by block into ChannelStats objects.  These
+# are "mergeable": stats for two adjacent spans of samples can be merged into
+# stats for the combined span.  So a file can be split into shards that are
+# scanned concurrently, and the shard results merged at the end.
+#
+# With backend='process', blocks are read in order into shared memory and
+# split by sample range among worker processes instead, from backends.py.
+#
+# Raw values are accumulated as integers and reported in volts using the same
+# conversion factors as GainCorrectIM and GainCorrectNI.
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+
+from . import datafile
+from . import blocks
+from . import backends
+from .datafile_ben import chan_conv_factors
+
+
+def adc_rails(meta):
+    """ Return the (low, high) raw sample values where the ADC saturates."""
+    if meta['typeThis'] == 'imec':
+        if 'imMaxInt' in meta:
+            max_int = int(meta['imMaxInt'])
+        else:
+            max_int = 512
+        return (-max_int, max_int - 1)
+    else:
+        return (-32768, 32767)
+
+
+class ChannelStats():
+    """ Mergeable per-channel stats over a span of consecutive samples.
+
+    Use ChannelStats.from_block() to compute stats for one block of raw data,
+    and merge() to combine stats from adjacent spans, earlier span first.
+    """
+
+    def __init__(self, n_chan):
+        self.n_chan = n_chan
+        self.n_samp = 0
+        self.sum = np.zeros(n_chan, dtype='int64')
+        self.sum_sq = np.zeros(n_chan, dtype='float64')
+        self.min = np.full(n_chan, np.iinfo('int16').max, dtype='int64')
+        self.max = np.full(n_chan, np.iinfo('int16').min, dtype='int64')
+        self.n_low = np.zeros(n_chan, dtype='int64')
+        self.n_high = np.zeros(n_chan, dtype='int64')
+
+        # Runs of identical samples can span block boundaries, so keep track
+        # of the first and last values and the runs at each end, as well
+        # as the longest run seen anywhere.
+        self.first = np.zeros(n_chan, dtype='int64')
+        self.last = np.zeros(n_chan, dtype='int64')
+        self.lead_run = np.zeros(n_chan, dtype='int64')
+        self.trail_run = np.zeros(n_chan, dtype='int64')
+        self.max_run = np.zeros(n_chan, dtype='int64')
+
+    @classmethod
+    def from_block(cls, block, rails):
+        """ Compute stats for one raw int16 block with dimensions [n_chan, n_samp]."""
+        (n_chan, n_samp) = block.shape
+        stats = cls(n_chan)
+        if n_samp < 1:
+            return stats
+
+        data = np.asarray(block)
+        stats.n_samp = n_samp
+        stats.sum = data.sum(axis=1, dtype='int64')
+        as_float = data.astype('float64')
+        stats.sum_sq = np.einsum('ij,ij->i', as_float, as_float)
+        stats.min = data.min(axis=1).astype('int64')
+        stats.max = data.max(axis=1).astype('int64')
+        stats.n_low = np.count_nonzero(data <= rails[0], axis=1)
+        stats.n_high = np.count_nonzero(data >= rails[1], axis=1)
+
+        # Runs of identical values: for each sample, find where the current run started.
+        stats.first = data[:, 0].astype('int64')
+        stats.last = data[:, -1].astype('int64')
+        changed = np.zeros((n_chan, n_samp), dtype=bool)
+        changed[:, 1:] = data[:, 1:] != data[:, :-1]
+        sample_index = np.arange(n_samp, dtype='int32')
+        run_start = np.maximum.accumulate(np.where(changed, sample_index, 0), axis=1)
+        run_length = sample_index - run_start + 1
+        stats.max_run = run_length.max(axis=1).astype('int64')
+        stats.trail_run = run_length[:, -1].astype('int64')
+        changed[:, 0] = False
+        any_changed = changed.any(axis=1)
+        stats.lead_run = np.where(any_changed, changed.argmax(axis=1), n_samp).astype('int64')
+        return stats
+
+    def merge(self, later):
+        """ Return stats for this span followed immediately by the later span."""
+        if self.n_samp == 0:
+            return later
+        if later.n_samp == 0:
+            return self
+
+        merged = ChannelStats(self.n_chan)
+        merged.n_samp = self.n_samp + later.n_samp
+        merged.sum = self.sum + later.sum
+        merged.sum_sq = self.sum_sq + later.sum_sq
+        merged.min = np.minimum(self.min, later.min)
+        merged.max = np.maximum(self.max, later.max)
+        merged.n_low = self.n_low + later.n_low
+        merged.n_high = self.n_high + later.n_high
+
+        joins = self.last == later.first
+        joined_run = np.where(joins, self.trail_run + later.lead_run, 0)
+        self_flat = self.lead_run == self.n_samp
+        later_flat = later.lead_run == later.n_samp
+
+        merged.first = self.first
+        merged.last = later.last
+        merged.lead_run = np.where(self_flat & joins, self.n_samp + later.lead_run, self.lead_run)
+        merged.trail_run = np.where(later_flat & joins, later.n_samp + self.trail_run, later.trail_run)
+        merged.max_run = np.maximum(np.maximum(self.max_run, later.max_run), joined_run)
+        return merged
+
+    def summary(self, meta, flat_secs=1.0):
+        """ Return a dict of per-channel results, with values in volts where applicable.
+
+        Channels are flagged as flat if they contain a run of identical samples
+        lasting at least flat_secs.
+        """
+        chan_list = range(self.n_chan)
+        convs = chan_conv_factors(chan_list, meta)
+        sample_rate = datafile.SampRate(meta)
+        n_samp = max(self.n_samp, 1)
+        mean = self.sum / n_samp
+        return {
+            'n_samp': self.n_samp,
+            'mean': mean * convs,
+            'rms': np.sqrt(self.sum_sq / n_samp) * convs,
+            'std': np.sqrt(np.maximum(self.sum_sq / n_samp - mean ** 2, 0)) * convs,
+            'min': self.min * convs,
+            'max': self.max * convs,
+            'n_low': self.n_low,
+            'n_high': self.n_high,
+            'percent_clipped': 100 * (self.n_low + self.n_high) / n_samp,
+            'max_flat_secs': self.max_run / sample_rate,
+            'flat': self.max_run >= flat_secs * sample_rate,
+        }
+
+
+def shard_ranges(n_file_samp, n_shards):
+    """ Split samples 0 through n_file_samp into n_shards (samp_0, n_samp) ranges."""
+    edges = np.linspace(0, n_file_samp, n_shards + 1).astype('int64')
+    return [(int(edges[ii]), int(edges[ii + 1] - edges[ii])) for ii in range(n_shards) if edges[ii + 1] > edges[ii]]
+
+
+def shard_stats(bin_file, meta, samp_0, n_samp, samp_per_block=None):
+    """ Compute ChannelStats for one contiguous shard of a .bin file."""
+    (n_chan, _) = blocks.file_shape(meta)
+    rails = adc_rails(meta)
+    stats = ChannelStats(n_chan)
+    for (_, block) in blocks.iter_blocks(bin_file, meta, samp_0, n_samp, samp_per_block):
+        stats = stats.merge(ChannelStats.from_block(block, rails))
+    return stats
+
+
+def channel_stats(bin_file, meta, n_workers=4, samp_per_block=None, backend='thread'):
+    """ Compute ChannelStats for a whole .bin file, in one pass.
+
+    With backend='thread', the file is split into n_workers contiguous shards
+    that are scanned concurrently on a thread pool, then merged in order.
+
+    With backend='process', each block is read into shared memory and split
+    among n_workers worker processes, then merged in order.
+    """
+    (n_chan, n_file_samp) = blocks.file_shape(meta)
+    if not samp_per_block:
+        # The run-length computation needs a few bytes per sample, so keep blocks modest.
+        samp_per_block = blocks.samp_per_block_for(meta, n_blocks=max(n_workers, 1), work_bytes=24)
+
+    if backend != 'thread':
+        runner = backends.get_backend(backend, n_workers)
+        rails = adc_rails(meta)
+        stats = ChannelStats(n_chan)
+        for (_, block) in blocks.iter_blocks(bin_file, meta, 0, n_file_samp, samp_per_block):
+            data = runner.array('data', block.shape, 'int16')
+            np.copyto(data, block)
+            tasks = [(start, end, rails) for (start, end) in backends.split_range(block.shape[1], runner.n_workers)]
+            for piece in runner.run(_piece_stats, tasks, {'data': data}):
+                stats = stats.merge(piece)
+        return stats
+
+    shards = shard_ranges(n_file_samp, max(n_workers, 1))
+    with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as executor:
+        futures = [executor.submit(shard_stats, bin_file, meta, samp_0, n_samp, samp_per_block) for (samp_0, n_samp) in shards]
+        stats = ChannelStats(n_chan)
+        for future in futures:
+            stats = stats.merge(future.result())
+    return stats
+
+
+def _piece_stats(arrays, start, end, rails):
+    return ChannelStats.from_block(arrays['data'][:, start:end], rails)
+
+
+def print_channel_stats(meta, bin_file, summary):
+    """ Print one line of QC stats per channel, in microvolts."""
+    print(f'\nQC stats for {Path(bin_file).name} ({summary["n_samp"]} samples)')
+    print('chan     mean_uV      rms_uV      min_uV      max_uV   n_low  n_high  %clipped  max_flat_s')
+    for chan in range(len(summary['mean'])):
+        flag = ' FLAT' if summary['flat'][chan] else ''
+        print(f'{chan:4d} {summary["mean"][chan] * 1e6:11.2f} {summary["rms"][chan] * 1e6:11.2f}'
+              f' {summary["min"][chan] * 1e6:11.2f} {summary["max"][chan] * 1e6:11.2f}'
+              f' {summary["n_low"][chan]:7d} {summary["n_high"][chan]:7d}'
+              f' {summary["percent_clipped"][chan]:9.4f} {summary["max_flat_secs"][chan]:11.4f}{flag}')
+
+
+def qc_report(rec_dir, bin_glob='**/*.bin', n_workers=4, flat_secs=1.0):
+    """ Compute and print QC stats for every .bin file found in rec_dir.
+
+    Returns a dict of per-file summaries, keyed by .bin file path.
+    """
+    print(f'Searching for .bin files matching "{bin_glob}" in {rec_dir}')
+    bin_files = list(Path(rec_dir).rglob(bin_glob))
+    bin_files.sort(key=lambda path: path.name)
+    print(f'Found {len(bin_files)} .bin files')
+
+    report = {}
+    for bin_file in bin_files:
+        meta = datafile.readMeta(bin_file)
+        stats = channel_stats(bin_file, meta, n_workers=n_workers)
+        summary = stats.summary(meta, flat_secs=flat_secs)
+        print_channel_stats(meta, bin_file, summary)
+        report[bin_file] = summary
+    return report
@@ -0,0 +1,160 @@
+# Decimate imec data to a lower sample rate, for example AP band to LFP rate.
+#
+# Some probes (NP 2.0) save only a full-band AP stream, while LFP analyses
+# want something like 2.5kHz data.  This reads an imec .bin file block by
+# block, applies an anti-aliasing low-pass FIR to the neural channels,
+# keeps every Nth sample, and writes a new .bin and .meta pair.
+#
+# Filtering uses filters.StreamingDecimator, a polyphase FIR that only
+# computes the samples it keeps.  Full-rate FFT convolution followed by
+# decimation computes N times more output than it keeps: for 64 channels
+# of 30kHz data decimated by 12 with 199 taps, the polyphase form runs
+# about 4x faster.
+#
+# Filter state carries across blocks, so results don't depend on block size.
+# The sync channel is not filtered, just decimated, so digital bits stay intact.
+#
+# Kept samples are those whose stream sample number, counting from the
+# .meta firstSample, is a multiple of the factor.  So the new firstSample
+# is exact, and decimated files from the same stream share one sample grid.
+#
+# The new .meta has updated imSampRate, nSavedChans, fileSizeBytes,
+# fileTimeSecs, firstSample, and fileSHA1 so that readMeta and
+# makeMemMapRaw can use the new .bin directly.
+
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+
+from . import datafile
+from . import datafile_ben
+from . import blocks
+from .filters import fir_taps, StreamingDecimator
+
+
+def decimation_phase(meta, factor):
+    """ Return the first sample of a file to keep, so that kept samples are at multiples of factor in the stream."""
+    return (-int(meta.get('firstSample', 0))) % factor
+
+
+def decimated_meta_updates(meta, chan_list, factor, n_out_samp, sha1):
+    """ Return meta entries that change for a decimated copy of the given channels.
+
+    This assumes the kept samples start at decimation_phase(meta, factor).
+    """
+    n_chan = len(chan_list)
+    (AP, LF, SY) = datafile.ChannelCountsIM(meta)
+    n_ap = sum(1 for c in chan_list if c < AP)
+    n_lf = sum(1 for c in chan_list if AP <= c < AP + LF)
+    n_sy = n_chan - n_ap - n_lf
+    original_chans = datafile.OriginalChans(meta)
+    neural_list = [c for c in chan_list if c < AP + LF]
+
+    updates = {
+        'imSampRate': f'{float(meta["imSampRate"]) / factor:.6f}',
+        'nSavedChans': n_chan,
+        'snsApLfSy': f'{n_ap},{n_lf},{n_sy}',
+        'snsSaveChanSubset': datafile_ben.format_chan_subset(original_chans[chan_list]),
+        'fileSizeBytes': n_out_samp * n_chan * 2,
+        'fileTimeSecs': f'{n_out_samp * factor / float(meta["imSampRate"]):.6f}',
+        'firstSample': (int(meta.get('firstSample', 0)) + decimation_phase(meta, factor)) // factor,
+        'fileSHA1': sha1,
+    }
+    if 'snsChanMap' in meta:
+        updates['snsChanMap'] = datafile_ben.subset_meta_map(meta['snsChanMap'], chan_list)
+    for key in ('snsShankMap', 'snsGeomMap'):
+        if key in meta:
+            updates[key] = datafile_ben.subset_meta_map(meta[key], neural_list)
+    return updates
+
+
+def decimate_bin(bin_file, factor=12, out_file=None, chan_list=None, cutoff_hz=None,
+                 samp_per_block=None, chans_per_group=64, n_workers=4):
+    """ Anti-alias and decimate an imec .bin file by an integer factor, writing a new .bin and .meta.
+
+    The factor keyword arg is 12 by default, for 30kHz AP data to 2.5kHz.
+
+    The out_file keyword arg defaults to a name like "rec_g0_t0.imec0.ap.ds12.bin"
+    in the same folder as bin_file.
+
+    The chan_list keyword arg selects saved-channel indices to keep, default
+    all.  It must select at least one channel.
+
+    The cutoff_hz keyword arg is the anti-aliasing low-pass corner, by default
+    40% of the new sample rate.
+
+    Returns the path to the new .bin file.
+    """
+    bin_path = Path(bin_file)
+    meta = datafile.readMeta(bin_path)
+    (n_chan, n_file_samp) = blocks.file_shape(meta)
+    if out_file is None:
+        out_file = bin_path.with_name(f'{bin_path.stem}.ds{factor}.bin')
+    out_path = Path(out_file)
+    if chan_list is None:
+        chan_list = range(n_chan)
+    chan_list = np.asarray(chan_list, dtype='int64')
+    if not chan_list.size:
+        raise ValueError('chan_list must select at least one channel')
+
+    sample_rate = datafile.SampRate(meta)
+    out_rate = sample_rate / factor
+    if cutoff_hz is None:
+        cutoff_hz = 0.4 * out_rate
+    taps = fir_taps(sample_rate, high_hz=cutoff_hz)
+    phase = decimation_phase(meta, factor)
+
+    # Filter neural channels in groups, and pass the sync channel through.
+    (AP, LF, _) = datafile.ChannelCountsIM(meta)
+    neural_rows = [row for row, chan in enumerate(chan_list) if chan < AP + LF]
+    other_rows = [row for row, chan in enumerate(chan_list) if chan >= AP + LF]
+    groups = []
+    for group_start in range(0, len(neural_rows), chans_per_group):
+        rows = neural_rows[group_start:group_start + chans_per_group]
+        groups.append((rows, StreamingDecimator(taps, len(rows), factor, phase)))
+    if other_rows:
+        # A unit impulse as long as taps passes samples through exactly, ready at the same time as the filtered rows.
+        impulse = np.zeros(len(taps))
+        impulse[(len(taps) - 1) // 2] = 1.0
+        groups.append((other_rows, StreamingDecimator(impulse, len(other_rows), factor, phase)))
+
+    print(f'Decimating {bin_path.name} by {factor}, {sample_rate:.2f}Hz to {out_rate:.2f}Hz, low-pass at {cutoff_hz:.1f}Hz')
+    start = time.perf_counter()
+
+    hasher = hashlib.sha1()
+    n_out_samp = 0
+
+    def write_decimated(f, decimated_rows):
+        nonlocal n_out_samp
+        # Every group has seen the same input, so they're ready with the same number of samples.
+        n_new = decimated_rows[0][1].shape[1]
+        out_block = np.zeros((len(chan_list), n_new), dtype='float32')
+        for (rows, decimated) in decimated_rows:
+            out_block[rows, :] = decimated
+        kept = np.clip(np.round(out_block), -32768, 32767).astype('int16')
+        # Write in file order, samples interleaved by channel.
+        file_order = np.ascontiguousarray(kept.T)
+        f.write(file_order.tobytes())
+        hasher.update(file_order)
+        n_out_samp += kept.shape[1]
+
+    if not samp_per_block:
+        # A copy of the block, plus float32 filter workspace and output.
+        samp_per_block = blocks.samp_per_block_for(meta, work_bytes=32)
+
+    with open(out_path, 'wb') as f, ThreadPoolExecutor(max_workers=max(n_workers, 1)) as executor:
+        for (_, block) in blocks.iter_blocks(bin_path, meta, samp_per_block=samp_per_block):
+            data = np.array(block[chan_list, :])
+            decimated_rows = list(executor.map(lambda group: (group[0], group[1].process(data[group[0], :])), groups))
+            if decimated_rows[0][1].shape[1]:
+                write_decimated(f, decimated_rows)
+        write_decimated(f, [(rows, processor.flush()) for (rows, processor) in groups])
+
+    updates = decimated_meta_updates(meta, chan_list, factor, n_out_samp, hasher.hexdigest().upper())
+    datafile_ben.write_meta_like(bin_path, out_path, updates)
+
+    seconds = time.perf_counter() - start
+    print(f'Wrote {n_out_samp} samples x {len(chan_list)} channels to {out_path.name} in {seconds:.2f}s')
+    return out_path
@@ -0,0 +1,386 @@
+# Run the processing stages for many sessions, resuming where a batch left off.
+#
+# Each session is one SpikeGLX run, with CatGT coordinates like in try_catgt.py:
+#   {'name': 'mouse1_day3', 'data_path': 'spikeglx_data', 'run_name': 'rec',
+#    'g': '3', 't': '0', 'streams': '-ni -ap -lf', 'options': '-prb=0:1 -prb_fld'}
+#
+# For each session this builds a small dependency graph of stages, from the
+# session's catalog (see catalog.py) and the fyi outputs of CatGT:
+#   - 'catgt' -- run CatGT, as cli_wrappers.catgt
+#   - 'tprime' -- after catgt, align each event stream in the CatGT fyi file
+#     that has its own sync edges to a reference stream, with TPrime
+#   - 'summary:<file>' -- cached per-file summary products, as in summary.py
+#   - 'sync:<file>' -- sync edge times in seconds, written one per line
+#   - 'qc:<file>' -- per-channel QC stats, as in qc_stats.py, written as JSON
+#
+# Stages run on a thread pool, limited by resource slots: each stage holds
+# one "io" slot and/or one "cpu" slot while it runs, so a batch can keep
+# the disks busy with a few concurrent readers without oversubscribing the
+# CPUs, or vice versa.  CatGT and TPrime stages also hold a "catgt" or
+# "tprime" slot, with only one of each.  The cli_wrappers find each run's
+# results by diffing CatGT.log or TPrime.log in the working directory, so
+# concurrent runs of the same tool would pick up each other's log entries.
+#
+# Completion state is checkpointed to a JSON file after each stage finishes.
+# Each completed stage is recorded with a key that identifies its inputs:
+# session parameters, the size and modification time of its .bin and .meta
+# files (all of the session's files, for CatGT), and the keys of the stages
+# it depends on.  Running the same batch again skips
+# stages that completed with the same key, reruns stages that failed or
+# whose inputs changed, and passes recorded results (like the CatGT fyi) on
+# to dependent stages.
+#
+# From the command line, with a JSON list of sessions:
+#   python -m spikeglx_tools.scheduler sessions.json --state batch/state.json --io-slots 2 --cpu-slots 8
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timezone
+from functools import partial
+from pathlib import Path
+
+from .catalog import catalog_run
+
+# Defaults for optional session parameters.
+session_defaults = {
+    'streams': '-ni -ap -lf',
+    'options': '',
+    'output_path': None,
+    'work_path': None,
+    'dry_run': False,
+    'catgt_runit': None,
+    'tprime_runit': None,
+    'tprime_reference': None,
+    'sync_period': 1.0,
+    'summary_start': 0,
+    'summary_duration': 30,
+    'flat_secs': 1.0,
+}
+
+times_key_pattern = re.compile(r'^times_(?P<stream>.+)_\d+$')
+
+
+class Stage():
+    """ One step of work for a session.
+
+    name -- unique within the session, like 'catgt' or 'qc:rec_g0_t0.nidq.bin'
+    resources -- slots the stage holds while it runs, like ('io',) or ('io', 'cpu')
+    func -- called as func(session, results), where results has the recorded
+            results of the stages named in depends, and returns a JSON-friendly dict
+    depends -- names of stages that must complete first
+    key_parts -- values that identify the stage's inputs, besides its dependencies
+    """
+
+    def __init__(self, name, resources, func, depends=(), key_parts=()):
+        self.name = name
+        self.resources = tuple(resources)
+        self.func = func
+        self.depends = list(depends)
+        self.key_parts = list(key_parts)
+
+
+def index_range(value):
+    """ Return the indices in a CatGT g or t value like '3' or '0:1', or None if it's not a simple range."""
+    (first, _, last) = str(value).partition(':')
+    try:
+        return range(int(first), int(last or first) + 1)
+    except ValueError:
+        return None
+
+
+def stream_selected(stream, which_streams):
+    """ Check whether a catalog stream like 'nidq' or 'imec0.ap' is selected by CatGT stream flags like '-ni -ap'."""
+    flags = which_streams.split()
+    if stream == 'nidq':
+        return '-ni' in flags
+    if stream.startswith('obx'):
+        return '-ob' in flags
+    return f'-{stream.rsplit(".", maxsplit=1)[-1]}' in flags
+
+
+def session_catalog(session):
+    """ Return catalog entries for the gates, triggers, and streams of a session."""
+    gates = index_range(session['g'])
+    triggers = index_range(session['t'])
+    return [entry for entry in catalog_run(session['data_path'], session['run_name'])
+            if (gates is None or entry['g'] in gates)
+            and (triggers is None or entry['t'] in triggers)
+            and stream_selected(entry['stream'], session['streams'])]
+
+
+def prepare_session(session, default_work_path):
+    """ Fill in defaults for a session dict, including its name and work_path."""
+    prepared = dict(session_defaults)
+    prepared.update(session)
+    if not prepared.get('name'):
+        prepared['name'] = f'{prepared["run_name"]}_g{prepared["g"]}_t{prepared["t"]}'
+    if not prepared['work_path']:
+        prepared['work_path'] = Path(default_work_path, prepared['name'])
+    prepared['work_path'] = Path(prepared['work_path'])
+    return prepared
+
+
+def run_catgt(session, results):
+    from .cli_wrappers import catgt
+
+    return catgt(session['data_path'], session['run_name'], session['g'], session['t'], session['streams'],
+                 options=session['options'], output_path=session['output_path'], dry_run=session['dry_run'],
+                 which_runit=session['catgt_runit'])
+
+
+def tprime_streams(fyi, reference=None):
+    """ Choose TPrime arguments from a CatGT fyi dict.
+
+    Returns (to_stream, from_streams) where to_stream is the sync edges file
+    of the reference stream, by default imec0 if present, and from_streams
+    has (edges_file, events_file, None) for each events file of other streams.
+    """
+    sync_keys = [key for key in fyi if key.startswith('sync_')]
+    if not sync_keys:
+        return (None, [])
+    if reference is None:
+        reference = 'sync_imec0' if 'sync_imec0' in fyi else sync_keys[0]
+    from_streams = []
+    for key in fyi:
+        match = times_key_pattern.match(key)
+        if match and f'sync_{match["stream"]}' in fyi and f'sync_{match["stream"]}' != reference:
+            from_streams.append((fyi[f'sync_{match["stream"]}'], fyi[key], None))
+    return (fyi[reference], from_streams)
+
+
+def run_tprime(session, results):
+    from .cli_wrappers import tprime
+
+    fyi = results['catgt'].get('fyi')
+    if not fyi:
+        return {'skipped': 'no CatGT fyi file'}
+    (to_stream, from_streams) = tprime_streams(fyi, session['tprime_reference'])
+    if not from_streams:
+        return {'skipped': 'no event streams to align'}
+    return tprime(to_stream, from_streams, sync_period=session['sync_period'], dry_run=session['dry_run'],
+                  which_runit=session['tprime_runit'])
+
+
+def run_summary(entry, session, results):
+    from .summary import cached_file_summary
+
+    cache_dir = Path(session['work_path'], 'summary')
+    products = cached_file_summary(entry['bin_file'].parent, entry['bin_file'], session['summary_start'],
+                                   session['summary_duration'], cache_dir=cache_dir)
+    return {'cache_dir': cache_dir, 'end_time': products['end_time'], 'n_event_files': len(products['event_times'])}
+
+
+def run_sync(entry, session, results):
+    from .cli_wrappers import write_floats
+    from .timebase import sync_edges
+
+    times = sync_edges(entry['bin_file'], entry['meta']) / entry['sample_rate']
+    sync_path = Path(session['work_path'], 'sync')
+    sync_path.mkdir(parents=True, exist_ok=True)
+    edges_file = sync_path.joinpath(f'{entry["bin_file"].stem}.sync_edges.txt')
+    write_floats(edges_file, times)
+    return {'edges_file': edges_file, 'n_edges': len(times)}
+
+
+def run_qc(entry, session, results):
+    from .qc_stats import channel_stats
+
+    # One worker per stage, since the scheduler runs stages concurrently.
+    stats = channel_stats(entry['bin_file'], entry['meta'], n_workers=1)
+    summary = stats.summary(entry['meta'], flat_secs=session['flat_secs'])
+    qc_path = Path(session['work_path'], 'qc')
+    qc_path.mkdir(parents=True, exist_ok=True)
+    qc_file = qc_path.joinpath(f'{entry["bin_file"].stem}.qc.json')
+    with open(qc_file, 'w') as f:
+        json.dump({name: value.tolist() if hasattr(value, 'tolist') else value for (name, value) in summary.items()}, f)
+    return {'qc_file': qc_file, 'n_flat': int(summary['flat'].sum()), 'max_percent_clipped': float(summary['percent_clipped'].max(initial=0))}
+
+
+def file_identities(entry):
+    """ Return path, size, and modification time of the .bin and .meta files of a catalog entry."""
+    identities = []
+    for path in [entry['bin_file'], entry['meta_file']]:
+        stat = path.stat()
+        identities += [path.absolute(), stat.st_size, stat.st_mtime_ns]
+    return identities
+
+
+def session_stages(session):
+    """ Return the stages for one session, with each stage after the stages it depends on."""
+    catalog = session_catalog(session)
+    catgt_parts = [session[name] for name in ['data_path', 'run_name', 'g', 't', 'streams', 'options', 'output_path', 'dry_run']]
+    catgt_parts += [part for entry in catalog for part in file_identities(entry)]
+    stages = [
+        Stage('catgt', ('io', 'cpu', 'catgt'), run_catgt, key_parts=catgt_parts),
+        Stage('tprime', ('cpu', 'tprime'), run_tprime, depends=['catgt'], key_parts=[session['tprime_reference'], session['sync_period']]),
+    ]
+    for entry in catalog:
+        identity = file_identities(entry)
+        name = entry['bin_file'].name
+        summary_parts = identity + [session['summary_start'], session['summary_duration']]
+        stages.append(Stage(f'summary:{name}', ('io',), partial(run_summary, entry), key_parts=summary_parts))
+        stages.append(Stage(f'sync:{name}', ('io',), partial(run_sync, entry), key_parts=identity))
+        stages.append(Stage(f'qc:{name}', ('io', 'cpu'), partial(run_qc, entry), key_parts=identity + [session['flat_secs']]))
+    return stages
+
+
+def stage_key(stage, depend_keys):
+    parts = [stage.name] + stage.key_parts + depend_keys
+    return hashlib.sha1('|'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+class BatchScheduler():
+    """ Run stages for many sessions with per-resource slots, checkpointing completion state to state_file.
+
+    The io_slots and cpu_slots keyword args limit how many running stages
+    can hold each resource at once.  CatGT and TPrime each run one at a
+    time, since they share log files in the working directory.  Session
+    work folders default to
+    folders named by session, next to the state_file.
+    """
+
+    def __init__(self, state_file, io_slots=2, cpu_slots=None):
+        self.state_file = Path(state_file)
+        self.slots = {'io': max(int(io_slots), 1), 'cpu': max(int(cpu_slots or os.cpu_count() or 1), 1), 'catgt': 1, 'tprime': 1}
+        self.state = self.load_state()
+
+    def load_state(self):
+        if self.state_file.exists():
+            with open(self.state_file) as f:
+                return json.load(f)
+        return {'sessions': {}}
+
+    def save_state(self):
+        # Write to a temp file first, so an interrupted run doesn't leave a partial state file.
+        self.state_file.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = self.state_file.with_name(f'{self.state_file.name}.{os.getpid()}.tmp')
+        with open(temp_file, 'w') as f:
+            json.dump(self.state, f, indent=2, default=str)
+        os.replace(temp_file, self.state_file)
+
+    def record(self, session_name, stage_name):
+        """ Return the recorded state of a stage, or None, without changing self.state."""
+        return self.state['sessions'].get(session_name, {}).get(stage_name)
+
+    def plan(self, sessions):
+        """ Return a list of (session, stage, key) jobs for all sessions, with dependencies first."""
+        jobs = []
+        for session in sessions:
+            session = prepare_session(session, self.state_file.parent)
+            keys = {}
+            for stage in session_stages(session):
+                keys[stage.name] = stage_key(stage, [keys[name] for name in stage.depends])
+                jobs.append((session, stage, keys[stage.name]))
+        return jobs
+
+    def run_stage(self, session, stage, results):
+        """ Run one stage on a worker thread, with the results of its dependencies, and return its record.
+
+        Only the main thread reads or changes self.state, so results are
+        collected there before the stage is submitted.
+        """
+        start = datetime.now(timezone.utc)
+        result = stage.func(session, results)
+        finish = datetime.now(timezone.utc)
+        # Round trip through JSON so fresh and resumed results look the same.
+        return {
+            'result': json.loads(json.dumps(result, default=str)),
+            'start': str(start),
+            'finish': str(finish),
+            'duration': str(finish - start),
+        }
+
+    def run(self, sessions):
+        """ Run all stages that aren't already complete, and return a dict of status counts.
+
+        Statuses are 'done', 'skipped' (done in an earlier run), 'failed',
+        and 'blocked' (a dependency failed).
+        """
+        jobs = self.plan(sessions)
+        counts = {'done': 0, 'skipped': 0, 'failed': 0, 'blocked': 0}
+        status = {}
+        waiting = []
+        for (session, stage, key) in jobs:
+            record = self.record(session['name'], stage.name)
+            if record and record.get('status') == 'done' and record.get('key') == key:
+                status[(session['name'], stage.name)] = 'done'
+                counts['skipped'] += 1
+            else:
+                waiting.append((session, stage, key))
+        print(f'Batch of {len(sessions)} sessions: {len(waiting)} stages to run, {counts["skipped"]} already done')
+
+        free = dict(self.slots)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.slots['io'] + self.slots['cpu']) as executor:
+            try:
+                while waiting or running:
+                    for job in list(waiting):
+                        (session, stage, key) = job
+                        depend_status = [status.get((session['name'], name)) for name in stage.depends]
+                        if any(value in ('failed', 'blocked') for value in depend_status):
+                            waiting.remove(job)
+                            status[(session['name'], stage.name)] = 'blocked'
+                            counts['blocked'] += 1
+                            print(f'Blocked {session["name"]} {stage.name}')
+                        elif all(value == 'done' for value in depend_status) and all(free[resource] > 0 for resource in stage.resources):
+                            waiting.remove(job)
+                            for resource in stage.resources:
+                                free[resource] -= 1
+                            results = {name: self.record(session['name'], name)['result'] for name in stage.depends}
+                            running[executor.submit(self.run_stage, session, stage, results)] = job
+
+                    if not running:
+                        break
+                    (finished, _) = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        (session, stage, key) = running.pop(future)
+                        for resource in stage.resources:
+                            free[resource] += 1
+                        try:
+                            record = future.result()
+                            record.update({'status': 'done', 'key': key})
+                            print(f'Done {session["name"]} {stage.name} in {record["duration"]}')
+                        except Exception as e:
+                            traceback.print_exc()
+                            record = {'status': 'failed', 'key': key, 'error': f'{type(e).__name__}: {e}', 'finish': str(datetime.now(timezone.utc))}
+                            print(f'Failed {session["name"]} {stage.name}: {record["error"]}')
+                        self.state['sessions'].setdefault(session['name'], {})[stage.name] = record
+                        status[(session['name'], stage.name)] = record['status']
+                        counts[record['status']] += 1
+                        self.save_state()
+            except KeyboardInterrupt:
+                # Don't start anything else.  Stages already running finish, but aren't
+                # recorded, so they run again next time.
+                print(f'Interrupted, waiting for {len(running)} running stages')
+                for future in running:
+                    future.cancel()
+                raise
+            finally:
+                self.save_state()
+
+        print(f'Batch finished: {counts}')
+        return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run processing stages for many SpikeGLX sessions, resuming from a state file.')
+    parser.add_argument('sessions', help='JSON file with a list of session dicts')
+    parser.add_argument('--state', default='batch/state.json', help='JSON file for completion state')
+    parser.add_argument('--io-slots', type=int, default=2, help='stages that can read or write files at once')
+    parser.add_argument('--cpu-slots', type=int, default=None, help='stages that can compute at once, default CPU count')
+    args = parser.parse_args(argv)
+
+    with open(args.sessions) as f:
+        sessions = json.load(f)
+    counts = BatchScheduler(args.state, io_slots=args.io_slots, cpu_slots=args.cpu_slots).run(sessions)
+    return 1 if counts['failed'] or counts['blocked'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,100 @@
+# Extract peri-event snippets of raw data around many event times.
+#
+# For example, +/-500ms of LFP around trial events, or +/-1ms of AP data
+# around spike times.  Event times are in seconds from the start of the
+# .bin file, in the file's own clock -- for example event times from CatGT,
+# or times aligned to this stream with TPrime.
+#
+# Events are sorted by time before reading, so that each batch of snippets
+# comes from a nearby part of the file.  Each batch is gathered from the
+# makeMemMapRaw view with a single fancy-index, then converted to volts
+# with the same factors as GainCorrectIM and GainCorrectNI.
+#
+# Windows that run off the start or end of the file are padded with a
+# constant pad_value.
+
+import numpy as np
+
+from . import datafile
+from . import blocks
+from .datafile_ben import chan_conv_factors
+
+# Each snippet value takes 2 bytes raw, then 4 as float32.
+bytes_per_batch_value = 6
+
+
+def window_offsets(meta, window):
+    """ Return sample offsets relative to each event, for a window (t_before, t_after) in seconds.
+
+    The window is half-open: it includes t_before but not t_after.
+    """
+    sample_rate = datafile.SampRate(meta)
+    first = int(round(window[0] * sample_rate))
+    last = int(round(window[1] * sample_rate))
+    return np.arange(first, last, dtype='int64')
+
+
+def iter_snippet_batches(bin_file, meta, event_times, chan_list=None, window=(-0.001, 0.001), batch_size=None, pad_value=0, volts=True):
+    """ Yield (event_indices, snippets) for batches of events, in time order.
+
+    event_indices are positions in the given event_times array.  snippets
+    is a float32 array with dimensions [n_batch, n_chan, n_samp].
+
+    The chan_list keyword arg selects saved-channel indices, default all.
+    The window keyword arg is (t_before, t_after) in seconds relative to each event.
+    The volts keyword arg is True by default, to apply gain correction.
+    Otherwise, snippets contain raw sample values.
+
+    Raises ValueError if any event time is NaN or infinite.
+    """
+    (n_chan, n_file_samp) = blocks.file_shape(meta)
+    if chan_list is None:
+        chan_list = range(n_chan)
+    chan_array = np.asarray(chan_list, dtype='int64')
+    offsets = window_offsets(meta, window)
+
+    if batch_size is None:
+        # Use a fraction of the memory budget, leaving the rest for the caller's results.
+        batch_size = max(1, (blocks.memory_budget_bytes // 8) // (bytes_per_batch_value * max(len(chan_array) * len(offsets), 1)))
+
+    if volts:
+        convs = chan_conv_factors(chan_array, meta).astype('float32')
+    else:
+        convs = np.ones(len(chan_array), dtype='float32')
+
+    event_times = np.asarray(event_times, dtype='float64')
+    if not np.isfinite(event_times).all():
+        raise ValueError('event_times must all be finite, not NaN or inf')
+    event_samples = np.round(event_times * datafile.SampRate(meta)).astype('int64')
+    order = np.argsort(event_samples, kind='stable')
+
+    raw_data = blocks.memmap_bin(bin_file, meta)
+    for batch_start in range(0, len(order), batch_size):
+        event_indices = order[batch_start:batch_start + batch_size]
+        sample_indices = event_samples[event_indices, None] + offsets[None, :]
+        in_file = (sample_indices >= 0) & (sample_indices < n_file_samp)
+        clipped = np.clip(sample_indices, 0, n_file_samp - 1)
+
+        # One fancy-index for the whole batch: [n_chan, n_batch, n_samp].
+        gathered = raw_data[chan_array[:, None, None], clipped[None, :, :]]
+        snippets = gathered.transpose(1, 0, 2).astype('float32')
+        snippets *= convs[None, :, None]
+        if not in_file.all():
+            snippets[np.broadcast_to(~in_file[:, None, :], snippets.shape)] = pad_value
+
+        yield (event_indices, snippets)
+
+
+def extract_snippets(bin_file, meta, event_times, chan_list=None, window=(-0.001, 0.001), batch_size=None, pad_value=0, volts=True):
+    """ Return snippets around all events as one float32 array [n_events, n_chan, n_samp].
+
+    Snippets are in the same order as event_times.  This takes the same
+    args as iter_snippet_batches, which is better for very many events.
+    """
+    (n_chan, _) = blocks.file_shape(meta)
+    n_snippet_chan = n_chan if chan_list is None else len(chan_list)
+    n_samp = len(window_offsets(meta, window))
+    snippets = np.zeros((len(event_times), n_snippet_chan, n_samp), dtype='float32')
+    for (event_indices, batch) in iter_snippet_batches(bin_file, meta, event_times, chan_list, window, batch_size, pad_value, volts):
+        snippets[event_indices] = batch
+    return snippets
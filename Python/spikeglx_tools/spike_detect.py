@@ -0,0 +1,169 @@
+# Quick threshold-crossing spike detection across all imec AP channels.
+#
+# This is for multi-unit QC, not spike sorting.  The recording is read once,
+# block by block.  Each block is band-pass filtered, and negative threshold
+# crossings are detected on all channels at once.
+#
+# The threshold for each channel is a multiple of a robust noise estimate,
+# median(|x|) / 0.6745 (the "MAD" estimate).  This is computed for each
+# block as it streams by, and the threshold uses the median of all the
+# block estimates so far.
+#
+# After each crossing, the spike sample and amplitude are taken from the
+# most negative filtered value within the refractory period.  Crossings
+# within the refractory period of the previous crossing on the same channel
+# are dropped.
+#
+# Channels are split into groups that are filtered and detected concurrently
+# on a thread pool.  numpy releases the GIL for the heavy lifting here.
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from . import datafile
+from . import blocks
+from .filters import fir_taps, StreamingFir
+from .datafile_ben import chan_conv_factors
+
+mad_to_sigma = 1 / 0.6745
+
+
+class _GroupDetector():
+    """ Filter and detect spikes for one group of channels, carrying state across blocks."""
+
+    def __init__(self, chans, taps, samp_0, threshold, refractory, convs):
+        self.chans = np.asarray(chans)
+        self.fir = StreamingFir(taps, len(chans))
+        self.threshold = threshold
+        self.refractory = refractory
+        self.convs = convs.astype('float32')
+        self.carry = np.zeros((len(chans), 0), dtype='float32')
+        self.next_samp = samp_0
+        self.noise_history = []
+        self.last_crossing = np.full(len(chans), np.iinfo('int64').min // 2, dtype='int64')
+        self.samples = []
+        self.channels = []
+        self.amplitudes = []
+
+    def noise(self):
+        return np.median(np.stack(self.noise_history), axis=0)
+
+    def process(self, data):
+        self.detect(self.fir.process(data[self.chans, :]), final=False)
+
+    def finish(self):
+        self.detect(self.fir.flush(), final=True)
+
+    def detect(self, filtered, final):
+        if filtered.shape[1] >= 1000 or not self.noise_history:
+            if filtered.shape[1]:
+                self.noise_history.append(np.median(np.abs(filtered), axis=1) * mad_to_sigma)
+        if not self.noise_history:
+            return
+        thresholds = -self.threshold * self.noise()
+
+        buffer = np.concatenate([self.carry, filtered], axis=1)
+        buffer_samp_0 = self.next_samp - self.carry.shape[1]
+        self.next_samp += filtered.shape[1]
+
+        # Check positions up to where a full refractory window follows, except at the very end.
+        n_buffer = buffer.shape[1]
+        end = n_buffer if final else max(n_buffer - self.refractory, 1)
+        below = buffer[:, :end] < thresholds[:, None]
+        crossing = np.zeros_like(below)
+        crossing[:, 1:] = below[:, 1:] & ~below[:, :-1]
+        self.carry = buffer[:, end - 1:].copy()
+
+        (chan_index, position) = np.nonzero(crossing)
+        if not chan_index.size:
+            return
+
+        # Drop crossings too soon after the previous crossing on the same channel.
+        crossing_samp = position + buffer_samp_0
+        previous = np.empty_like(crossing_samp)
+        previous[1:] = crossing_samp[:-1]
+        first_in_chan = np.ones(len(chan_index), dtype=bool)
+        first_in_chan[1:] = chan_index[1:] != chan_index[:-1]
+        previous[first_in_chan] = self.last_crossing[chan_index[first_in_chan]]
+        last_in_chan = np.ones(len(chan_index), dtype=bool)
+        last_in_chan[:-1] = first_in_chan[1:]
+        self.last_crossing[chan_index[last_in_chan]] = crossing_samp[last_in_chan]
+        keep = crossing_samp - previous > self.refractory
+        chan_index = chan_index[keep]
+        position = position[keep]
+
+        # Find the peak within the refractory window after each crossing.
+        window = position[:, None] + np.arange(self.refractory)[None, :]
+        window = np.minimum(window, n_buffer - 1)
+        values = buffer[chan_index[:, None], window]
+        peak = values.argmin(axis=1)
+        self.samples.append(window[np.arange(len(peak)), peak] + buffer_samp_0)
+        self.channels.append(self.chans[chan_index])
+        self.amplitudes.append(values[np.arange(len(peak)), peak] * self.convs[chan_index])
+
+
+def detect_spikes(bin_file, meta, chan_list=None, band=(300.0, 6000.0), threshold=5.0, refractory_secs=0.001,
+                  samp_0=0, n_samp=None, samp_per_block=None, chans_per_group=48, n_workers=4):
+    """ Detect negative threshold crossings on imec AP channels.
+
+    The chan_list keyword arg selects saved-channel indices, by default all
+    AP channels from ChannelCountsIM.
+
+    The band keyword arg is the (low, high) band-pass in Hz.
+    The threshold keyword arg is in multiples of the MAD noise estimate.
+    The refractory_secs keyword arg is the dead time after each crossing.
+
+    Returns a dict with:
+    - 'samples' -- file sample number of each spike peak, sorted
+    - 'channels' -- saved-channel index of each spike
+    - 'amplitudes' -- filtered peak value of each spike, in volts
+    - 'noise' -- final MAD noise estimate for each channel in chan_list, in volts
+    - 'chan_list' -- the channels that were searched
+    """
+    if chan_list is None:
+        (AP, _, _) = datafile.ChannelCountsIM(meta)
+        chan_list = range(AP)
+    chan_list = np.asarray(chan_list, dtype='int64')
+
+    sample_rate = datafile.SampRate(meta)
+    taps = fir_taps(sample_rate, band[0], band[1])
+    refractory = max(1, int(round(refractory_secs * sample_rate)))
+    convs = chan_conv_factors(chan_list, meta)
+
+    if not samp_per_block:
+        # A copy of the block, plus float32 filter workspace for each channel group.
+        samp_per_block = blocks.samp_per_block_for(meta, work_bytes=32)
+    samp_0 = max(int(samp_0), 0)
+
+    groups = []
+    for group_start in range(0, len(chan_list), chans_per_group):
+        group_slice = slice(group_start, group_start + chans_per_group)
+        groups.append(_GroupDetector(chan_list[group_slice], taps, samp_0, threshold, refractory, convs[group_slice]))
+
+    start = time.perf_counter()
+    n_read = 0
+    with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as executor:
+        for (_, block) in blocks.iter_blocks(bin_file, meta, samp_0, n_samp, samp_per_block):
+            data = np.array(block)
+            n_read += data.shape[1]
+            list(executor.map(lambda group: group.process(data), groups))
+        list(executor.map(lambda group: group.finish(), groups))
+    seconds = time.perf_counter() - start
+
+    samples = np.concatenate([np.concatenate(g.samples) if g.samples else np.zeros(0, dtype='int64') for g in groups])
+    channels = np.concatenate([np.concatenate(g.channels) if g.channels else np.zeros(0, dtype='int64') for g in groups])
+    amplitudes = np.concatenate([np.concatenate(g.amplitudes) if g.amplitudes else np.zeros(0, dtype='float32') for g in groups])
+    order = np.argsort(samples, kind='stable')
+
+    noise = np.concatenate([g.noise() if g.noise_history else np.full(len(g.chans), np.nan) for g in groups]) * convs
+    if seconds > 0:
+        print(f'Detected {len(samples)} spikes on {len(chan_list)} channels in {seconds:.2f}s ({n_read / sample_rate / seconds:.1f}x real time)')
+
+    return {
+        'samples': samples[order],
+        'channels': channels[order].astype('int16'),
+        'amplitudes': amplitudes[order].astype('float32'),
+        'noise': noise,
+        'chan_list': chan_list,
+    }
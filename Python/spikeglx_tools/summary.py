@@ -10,17 +10,30 @@
 # BSH added interpretation from the SpikeGLX docs:
 #  - https://billkarsh.github.io/SpikeGLX/Sgl_help/UserManual.html
 #  - https://billkarsh.github.io/SpikeGLX/Sgl_help/Metadata_30.html
-
+#
+# With a cache_dir, the per-file products (the printed description, the
+# decimated sync, analog, AP, and LF waves, and event times to overlay) are
+# saved in a compressed .npz file per .bin file.  Cache files are keyed by
+# the .meta file's size and modification time, the event files found, and
+# the start_time, duration, and samp_per_chunk parameters.  So a re-run only
+# reads and decimates files that are new or changed.  Each .bin file keeps
+# only its latest cache file, and waves keep their own dtypes, so cached
+# products are the same as new ones.
+
+import contextlib
+import glob
+import hashlib
+import io
+import os
 from pathlib import Path
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib import cm
 
 from . import datafile
 from . import datafile_ben
+from . import blocks
 from .cli_wrappers import read_floats
 
-def plot_recording_summary(rec_dir, start_time=0, duration=30, bin_glob='**/*.bin'):
+def plot_recording_summary(rec_dir, start_time=0, duration=30, bin_glob='**/*.bin', cache_dir=None, samp_per_chunk=None):
 
     print(f'Searching for .bin files matching "{bin_glob}" in {rec_dir}')
 
@@ -36,6 +49,10 @@ def plot_recording_summary(rec_dir, start_time=0, duration=30, bin_glob='**/*.bi
 
     print(f'Plotting {duration} seconds of data starting at {start_time}, for each file.')
 
+    # Import matplotlib only when plotting, since it's slow to import.
+    import matplotlib.pyplot as plt
+    from matplotlib import cm
+
     fig, (ax1, ax2, ax3, ax4) = plt.subplots(4, 1)
     color_map = cm.get_cmap('plasma', file_count)
     plot_colors = dict(zip(bin_files, color_map.colors))
@@ -44,43 +61,24 @@ def plot_recording_summary(rec_dir, start_time=0, duration=30, bin_glob='**/*.bi
     end_time = start_time
     for bin_file in bin_files:
 
-        event_glob = f'{bin_file.stem}*.txt'
-        event_files = rec_path.rglob(event_glob)
-        for index, event_file in enumerate(event_files):
-            print(f'Found event file: {event_file}')
-            event_times = read_floats(event_file)
-            line_style = event_line_styles[index % len(event_line_styles)]
-            ax1.vlines(event_times, 0, 5, colors = [plot_colors[bin_file]], linestyles=[line_style])
-
         print(f'\nReading .meta and .bin for {bin_file.name}')
+        products = cached_file_summary(rec_path, bin_file, start_time, duration, cache_dir, samp_per_chunk)
+        print(products['description'], end='')
 
-        meta = datafile.readMeta(bin_file)
-        if (meta['typeThis'] == 'nidq'):
-            describe_ni(meta, bin_file)
-            [data_array, sample_times] = read_data_ni(meta, bin_file, start_time, duration)
-            if sample_times.size:
-                end_time = max(end_time, sample_times.max())
-            
-            (sync_wave, sync_times) = extract_sync_ni(meta, data_array, sample_times)
-            ax1.plot(sync_times.transpose(), sync_wave.transpose(), '.', color=plot_colors[bin_file], label=bin_file.name)
-
-            (analog_waves, analog_times) = extract_analog_ni(meta, data_array, sample_times)
-            ax2.plot(analog_times.transpose(), analog_waves.transpose(), '.', color=plot_colors[bin_file])
-
-        else:
-            describe_im(meta, bin_file)
-            [data_array, sample_times] = read_data_im(meta, bin_file, start_time, duration)
-            if sample_times.size:
-                end_time = max(end_time, sample_times.max())
-
-            (sync_wave, sync_times) = extract_sync_im(meta, data_array, sample_times)
-            ax1.plot(sync_times.transpose(), sync_wave.transpose(), '.', color=plot_colors[bin_file], label=bin_file.name)
+        for index, event_times in enumerate(products['event_times']):
+            line_style = event_line_styles[index % len(event_line_styles)]
+            ax1.vlines(event_times, 0, 5, colors = [plot_colors[bin_file]], linestyles=[line_style])
 
-            (ap_waves, ap_times) = extract_ap_im(meta, data_array, sample_times)
-            ax3.plot(ap_times.transpose(), ap_waves.transpose(), '.', color=plot_colors[bin_file])
+        if products['end_time'] is not None:
+            end_time = max(end_time, products['end_time'])
 
-            (lf_waves, lf_times) = extract_lf_im(meta, data_array, sample_times)
-            ax4.plot(lf_times.transpose(), lf_waves.transpose(), '.', color=plot_colors[bin_file])
+        ax1.plot(products['sync_times'].transpose(), products['sync_wave'].transpose(), '.', color=plot_colors[bin_file], label=bin_file.name)
+        if 'analog_waves' in products:
+            ax2.plot(products['analog_times'].transpose(), products['analog_waves'].transpose(), '.', color=plot_colors[bin_file])
+        if 'ap_waves' in products:
+            ax3.plot(products['ap_times'].transpose(), products['ap_waves'].transpose(), '.', color=plot_colors[bin_file])
+        if 'lf_waves' in products:
+            ax4.plot(products['lf_times'].transpose(), products['lf_waves'].transpose(), '.', color=plot_colors[bin_file])
 
     ax1.set_xlim(start_time, end_time)
     ax1.legend()
@@ -103,6 +101,93 @@ def plot_recording_summary(rec_dir, start_time=0, duration=30, bin_glob='**/*.bi
     plt.show()
 
 
+# Compute the products plotted for one .bin file: the printed description,
+# waves and times to plot, event times to overlay, and the latest sample time.
+def summarize_file(rec_path, bin_file, start_time=0, duration=30, samp_per_chunk=None):
+    products = {'event_times': [], 'end_time': None}
+
+    description = io.StringIO()
+    with contextlib.redirect_stdout(description):
+        for event_file in find_event_files(rec_path, bin_file):
+            print(f'Found event file: {event_file}')
+            products['event_times'].append(np.asarray(read_floats(event_file), dtype='float64'))
+
+        meta = datafile.readMeta(bin_file)
+        if (meta['typeThis'] == 'nidq'):
+            describe_ni(meta, bin_file)
+            [data_array, sample_times] = read_data_ni(meta, bin_file, start_time, duration, samp_per_chunk)
+            (products['sync_wave'], products['sync_times']) = extract_sync_ni(meta, data_array, sample_times)
+            (products['analog_waves'], products['analog_times']) = extract_analog_ni(meta, data_array, sample_times)
+        else:
+            describe_im(meta, bin_file)
+            [data_array, sample_times] = read_data_im(meta, bin_file, start_time, duration, samp_per_chunk)
+            (products['sync_wave'], products['sync_times']) = extract_sync_im(meta, data_array, sample_times)
+            (products['ap_waves'], products['ap_times']) = extract_ap_im(meta, data_array, sample_times)
+            (products['lf_waves'], products['lf_times']) = extract_lf_im(meta, data_array, sample_times)
+
+    if sample_times.size:
+        products['end_time'] = float(sample_times.max())
+    products['description'] = description.getvalue()
+    return products
+
+
+def find_event_files(rec_path, bin_file):
+    event_glob = f'{bin_file.stem}*.txt'
+    return sorted(rec_path.rglob(event_glob))
+
+
+# Identify the inputs to summarize_file, for naming its cache file.
+def summary_cache_key(rec_path, bin_file, start_time, duration, samp_per_chunk):
+    parts = [bin_file.absolute(), start_time, duration, samp_per_chunk]
+    if not samp_per_chunk:
+        # The default chunk size depends on the memory budget.
+        parts.append(blocks.memory_budget_bytes)
+    for identity_file in [bin_file.with_suffix('.meta')] + find_event_files(rec_path, bin_file):
+        stat = identity_file.stat()
+        parts += [identity_file.name, stat.st_size, stat.st_mtime_ns]
+    return hashlib.sha1('|'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+# Like summarize_file, but load products from cache_dir when they were
+# already computed for the same inputs, or compute and save them there.
+def cached_file_summary(rec_path, bin_file, start_time=0, duration=30, cache_dir=None, samp_per_chunk=None):
+    if cache_dir is None:
+        return summarize_file(rec_path, bin_file, start_time, duration, samp_per_chunk)
+
+    cache_path = Path(cache_dir)
+    key = summary_cache_key(rec_path, bin_file, start_time, duration, samp_per_chunk)
+    # Name cache files for the .bin file's path too, so files with the same name in different folders don't collide.
+    prefix = f'{bin_file.stem}.{hashlib.sha1(str(bin_file.absolute()).encode()).hexdigest()[:8]}.'
+    cache_file = cache_path.joinpath(f'{prefix}{key[:16]}.npz')
+    if cache_file.exists():
+        with np.load(cache_file) as cached:
+            products = {name: cached[name] for name in cached.files if not name.startswith('_')}
+            n_events = int(cached['_n_events'])
+            products['event_times'] = [products.pop(f'event_times_{index}') for index in range(n_events)]
+            products['description'] = str(cached['_description'])
+            products['end_time'] = float(cached['_end_time']) if np.isfinite(cached['_end_time']) else None
+        return products
+
+    products = summarize_file(rec_path, bin_file, start_time, duration, samp_per_chunk)
+    arrays = {name: value for (name, value) in products.items() if name.endswith(('_wave', '_waves', '_times')) and name != 'event_times'}
+    arrays.update({f'event_times_{index}': times for (index, times) in enumerate(products['event_times'])})
+    arrays['_n_events'] = np.array(len(products['event_times']))
+    arrays['_description'] = np.array(products['description'])
+    arrays['_end_time'] = np.array(np.nan if products['end_time'] is None else products['end_time'])
+
+    # Write to a temp file first, so an interrupted run doesn't leave a partial cache file.
+    cache_path.mkdir(parents=True, exist_ok=True)
+    temp_file = cache_file.with_suffix('.partial.npz')
+    np.savez_compressed(temp_file, **arrays)
+    os.replace(temp_file, cache_file)
+
+    # Remove cache files for older versions of this .bin file, or other parameters.
+    for stale_file in cache_path.glob(glob.escape(prefix) + '*.npz'):
+        if stale_file != cache_file and not stale_file.name.endswith('.partial.npz'):
+            stale_file.unlink(missing_ok=True)
+    return products
+
+
 def describe_ni(meta, bin_file):
     print(f'\n{meta["typeThis"]} {meta["niDev1ProductName"]}: {bin_file.name}')
 
@@ -186,26 +271,26 @@ def describe_im(meta, bin_file):
     print(f'User notes: {meta["userNotes"]}')
 
 
-def read_data_ni(meta, bin_file, start_time = 0, duration = None):
+def read_data_ni(meta, bin_file, start_time = 0, duration = None, samp_per_chunk = None, chan_list = None):
     if duration == None or not np.isfinite(duration):
         duration = float(meta["fileTimeSecs"]) - start_time
 
     sample_rate = float(meta["niSampRate"])
     samp_0 = int(np.floor(start_time * sample_rate))
     n_samp = int(np.ceil(duration * sample_rate))
-    [data_array, data_indices] = datafile_ben.read_bin_ben(samp_0, n_samp, meta, bin_file)
+    [data_array, data_indices] = datafile_ben.read_bin_ben(samp_0, n_samp, meta, bin_file, samp_per_chunk, chan_list=chan_list)
     sample_times = data_indices / sample_rate;
     return(data_array, sample_times)
 
 
-def read_data_im(meta, bin_file, start_time = 0, duration = None):
+def read_data_im(meta, bin_file, start_time = 0, duration = None, samp_per_chunk = None, chan_list = None):
     if duration == None or not np.isfinite(duration):
         duration = float(meta["fileTimeSecs"]) - start_time
 
     sample_rate = float(meta["imSampRate"])
     samp_0 = int(np.floor(start_time * sample_rate))
     n_samp = int(np.ceil(duration * sample_rate))
-    [data_array, data_indices] = datafile_ben.read_bin_ben(samp_0, n_samp, meta, bin_file)
+    [data_array, data_indices] = datafile_ben.read_bin_ben(samp_0, n_samp, meta, bin_file, samp_per_chunk, chan_list=chan_list)
     sample_times = data_indices / sample_rate;
     return(data_array, sample_times)
 
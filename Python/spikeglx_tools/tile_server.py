@@ -0,0 +1,290 @@
+# Serve min/max tiles of SpikeGLX recordings over local HTTP, for browsing in a viewer.
+#
+# This lets lab members browse big recordings from a laptop without copying
+# them.  The server finds .bin files under the given folders and serves
+# tiles from a window_service.WindowService decimation pyramid: at each zoom
+# level, tile i holds the mins and maxes of tile_chunks consecutive chunks of
+# samples, for all channels.
+#
+# At startup the server precomputes the coarsest levels of each file's
+# pyramid, as many as fit in half of the tile cache, in the background.
+# Those are the tiles a viewer asks for first, and each one spans much of
+# the file, so computing one on request would mean a long wait.  Finer
+# levels are computed on first request and cached: each covers little of
+# the file, so is quick to compute, and all of level 0 is 1/16 the size of
+# the recording, too big to keep for long recordings.
+#
+# Routes:
+#   /files                                 -- JSON list of files and pyramid parameters
+#   /tiles/<file>/<level>/<index>.bin      -- compact binary tile
+#   /tiles/<file>/<level>/<index>.png      -- grayscale PNG of peak-to-peak amplitude
+#
+# Tile routes take an optional chans query parameter, in the style of
+# snsSaveChanSubset, like ?chans=0:383,768.  PNG tiles take an optional
+# scale parameter, the peak-to-peak amplitude in raw units that maps to
+# white.  By default it's the 99th percentile of the tile.
+#
+# Binary tiles start with a 24-byte little-endian header:
+#   magic b'SGT1', uint32 n_chan, uint32 n_values, uint32 samp_per_chunk, int64 samp_0
+# followed by int16 values [n_chan, n_values] in C order, with the min and
+# max of each chunk adjacent, as in read_bin_ben.  Convert to volts with the
+# per-channel convs listed in /files.
+#
+# Tiles never change for a given file, so responses have strong ETags based
+# on the file's size and modification time, and requests with a matching
+# If-None-Match get 304 Not Modified.
+#
+# Malformed requests, or requests for tiles that don't exist, get 404 Not
+# Found.  Any other error gets 500 Internal Server Error, with the
+# traceback printed to stderr.
+#
+# Browsers only let pages from other origins read the responses if the
+# server is started with --allow-origin, like --allow-origin
+# http://localhost:3000, which is sent as Access-Control-Allow-Origin.
+#
+# From the command line, serving on localhost:
+#   python -m spikeglx_tools.tile_server path/to/recordings --port 8080
+
+import argparse
+import asyncio
+import hashlib
+import json
+import struct
+import sys
+import threading
+import traceback
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+
+from . import datafile
+from .verify import find_bin_files
+from .window_service import WindowService
+
+tile_header_format = '<4sIIIq'
+
+
+def png_bytes(gray):
+    """ Encode a uint8 array [height, width] as a grayscale PNG, with only the standard library."""
+    (height, width) = gray.shape
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    # Each row starts with filter type 0 (none).
+    rows = np.zeros((height, width + 1), dtype='uint8')
+    rows[:, 1:] = gray
+    header = struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(rows.tobytes(), 6)) + chunk(b'IEND', b'')
+
+
+def tile_png(values, scale=None):
+    """ Render a tile's peak-to-peak amplitude as gray levels, one row per channel and one column per chunk."""
+    peak_to_peak = values[:, 1::2].astype('float32') - values[:, 0::2]
+    if not scale:
+        scale = max(float(np.percentile(peak_to_peak, 99)), 1.0) if peak_to_peak.size else 1.0
+    gray = np.clip(peak_to_peak * (255 / scale), 0, 255).astype('uint8')
+    return png_bytes(gray)
+
+
+def tile_bin(values, samp_per_chunk, samp_0):
+    """ Pack a tile as the binary format described above."""
+    (n_chan, n_values) = values.shape
+    header = struct.pack(tile_header_format, b'SGT1', n_chan, n_values, samp_per_chunk, samp_0)
+    return header + np.ascontiguousarray(values, dtype='<i2').tobytes()
+
+
+def etag_matches(if_none_match, etag):
+    """ Check an If-None-Match header against an ETag, comparing each listed tag exactly, ignoring weak W/ prefixes."""
+    if if_none_match.strip() == '*':
+        return True
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return any(tag.removeprefix('W/') == etag for tag in tags)
+
+
+class TileServer():
+    """ Tiles for a list of .bin files, from a WindowService running on its own event loop thread."""
+
+    def __init__(self, bin_files, n_workers=4, cache_bytes=None):
+        self.bin_files = list(bin_files)
+        self.service = WindowService(n_workers=n_workers, cache_bytes=cache_bytes)
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.loop_thread.start()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.service.close()
+
+    def file_list(self):
+        files = []
+        for (file_id, bin_file) in enumerate(self.bin_files):
+            info = self.service.open(bin_file)
+            files.append({
+                'id': file_id,
+                'name': bin_file.name,
+                'n_chan': info['n_chan'],
+                'n_samp': info['n_file_samp'],
+                'sample_rate': info['sample_rate'],
+                'n_levels': info['n_levels'],
+                'samp_per_chunk': [self.service.samp_per_chunk(level) for level in range(info['n_levels'])],
+                'tile_chunks': self.service.tile_chunks,
+                'convs': info['convs'].tolist(),
+            })
+        return files
+
+    def etag(self, file_id, level, index, fmt, query):
+        """ Make a strong ETag from the file's identity and everything that affects the tile's bytes."""
+        stat = self.bin_files[file_id].stat()
+        parts = [self.bin_files[file_id].absolute(), stat.st_size, stat.st_mtime_ns, level, index, fmt,
+                 self.service.base_samp_per_chunk, self.service.zoom_factor, self.service.tile_chunks,
+                 query.get('chans', [''])[0], query.get('scale', [''])[0]]
+        return '"' + hashlib.sha1('|'.join(str(part) for part in parts).encode()).hexdigest() + '"'
+
+    def precompute(self, max_bytes=None):
+        """ Start precomputing the coarse levels of each file's pyramid, on the event loop.
+
+        The max_bytes keyword arg is the total size of precomputed tiles, by
+        default half the tile cache, shared evenly between files.  Returns a
+        concurrent.futures.Future with a list of the levels precomputed for
+        each file.
+        """
+        if max_bytes is None:
+            max_bytes = self.service.cache.max_bytes // 2
+        file_bytes = max_bytes // max(len(self.bin_files), 1)
+
+        async def run():
+            return [await self.service.precompute(bin_file, file_bytes) for bin_file in self.bin_files]
+
+        return asyncio.run_coroutine_threadsafe(run(), self.loop)
+
+    def parse_tile(self, file_id, level, index, fmt, query):
+        """ Check that a tile exists, and parse its query parameters, returning (chans, scale).
+
+        Raises KeyError, ValueError, or IndexError for bad requests.
+        """
+        if fmt not in ('bin', 'png') or not 0 <= file_id < len(self.bin_files):
+            raise KeyError(f'No file {file_id} or format {fmt}')
+        info = self.service.open(self.bin_files[file_id])
+        if level < 0 or level >= info['n_levels'] or index < 0 or index * self.service.tile_chunks * self.service.samp_per_chunk(level) >= info['n_file_samp']:
+            raise KeyError(f'No tile {level}/{index}')
+        chans = None
+        if 'chans' in query:
+            chans = np.asarray(datafile.OriginalChans({'snsSaveChanSubset': query['chans'][0], 'nSavedChans': info['n_chan']}))
+            if chans.size and (chans.min() < 0 or chans.max() >= info['n_chan']):
+                raise IndexError(f'Channels {query["chans"][0]} out of range for {info["n_chan"]} channels')
+        scale = float(query['scale'][0]) if 'scale' in query else None
+        return (chans, scale)
+
+    def tile(self, file_id, level, index, fmt, chans=None, scale=None):
+        """ Return the body and content type for one tile, with arguments checked by parse_tile()."""
+        info = self.service.open(self.bin_files[file_id])
+        future = asyncio.run_coroutine_threadsafe(self.service.tile(info, level, index), self.loop)
+        values = future.result()
+        if chans is not None:
+            values = values[chans, :]
+
+        samp_per_chunk = self.service.samp_per_chunk(level)
+        if fmt == 'png':
+            return (tile_png(values, scale), 'image/png')
+        samp_0 = index * self.service.tile_chunks * samp_per_chunk
+        return (tile_bin(values, samp_per_chunk, samp_0), 'application/octet-stream')
+
+
+def make_handler(tile_server, allow_origin=None):
+    """ Make a request handler class bound to a TileServer.
+
+    The allow_origin keyword arg is sent as Access-Control-Allow-Origin, to
+    let pages from that origin read responses.  By default it isn't sent.
+    """
+
+    class TileHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            parts = [part for part in url.path.split('/') if part]
+            query = parse_qs(url.query)
+            try:
+                if parts == ['files']:
+                    tile_args = None
+                elif len(parts) == 4 and parts[0] == 'tiles' and '.' in parts[3]:
+                    (index, fmt) = parts[3].split('.', maxsplit=1)
+                    (file_id, level, index) = (int(parts[1]), int(parts[2]), int(index))
+                    (chans, scale) = tile_server.parse_tile(file_id, level, index, fmt, query)
+                    tile_args = (file_id, level, index, fmt, chans, scale)
+                else:
+                    raise KeyError(self.path)
+            except (KeyError, ValueError, IndexError) as e:
+                self.respond(404, str(e).encode(), 'text/plain')
+                return
+
+            try:
+                if tile_args is None:
+                    body = json.dumps(tile_server.file_list()).encode()
+                    self.respond(200, body, 'application/json')
+                    return
+                etag = tile_server.etag(file_id, level, index, fmt, query)
+                if etag_matches(self.headers.get('If-None-Match', ''), etag):
+                    self.respond(304, b'', None, etag)
+                    return
+                (body, content_type) = tile_server.tile(*tile_args)
+            except Exception as e:
+                traceback.print_exc()
+                self.respond(500, f'Internal server error: {type(e).__name__}'.encode(), 'text/plain')
+                return
+            self.respond(200, body, content_type, etag)
+
+        def respond(self, status, body, content_type, etag=None):
+            self.send_response(status)
+            if content_type:
+                self.send_header('Content-Type', content_type)
+            if etag:
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', 'public, max-age=86400')
+            if allow_origin:
+                self.send_header('Access-Control-Allow-Origin', allow_origin)
+                self.send_header('Vary', 'Origin')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return TileHandler
+
+
+def serve(paths, host='127.0.0.1', port=8080, n_workers=4, allow_origin=None, precompute=True):
+    """ Serve tiles for .bin files found under the given paths, until interrupted."""
+    bin_files = find_bin_files(paths)
+    tile_server = TileServer(bin_files, n_workers=n_workers)
+    if precompute:
+        tile_server.precompute()
+    httpd = ThreadingHTTPServer((host, port), make_handler(tile_server, allow_origin))
+    print(f'Serving tiles for {len(bin_files)} .bin files at http://{host}:{httpd.server_port}/files')
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        tile_server.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve min/max tiles of SpikeGLX .bin files over local HTTP.')
+    parser.add_argument('paths', nargs='+', help='.bin files or folders to search for .bin files')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on')
+    parser.add_argument('--workers', type=int, default=4, help='threads for computing tiles')
+    parser.add_argument('--allow-origin', help='origin allowed to read responses from a browser, like http://localhost:3000')
+    parser.add_argument('--no-precompute', action='store_true', help='compute all tiles on first request, rather than the coarse ones at startup')
+    args = parser.parse_args(argv)
+    serve(args.paths, args.host, args.port, args.workers, args.allow_origin, not args.no_precompute)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
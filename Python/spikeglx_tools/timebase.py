@@ -0,0 +1,228 @@
+# Map times between the clocks of different SpikeGLX streams in the same run.
+#
+# Each stream (nidq, imec0, imec1, ...) has its own sample clock, and as
+# try_tprime shows, these drift apart by about a sample period over a
+# session.  All streams record the same sync pulses, though, so matching
+# sync edges between a stream and a reference stream gives a piecewise-linear
+# mapping between their clocks -- the same idea as TPrime.
+#
+# Times here are "run times": seconds since the start of the run in a
+# stream's own clock, computed as (firstSample + sample) / sample rate.
+#
+# Sync edges are extracted from the sync channel given in the .meta, reading
+# just that channel with channel_major.read_channels, which uses a
+# channel-major copy of the file when one exists.  Edges are cached per
+# file, and TimeBase objects are cached per set of files, so repeated
+# queries for the same run don't re-read anything.  Both caches are keyed by
+# the size and modification time of the files, so rewritten files are read
+# again.
+
+from pathlib import Path
+import numpy as np
+
+from . import datafile
+from . import blocks
+from .channel_major import read_channels
+from .datafile_ben import chan_conv_factors
+
+_edge_cache = {}
+_time_base_cache = {}
+
+# Read the sync channel in pieces of this many samples.
+sync_samp_per_read = 16 * 1024 * 1024
+
+
+def stream_name(bin_file):
+    """ Return a stream name like 'nidq' or 'imec0.ap' from a .bin file name like 'rec_g0_t0.imec0.ap.bin'."""
+    parts = Path(bin_file).stem.split('.', maxsplit=1)
+    return parts[1] if len(parts) > 1 else parts[0]
+
+
+def sync_channel(meta):
+    """ Return (channel, bit, threshold) for reading the sync signal of a stream.
+
+    For digital sync, bit is the line within the 16-bit word and threshold is None.
+    For NI analog sync, bit is None and threshold is in raw units.
+    """
+    if meta['typeThis'] == 'imec':
+        (AP, LF, _) = datafile.ChannelCountsIM(meta)
+        return (AP + LF, 6, None)
+
+    (MN, MA, XA, _) = datafile.ChannelCountsNI(meta)
+    sync_ni_chan = int(meta['syncNiChan'])
+    if int(meta['syncNiChanType']) == 0:
+        return (MN + MA + XA + sync_ni_chan // 16, sync_ni_chan % 16, None)
+    else:
+        channel = MN + MA + sync_ni_chan
+        threshold_volts = float(meta.get('syncNiThresh', 1.1))
+        threshold = threshold_volts / chan_conv_factors([channel], meta)[0]
+        return (channel, None, threshold)
+
+
+def sync_edges(bin_file, meta=None):
+    """ Return rising edge sample numbers of the sync signal in a .bin file.
+
+    Results are cached per file, keyed by path, size, and modification time.
+    """
+    bin_path = Path(bin_file)
+    stat = bin_path.stat()
+    key = (str(bin_path.absolute()), stat.st_size, stat.st_mtime_ns)
+    if key in _edge_cache:
+        return _edge_cache[key]
+
+    if meta is None:
+        meta = datafile.readMeta(bin_path)
+    (channel, bit, threshold) = sync_channel(meta)
+    (_, n_file_samp) = blocks.file_shape(meta)
+
+    edges = []
+    previous = None
+    for samp_0 in range(0, n_file_samp, sync_samp_per_read):
+        raw = read_channels(bin_path, meta, [channel], samp_0, sync_samp_per_read)[0]
+        if bit is not None:
+            high = (raw.view('uint16') >> bit) & 1
+        else:
+            high = (raw > threshold).astype('uint16')
+        high = high.astype('int8')
+        if previous is None:
+            previous = high[0]
+        steps = np.diff(high, prepend=previous)
+        edges.append(np.flatnonzero(steps > 0) + samp_0)
+        previous = high[-1]
+
+    edges = np.concatenate(edges) if edges else np.zeros(0, dtype='int64')
+    _edge_cache[key] = edges
+    return edges
+
+
+def match_edges(times, reference_times, sync_period=1.0):
+    """ Pair up edges with the nearest reference edge within half a sync period.
+
+    Returns (times, reference_times) arrays of matched pairs, in order.
+    """
+    if not len(times) or not len(reference_times):
+        return (np.zeros(0), np.zeros(0))
+    nearest = np.clip(np.searchsorted(reference_times, times), 1, len(reference_times) - 1)
+    before = reference_times[nearest - 1]
+    after = reference_times[nearest]
+    nearest = np.where(np.abs(times - before) <= np.abs(times - after), nearest - 1, nearest)
+    differences = np.abs(times - reference_times[nearest])
+    matched = differences < sync_period / 2
+    # Keep one match per reference edge.
+    (_, first) = np.unique(nearest[matched], return_index=True)
+    return (times[matched][first], reference_times[nearest[matched]][first])
+
+
+def piecewise_linear(x, xp, fp):
+    """ Like np.interp, but extrapolate beyond the ends using the first and last segments."""
+    x = np.asarray(x, dtype='float64')
+    if len(xp) < 2:
+        offset = fp[0] - xp[0] if len(xp) else 0.0
+        return x + offset
+    y = np.interp(x, xp, fp)
+    before = x < xp[0]
+    after = x > xp[-1]
+    y[before] = fp[0] + (x[before] - xp[0]) * (fp[1] - fp[0]) / (xp[1] - xp[0])
+    y[after] = fp[-1] + (x[after] - xp[-1]) * (fp[-1] - fp[-2]) / (xp[-1] - xp[-2])
+    return y
+
+
+class TimeBase():
+    """ Piecewise-linear clock mappings between the streams of one run.
+
+    Create with a list of .bin files from the same run, and optionally the
+    name of the reference stream (by default the first imec stream, or the
+    first stream).  Stream names come from stream_name(), like 'imec0.ap'.
+    """
+
+    def __init__(self, bin_files, reference=None, sync_period=1.0):
+        self.sync_period = sync_period
+        self.streams = {}
+        for bin_file in bin_files:
+            meta = datafile.readMeta(Path(bin_file))
+            sample_rate = datafile.SampRate(meta)
+            first_sample = int(meta.get('firstSample', 0))
+            edges = sync_edges(bin_file, meta)
+            self.streams[stream_name(bin_file)] = {
+                'bin_file': Path(bin_file),
+                'meta': meta,
+                'sample_rate': sample_rate,
+                'first_sample': first_sample,
+                'edge_times': (first_sample + edges) / sample_rate,
+            }
+
+        if reference is None:
+            imec_names = [name for name in self.streams if name.startswith('imec')]
+            reference = imec_names[0] if imec_names else next(iter(self.streams))
+        self.reference = reference
+
+        reference_times = self.streams[reference]['edge_times']
+        for stream in self.streams.values():
+            (stream['matched'], stream['matched_reference']) = match_edges(stream['edge_times'], reference_times, sync_period)
+
+    def to_reference(self, stream, times):
+        """ Convert run times in the given stream's clock to the reference clock."""
+        info = self.streams[stream]
+        return piecewise_linear(times, info['matched'], info['matched_reference'])
+
+    def from_reference(self, stream, times):
+        """ Convert run times in the reference clock to the given stream's clock."""
+        info = self.streams[stream]
+        return piecewise_linear(times, info['matched_reference'], info['matched'])
+
+    def sample_ranges(self, stream, t0, t1):
+        """ Convert windows [t0, t1) in the reference clock to (samp_0, n_samp) arrays in a stream's file.
+
+        t0 and t1 may be scalars or arrays of many windows.  Samples are
+        relative to the start of the stream's .bin file and may extend past
+        its ends, so callers should clip as needed.
+        """
+        info = self.streams[stream]
+        first = np.floor(self.from_reference(stream, np.atleast_1d(t0)) * info['sample_rate']).astype('int64')
+        last = np.ceil(self.from_reference(stream, np.atleast_1d(t1)) * info['sample_rate']).astype('int64')
+        samp_0 = first - info['first_sample']
+        return (samp_0, np.maximum(last - first, 0))
+
+    def read_windows(self, t0, t1, streams=None, chan_lists=None):
+        """ Read raw data for windows in the reference clock, from each stream.
+
+        Returns a dict keyed by stream name, with a list of (samp_0, data)
+        pairs per window.  Each data array is [n_chan, n_samp], clipped to
+        the file.  The chan_lists keyword arg can be a dict of saved-channel
+        lists keyed by stream name.  Streams without a channel list get views
+        of the stream's memmap, and streams with one get copies of just
+        those channels.
+        """
+        if streams is None:
+            streams = list(self.streams.keys())
+        results = {}
+        for stream in streams:
+            info = self.streams[stream]
+            raw_data = blocks.memmap_bin(info['bin_file'], info['meta'])
+            n_file_samp = raw_data.shape[1]
+            chans = slice(None) if not chan_lists or stream not in chan_lists else chan_lists[stream]
+            (samp_0s, n_samps) = self.sample_ranges(stream, t0, t1)
+            windows = []
+            for (samp_0, n_samp) in zip(samp_0s, n_samps):
+                first = int(np.clip(samp_0, 0, n_file_samp))
+                last = int(np.clip(samp_0 + n_samp, 0, n_file_samp))
+                windows.append((first, raw_data[chans, first:last]))
+            results[stream] = windows
+        return results
+
+
+def time_base_for(bin_files, reference=None, sync_period=1.0):
+    """ Return a cached TimeBase for the given .bin files, building it if needed.
+
+    The cache is keyed by the path, size, and modification time of each
+    .bin and .meta file, so a changed file builds a new TimeBase.
+    """
+    identities = []
+    for bin_file in bin_files:
+        for path in [Path(bin_file), Path(bin_file).with_suffix('.meta')]:
+            stat = path.stat()
+            identities.append((str(path.absolute()), stat.st_size, stat.st_mtime_ns))
+    key = (tuple(identities), reference, sync_period)
+    if key not in _time_base_cache:
+        _time_base_cache[key] = TimeBase(bin_files, reference, sync_period)
+    return _time_base_cache[key]
@@ -0,0 +1,201 @@
+# Verify SpikeGLX .bin files against the fileSizeBytes and fileSHA1 in their .meta.
+#
+# SpikeGLX records the expected size and SHA1 hash of each .bin file in
+# the .meta.  Checking these catches truncated or corrupted copies, which
+# makeMemMapRaw would otherwise map with the wrong shape.  The readers in
+# blocks.py only check the size, as they open each file.
+#
+# Files are hashed with large reads into one reusable buffer.  Files on
+# different disks are checked concurrently, while files on the same disk
+# are checked one at a time to keep each disk reading sequentially.
+#
+# The same check can ride along with any other full pass over a file,
+# using Sha1Consumer with pipeline.run_pipeline.
+#
+# From the command line:
+#   python -m spikeglx_tools.verify path/to/recordings [more paths ...]
+
+import argparse
+import hashlib
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from . import datafile
+from .pipeline import BlockConsumer
+
+default_buffer_bytes = 16 * 1024 * 1024
+
+
+def check_results(bin_file, meta, actual_size, sha1, seconds):
+    """ Compare size and hash with expected values from meta, and return a results dict."""
+    expected_size = int(meta['fileSizeBytes']) if 'fileSizeBytes' in meta else None
+    expected_sha1 = meta.get('fileSHA1', '').upper() or None
+    size_ok = expected_size is not None and expected_size == actual_size
+    sha1_ok = expected_sha1 is not None and expected_sha1 == sha1
+    return {
+        'bin_file': str(bin_file),
+        'expected_size': expected_size,
+        'actual_size': actual_size,
+        'size_ok': size_ok,
+        'expected_sha1': expected_sha1,
+        'sha1': sha1,
+        'sha1_ok': sha1_ok,
+        'ok': size_ok and sha1_ok,
+        'seconds': seconds,
+        'mb_per_sec': actual_size / 1e6 / seconds if seconds > 0 else float('inf'),
+    }
+
+
+def verify_bin(bin_file, meta=None, buffer_bytes=default_buffer_bytes, progress_secs=5.0):
+    """ Check one .bin file's size and SHA1 against its .meta.
+
+    Returns a dict of results including 'ok', 'size_ok', and 'sha1_ok', and
+    the throughput achieved in 'mb_per_sec'.
+
+    The progress_secs keyword arg sets how often to print progress while
+    hashing a big file.  Pass None to hash quietly.
+    """
+    bin_path = Path(bin_file)
+    if meta is None:
+        meta = datafile.readMeta(bin_path)
+
+    actual_size = bin_path.stat().st_size
+    hasher = hashlib.sha1()
+    buffer = bytearray(buffer_bytes)
+    view = memoryview(buffer)
+
+    start = time.perf_counter()
+    last_report = start
+    n_read = 0
+    with open(bin_path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            hasher.update(view[:n])
+            n_read += n
+            now = time.perf_counter()
+            if progress_secs and now - last_report >= progress_secs:
+                print(f'{bin_path.name}: {100 * n_read / max(actual_size, 1):.1f}% at {n_read / 1e6 / (now - start):.1f} MB/s')
+                last_report = now
+
+    seconds = time.perf_counter() - start
+    return check_results(bin_path, meta, n_read, hasher.hexdigest().upper(), seconds)
+
+
+def print_result(result):
+    if result['ok']:
+        status = 'OK'
+    elif not result['size_ok']:
+        status = f'SIZE MISMATCH (expected {result["expected_size"]}, found {result["actual_size"]})'
+    else:
+        status = f'SHA1 MISMATCH (expected {result["expected_sha1"]}, found {result["sha1"]})'
+    print(f'{status}: {result["bin_file"]} ({result["mb_per_sec"]:.1f} MB/s)')
+
+
+def verify_bins(bin_files, buffer_bytes=default_buffer_bytes, files_per_disk=1, progress_secs=5.0):
+    """ Check many .bin files, concurrently across disks.
+
+    Files are grouped by the device they live on.  Each device gets
+    files_per_disk worker threads, so different disks are read in parallel
+    without thrashing any one disk.
+
+    Returns a list of result dicts from verify_bin(), in the same order as bin_files.
+    """
+    bin_files = [Path(bin_file) for bin_file in bin_files]
+    by_disk = {}
+    for index, bin_file in enumerate(bin_files):
+        device = bin_file.stat().st_dev
+        by_disk.setdefault(device, []).append(index)
+
+    def verify_disk_files(indices):
+        return [(index, verify_bin(bin_files[index], buffer_bytes=buffer_bytes, progress_secs=progress_secs)) for index in indices]
+
+    # Split each disk's files among its workers.
+    work = []
+    for indices in by_disk.values():
+        for worker in range(files_per_disk):
+            if indices[worker::files_per_disk]:
+                work.append(indices[worker::files_per_disk])
+
+    start = time.perf_counter()
+    results = [None] * len(bin_files)
+    with ThreadPoolExecutor(max_workers=max(len(work), 1)) as executor:
+        for worker_results in executor.map(verify_disk_files, work):
+            for (index, result) in worker_results:
+                results[index] = result
+                print_result(result)
+
+    seconds = time.perf_counter() - start
+    total_bytes = sum(result['actual_size'] for result in results)
+    if seconds > 0:
+        print(f'Checked {len(results)} files, {total_bytes / 1e6:.1f} MB in {seconds:.2f}s ({total_bytes / 1e6 / seconds:.1f} MB/s) across {len(by_disk)} disks')
+    return results
+
+
+class Sha1Consumer(BlockConsumer):
+    """ Check size and SHA1 as part of a full pass in pipeline.run_pipeline.
+
+    The pipeline must cover the whole file for the hash to be meaningful.
+    Returns the same results dict as verify_bin().
+    """
+
+    def __init__(self, bin_file):
+        self.bin_file = bin_file
+        self.hasher = hashlib.sha1()
+        self.n_bytes = 0
+
+    def start(self, meta, n_chan, samp_0, n_samp):
+        self.meta = meta
+        if samp_0 != 0 or n_samp * n_chan * 2 != int(meta['fileSizeBytes']):
+            print(f'Sha1Consumer: pipeline covers only part of {self.bin_file}, SHA1 will not match.')
+        self.start_time = time.perf_counter()
+
+    def consume(self, block_samp_0, block):
+        # Blocks are [n_chan, n_samp] in Fortran order, so the transpose is file order.
+        self.hasher.update(block.T)
+        self.n_bytes += block.nbytes
+
+    def finish(self):
+        # Include any trailing partial sample, which is not part of any block.
+        actual_size = Path(self.bin_file).stat().st_size
+        if actual_size > self.n_bytes:
+            with open(self.bin_file, 'rb') as f:
+                f.seek(self.n_bytes)
+                self.hasher.update(f.read())
+        seconds = time.perf_counter() - self.start_time
+        return check_results(self.bin_file, self.meta, actual_size, self.hasher.hexdigest().upper(), seconds)
+
+
+def find_bin_files(paths, bin_glob='*.bin'):
+    bin_files = []
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            bin_files = bin_files + sorted(path.rglob(bin_glob))
+        else:
+            bin_files.append(path)
+    return bin_files
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Verify SpikeGLX .bin files against fileSizeBytes and fileSHA1 in their .meta.')
+    parser.add_argument('paths', nargs='+', help='.bin files or folders to search for .bin files')
+    parser.add_argument('--files-per-disk', type=int, default=1, help='concurrent files to check per disk')
+    parser.add_argument('--buffer-mb', type=int, default=default_buffer_bytes // (1024 * 1024), help='read buffer size in MB')
+    args = parser.parse_args(argv)
+
+    bin_files = find_bin_files(args.paths)
+    print(f'Verifying {len(bin_files)} .bin files')
+    results = verify_bins(bin_files, buffer_bytes=args.buffer_mb * 1024 * 1024, files_per_disk=args.files_per_disk)
+    failures = [result for result in results if not result['ok']]
+    if failures:
+        print(f'{len(failures)} of {len(results)} files failed verification')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,132 @@
+# Estimate channel covariance and a whitening matrix from imec AP data.
+#
+# Loading minutes of AP data into RAM as float64 (like GainCorrectIM output)
+# just to compute a covariance matrix is wasteful.  Instead, this reads a
+# set of blocks spread across the recording, filters each one, and adds its
+# float32 outer product (a BLAS matrix multiply) into a float64 running sum.
+# Memory is bounded by n_chan^2 plus one block, whatever the recording length.
+#
+# The whitening matrix can be global (ZCA over all channels), or local: each
+# channel whitened using only its nearest neighbors on the probe, from
+# snsShankMap or snsGeomMap.  This is the same idea as Kilosort's local
+# whitening.
+
+import numpy as np
+
+from . import datafile
+from . import blocks
+from . import geometry
+from .filters import fir_taps, fir_valid, common_average_reference
+from .export import read_with_margin
+from .datafile_ben import chan_conv_factors
+
+
+def sample_block_starts(n_file_samp, samp_per_block, n_blocks, sampling='strided', seed=0):
+    """ Choose start samples for n_blocks non-overlapping blocks spread across a file."""
+    n_available = max(n_file_samp // samp_per_block, 1)
+    n_blocks = min(n_blocks, n_available)
+    if sampling == 'random':
+        rng = np.random.default_rng(seed)
+        slots = np.sort(rng.choice(n_available, n_blocks, replace=False))
+    else:
+        slots = np.linspace(0, n_available - 1, n_blocks).round().astype('int64')
+    return slots * samp_per_block
+
+
+def channel_covariance(bin_file, meta, chan_list=None, band=(300.0, 6000.0), car=None,
+                       n_blocks=50, block_secs=1.0, sampling='strided', seed=0):
+    """ Estimate the covariance between channels of filtered data, streaming over sample blocks.
+
+    The chan_list keyword arg selects saved-channel indices, by default all
+    AP channels from ChannelCountsIM.
+
+    The band keyword arg is the (low, high) band-pass in Hz, or None for raw data.
+    The car keyword arg can be 'median' or 'mean' to re-reference first.
+
+    The n_blocks and block_secs keyword args say how much data to use.
+    The sampling keyword arg is 'strided' for evenly spaced blocks, or
+    'random' for randomly chosen blocks using the given seed.
+
+    Returns a dict with:
+    - 'cov' -- covariance in raw ADC units squared, [n_chan, n_chan]
+    - 'cov_volts' -- covariance in volts squared
+    - 'mean' -- mean of each channel in raw units
+    - 'n_samp' -- number of samples used
+    - 'chan_list' -- the channels used
+    """
+    if chan_list is None:
+        (AP, _, _) = datafile.ChannelCountsIM(meta)
+        chan_list = range(AP)
+    chan_list = np.asarray(chan_list, dtype='int64')
+    n_chan = len(chan_list)
+
+    sample_rate = datafile.SampRate(meta)
+    if band is not None:
+        taps = fir_taps(sample_rate, band[0], band[1])
+        margin = (len(taps) - 1) // 2
+    else:
+        taps = None
+        margin = 0
+
+    (_, n_file_samp) = blocks.file_shape(meta)
+    samp_per_block = max(1, min(int(block_secs * sample_rate), n_file_samp))
+    starts = sample_block_starts(n_file_samp, samp_per_block, n_blocks, sampling, seed)
+
+    raw_data = blocks.memmap_bin(bin_file, meta)
+    outer_sum = np.zeros((n_chan, n_chan), dtype='float64')
+    value_sum = np.zeros(n_chan, dtype='float64')
+    n_samp = 0
+    for block_samp_0 in starts:
+        block_samp_end = min(block_samp_0 + samp_per_block, n_file_samp)
+        data = read_with_margin(raw_data, chan_list, block_samp_0, block_samp_end, margin)
+        if taps is not None:
+            filtered = fir_valid(data, taps)
+        else:
+            filtered = data.astype('float32')
+        if car:
+            filtered = common_average_reference(filtered, use_median=(car == 'median'))
+        outer_sum += filtered @ filtered.T
+        value_sum += filtered.sum(axis=1, dtype='float64')
+        n_samp += filtered.shape[1]
+
+    mean = value_sum / max(n_samp, 1)
+    cov = (outer_sum - n_samp * np.outer(mean, mean)) / max(n_samp - 1, 1)
+    convs = chan_conv_factors(chan_list, meta)
+    return {
+        'cov': cov,
+        'cov_volts': cov * np.outer(convs, convs),
+        'mean': mean,
+        'n_samp': n_samp,
+        'chan_list': chan_list,
+    }
+
+
+def zca_whitening(cov, epsilon=1e-6):
+    """ Return the symmetric (ZCA) whitening matrix for a covariance matrix.
+
+    epsilon is added to the eigenvalues, relative to their mean, for stability.
+    """
+    (eigenvalues, eigenvectors) = np.linalg.eigh(cov)
+    eigenvalues = np.maximum(eigenvalues, 0) + epsilon * max(eigenvalues.mean(), np.finfo('float64').tiny)
+    return (eigenvectors / np.sqrt(eigenvalues)) @ eigenvectors.T
+
+
+def whitening_matrix(cov, meta=None, chan_list=None, n_neighbors=None, epsilon=1e-6):
+    """ Return a whitening matrix [n_chan, n_chan] for the given covariance.
+
+    By default, this is global ZCA whitening over all channels.
+
+    If n_neighbors is given, along with meta and chan_list to locate sites on the
+    probe, each channel's row is computed by ZCA whitening over only its
+    n_neighbors nearest sites, and is zero elsewhere.
+    """
+    if not n_neighbors:
+        return zca_whitening(cov, epsilon)
+
+    neighbors = geometry.channel_neighbors(meta, chan_list, n_neighbors)
+    whitening = np.zeros_like(cov)
+    for chan, local in enumerate(neighbors):
+        local_whitening = zca_whitening(cov[np.ix_(local, local)], epsilon)
+        # The channel itself is the first neighbor.
+        whitening[chan, local] = local_whitening[0]
+    return whitening
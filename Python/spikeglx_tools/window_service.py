@@ -0,0 +1,229 @@
+# Answer many concurrent window queries over recordings, for interactive viewers.
+#
+# A viewer asks for a window of a recording -- a file, some channels, a time
+# range, and roughly how many points it can draw.  This is an asyncio API for
+# answering lots of these queries from one process, with low latency.
+#
+# Zoomed-out queries are answered from a decimation pyramid of min/max
+# tiles, like read_bin_ben.  Level 0 has base_samp_per_chunk samples per
+# chunk, and each level above has zoom_factor times as many.  Each tile
+# holds the mins and maxes of tile_chunks consecutive chunks, for all
+# channels, as int16 raw values.  Tiles are computed lazily, the first time
+# a query needs them, and kept in a block_cache.BlockCache of their own, an
+# LRU cache with a byte budget, separate from the process-wide cache of raw
+# pieces.  A tile is combined from the tiles below it when those are
+# cached, or else computed from raw data.
+#
+# precompute() fills in the coarsest levels up front, so that the first
+# zoomed-out views of a file don't wait for a full pass over it.
+#
+# Zoomed-in queries, with fewer samples than requested points, are answered
+# with raw samples, read through the process-wide cache in block_cache.py.
+#
+# Overlapping queries are coalesced: while a tile is being computed, other
+# queries that need it wait for the same result instead of computing it again.
+# Raw reads and tile computation run on a thread pool, so the event loop
+# stays free to accept queries.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+
+from . import datafile
+from . import blocks
+from . import block_cache
+from .datafile_ben import min_max_chunks, chan_conv_factors
+
+
+class WindowService():
+    """ Asyncio API for min/max and raw window queries over .bin files.
+
+    Create one per process and await query() from any number of tasks.
+    """
+
+    def __init__(self, n_workers=4, base_samp_per_chunk=32, zoom_factor=4, tile_chunks=1024, cache_bytes=None):
+        self.base_samp_per_chunk = base_samp_per_chunk
+        self.zoom_factor = zoom_factor
+        self.tile_chunks = tile_chunks
+        self.executor = ThreadPoolExecutor(max_workers=max(n_workers, 1))
+        if cache_bytes is None:
+            cache_bytes = blocks.memory_budget_bytes // 4
+        self.cache = block_cache.BlockCache(cache_bytes)
+        self.files = {}
+        self.pending = {}
+
+    def close(self):
+        self.executor.shutdown()
+
+    def open(self, bin_file):
+        """ Return info about a .bin file, reading its .meta the first time."""
+        key = str(Path(bin_file).absolute())
+        if key not in self.files:
+            meta = datafile.readMeta(Path(bin_file))
+            (n_chan, n_file_samp) = blocks.file_shape(meta)
+            n_levels = 1
+            while self.tile_chunks * self.samp_per_chunk(n_levels - 1) < n_file_samp:
+                n_levels += 1
+            self.files[key] = {
+                'key': key,
+                'bin_file': Path(bin_file),
+                'meta': meta,
+                'n_chan': n_chan,
+                'n_file_samp': n_file_samp,
+                'sample_rate': datafile.SampRate(meta),
+                'convs': chan_conv_factors(range(n_chan), meta),
+                'n_levels': n_levels,
+            }
+        return self.files[key]
+
+    def samp_per_chunk(self, level):
+        return self.base_samp_per_chunk * self.zoom_factor ** level
+
+    def compute_tile(self, info, level, index):
+        """ Compute one tile from raw data, returning int16 [n_chan, 2 * n_chunks] with mins and maxes interleaved."""
+        samp_per_chunk = self.samp_per_chunk(level)
+        samp_0 = index * self.tile_chunks * samp_per_chunk
+        n_samp = min(self.tile_chunks * samp_per_chunk, info['n_file_samp'] - samp_0)
+        samp_per_block = max(1, blocks.samp_per_block_for(info['meta'], work_bytes=2) // samp_per_chunk) * samp_per_chunk
+        pieces = [min_max_chunks(block, block_samp_0, samp_per_chunk)[0].astype('int16')
+                  for (block_samp_0, block) in blocks.iter_blocks(info['bin_file'], info['meta'], samp_0, n_samp, samp_per_block)]
+        return np.concatenate(pieces, axis=1)
+
+    def combine_tiles(self, children):
+        """ Compute a tile from the zoom_factor tiles below it, or as many as exist."""
+        values = np.concatenate(children, axis=1)
+        starts = np.arange(0, values.shape[1] // 2, self.zoom_factor)
+        tile = np.empty((values.shape[0], 2 * len(starts)), dtype='int16')
+        tile[:, 0::2] = np.minimum.reduceat(values[:, 0::2], starts, axis=1)
+        tile[:, 1::2] = np.maximum.reduceat(values[:, 1::2], starts, axis=1)
+        return tile
+
+    def child_indices(self, info, level, index):
+        """ Return indices of the tiles at level - 1 that make up a tile, stopping at the end of the file."""
+        n_child_samp = self.tile_chunks * self.samp_per_chunk(level - 1)
+        first_child = index * self.zoom_factor
+        return [child for child in range(first_child, first_child + self.zoom_factor) if child * n_child_samp < info['n_file_samp']]
+
+    def covered(self, info, level, index):
+        """ Check whether a tile is cached or pending, or can be combined from cached tiles below it."""
+        key = (info['key'], level, index)
+        if self.cache.peek(key) is not None or key in self.pending:
+            return True
+        if level == 0:
+            return False
+        return all(self.covered(info, level - 1, child) for child in self.child_indices(info, level, index))
+
+    async def tile(self, info, level, index):
+        """ Return one tile, from the cache, from a computation already in progress, or newly computed."""
+        key = (info['key'], level, index)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        if key not in self.pending:
+            self.pending[key] = asyncio.ensure_future(self.load_tile(info, level, index))
+        return await asyncio.shield(self.pending[key])
+
+    async def load_tile(self, info, level, index):
+        key = (info['key'], level, index)
+        loop = asyncio.get_running_loop()
+        try:
+            if level > 0 and all(self.covered(info, level - 1, child) for child in self.child_indices(info, level, index)):
+                children = await asyncio.gather(*[self.tile(info, level - 1, child) for child in self.child_indices(info, level, index)])
+                tile = await loop.run_in_executor(self.executor, self.combine_tiles, children)
+            else:
+                tile = await loop.run_in_executor(self.executor, self.compute_tile, info, level, index)
+            self.cache.put(key, tile)
+            return tile
+        finally:
+            del self.pending[key]
+
+    def n_tiles(self, info, level):
+        return int(np.ceil(info['n_file_samp'] / (self.tile_chunks * self.samp_per_chunk(level))))
+
+    async def precompute(self, bin_file, max_bytes):
+        """ Compute and cache the coarsest levels of a file's pyramid whose tiles together fit in max_bytes.
+
+        The finest of these levels is computed from raw data, in one pass
+        over the file, and the coarser ones are combined from it.  Returns
+        the list of levels computed, which may be empty.
+        """
+        info = self.open(bin_file)
+        levels = []
+        n_bytes = 0
+        for level in reversed(range(info['n_levels'])):
+            n_chunks = int(np.ceil(info['n_file_samp'] / self.samp_per_chunk(level)))
+            n_bytes += 2 * n_chunks * info['n_chan'] * 2
+            if n_bytes > max_bytes:
+                break
+            levels.insert(0, level)
+        for level in levels:
+            await asyncio.gather(*[self.tile(info, level, index) for index in range(self.n_tiles(info, level))])
+        return levels
+
+    async def read_raw(self, info, chans, samp_0, samp_end):
+        """ Read raw samples through the block cache, on the thread pool."""
+        loop = asyncio.get_running_loop()
+        chan_list = None if isinstance(chans, slice) else chans
+        return await loop.run_in_executor(self.executor, block_cache.read_window, info['bin_file'], info['meta'], chan_list, samp_0, samp_end)
+
+    async def query(self, bin_file, chan_list=None, t0=0.0, t1=None, n_points=2000):
+        """ Answer one window query, with times in seconds from the start of the file.
+
+        Returns a dict with:
+        - 'samp_per_chunk' -- 1 for raw samples, or the chunk size of the pyramid level used
+        - 'level' -- the pyramid level, or None for raw samples
+        - 'samp_0' -- file sample number of the first value
+        - 'times' -- time in seconds of each value, or of the start of each chunk
+        - 'values' -- raw int16 values [n_chan, n_values], with mins and maxes interleaved for chunks
+        - 'convs' -- per-channel factors to convert values to volts
+        """
+        info = self.open(bin_file)
+        chans = slice(None) if chan_list is None else np.asarray(chan_list, dtype='int64')
+        sample_rate = info['sample_rate']
+        samp_0 = int(np.clip(np.floor(t0 * sample_rate), 0, info['n_file_samp']))
+        samp_end = info['n_file_samp'] if t1 is None else int(np.clip(np.ceil(t1 * sample_rate), samp_0, info['n_file_samp']))
+        convs = info['convs'][chans]
+
+        if samp_end - samp_0 <= n_points:
+            values = await self.read_raw(info, chans, samp_0, samp_end)
+            return {
+                'samp_per_chunk': 1,
+                'level': None,
+                'samp_0': samp_0,
+                'times': np.arange(samp_0, samp_end) / sample_rate,
+                'values': values,
+                'convs': convs,
+            }
+
+        # Choose the finest level with at most n_points values (2 per chunk) in the window.
+        level = 0
+        while level < info['n_levels'] - 1 and 2 * (samp_end - samp_0) / self.samp_per_chunk(level) > n_points:
+            level += 1
+        samp_per_chunk = self.samp_per_chunk(level)
+        chunk_0 = samp_0 // samp_per_chunk
+        chunk_end = int(np.ceil(samp_end / samp_per_chunk))
+        tile_0 = chunk_0 // self.tile_chunks
+        tile_end = (chunk_end - 1) // self.tile_chunks + 1
+
+        tiles = await asyncio.gather(*[self.tile(info, level, index) for index in range(tile_0, tile_end)])
+        offset = chunk_0 - tile_0 * self.tile_chunks
+        values = np.concatenate(tiles, axis=1)[chans, 2 * offset:2 * (offset + chunk_end - chunk_0)]
+        return {
+            'samp_per_chunk': samp_per_chunk,
+            'level': level,
+            'samp_0': chunk_0 * samp_per_chunk,
+            'times': np.arange(chunk_0, chunk_end) * samp_per_chunk / sample_rate,
+            'values': values,
+            'convs': convs,
+        }
+
+    async def query_many(self, queries):
+        """ Answer a list of query kwargs dicts concurrently, returning results in order."""
+        return await asyncio.gather(*[self.query(**query) for query in queries])
+
+    def stats(self):
+        """ Return tile cache stats, plus the number of tiles being computed."""
+        stats = self.cache.stats()
+        stats['n_pending'] = len(self.pending)
+        return stats
@@ -0,0 +1,134 @@
+# Shared helpers for tests: write small synthetic SpikeGLX recordings.
+#
+# Run the tests from the Python folder, next to spikeglx_tools:
+#   cd Python
+#   python -m pytest tests
+
+import hashlib
+import sys
+from pathlib import Path
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+# Keys written with a leading "~", like SpikeGLX does for its maps.
+tilde_keys = ['imroTbl', 'snsChanMap', 'snsShankMap', 'snsGeomMap']
+
+
+def write_recording(bin_file, data, meta):
+    """ Write int16 data [n_chan, n_samp] to bin_file, and a .meta with the given keys plus size and SHA1."""
+    bin_file = Path(bin_file)
+    bin_file.parent.mkdir(parents=True, exist_ok=True)
+    raw = np.asarray(data, dtype='int16').T.copy()
+    raw.tofile(bin_file)
+    meta = dict(meta)
+    meta['nSavedChans'] = str(data.shape[0])
+    meta['fileSizeBytes'] = str(raw.nbytes)
+    meta['fileSHA1'] = hashlib.sha1(raw.tobytes()).hexdigest().upper()
+    sample_rate = float(meta.get('imSampRate', meta.get('niSampRate')))
+    meta['fileTimeSecs'] = str(data.shape[1] / sample_rate)
+    lines = [f'{"~" if key in tilde_keys else ""}{key}={value}' for (key, value) in meta.items()]
+    bin_file.with_suffix('.meta').write_text('\n'.join(lines) + '\n')
+    return bin_file
+
+
+def make_imec(bin_file, n_ap=16, n_samp=30000, sample_rate=30000.0, first_sample=1000, chan_order=None, seed=0):
+    """ Write an imec AP file with noise, some spikes, and a 1 Hz sync on bit 6 of the SY channel.
+
+    The chan_order keyword arg is the user order of the AP channels for
+    snsChanMap, by default the same as the saved order.
+    """
+    rng = np.random.default_rng(seed)
+    data = rng.normal(0, 20, (n_ap + 1, n_samp)).astype('int16')
+    for chan in range(n_ap):
+        for spike in rng.integers(100, n_samp - 100, 20):
+            data[chan, spike:spike + 10] -= 200
+    times = (np.arange(n_samp) + first_sample) / sample_rate
+    data[n_ap] = ((times % 1.0) < 0.5).astype('int16') << 6
+
+    if chan_order is None:
+        chan_order = range(n_ap)
+    imro = f'(0,{n_ap})' + ''.join(f'({chan} 0 0 500 250 0)' for chan in range(n_ap))
+    chan_map = f'({n_ap},{n_ap},1)' + ''.join(f'(AP{chan};{chan}:{order})' for (chan, order) in enumerate(chan_order)) + f'(SY0;{n_ap}:{n_ap})'
+    shank_map = f'(1,2,{n_ap // 2})' + ''.join(f'(0:{chan % 2}:{chan // 2}:1)' for chan in range(n_ap))
+    meta = {
+        'typeThis': 'imec',
+        'imSampRate': str(sample_rate),
+        'imAiRangeMax': '0.6',
+        'imAiRangeMin': '-0.6',
+        'imMaxInt': '512',
+        'imroTbl': imro,
+        'snsApLfSy': f'{n_ap},0,1',
+        'snsSaveChanSubset': 'all',
+        'snsChanMap': chan_map,
+        'snsShankMap': shank_map,
+        'firstSample': str(first_sample),
+        'syncSourceIdx': '2',
+        'imDatPrb_pn': 'NP1010',
+        'imDatPrb_sn': '1',
+        'userNotes': '',
+    }
+    write_recording(bin_file, data, meta)
+    return data
+
+
+def make_ni(bin_file, n_samp=25000, sample_rate=25000.0, first_sample=500, seed=1):
+    """ Write an NI file with one noisy XA channel, a 1 Hz analog sync on XA 1, and one digital word."""
+    rng = np.random.default_rng(seed)
+    data = np.zeros((3, n_samp), dtype='int16')
+    data[0] = rng.normal(0, 100, n_samp).astype('int16')
+    times = (np.arange(n_samp) + first_sample) / sample_rate
+    data[1] = ((times % 1.0) < 0.5) * 20000
+    data[2] = ((times % 0.3) < 0.1).astype('int16') | (((times % 0.7) < 0.2).astype('int16') << 3)
+    meta = {
+        'typeThis': 'nidq',
+        'niSampRate': str(sample_rate),
+        'niAiRangeMax': '5',
+        'niAiRangeMin': '-5',
+        'snsMnMaXaDw': '0,0,2,1',
+        'niMNGain': '200',
+        'niMAGain': '1',
+        'syncNiChanType': '1',
+        'syncNiChan': '1',
+        'syncSourceIdx': '2',
+        'firstSample': str(first_sample),
+        'snsSaveChanSubset': 'all',
+        'niDev1ProductName': 'PCIe-6321',
+        'niMNChans1': '',
+        'niMAChans1': '',
+        'niXAChans1': '0:1',
+        'niXDChans1': '0:7',
+        'userNotes': '',
+    }
+    write_recording(bin_file, data, meta)
+    return data
+
+
+def make_run(data_path):
+    """ Write a run "rec" with three imec triggers, with a gap then an overlap, and two contiguous NI triggers.
+
+    Returns a dict of the data written for each stream, in trigger order.
+    """
+    gate_dir = Path(data_path, 'rec_g0')
+    imec = [make_imec(gate_dir.joinpath('rec_g0_imec0', f'rec_g0_t{t}.imec0.ap.bin'), n_ap=2, n_samp=3000, first_sample=first_sample, seed=t)
+            for (t, first_sample) in enumerate([1000, 4500, 7000])]
+    ni = [make_ni(gate_dir.joinpath(f'rec_g0_t{t}.nidq.bin'), n_samp=2000, first_sample=first_sample, seed=t)
+          for (t, first_sample) in enumerate([500, 2500])]
+    # Not part of the run.
+    make_ni(Path(data_path, 'other_g0', 'other_g0_t0.nidq.bin'), n_samp=100)
+    return {'imec0.ap': imec, 'nidq': ni}
+
+
+@pytest.fixture
+def imec_file(tmp_path):
+    bin_file = tmp_path.joinpath('rec_g0', 'rec_g0_imec0', 'rec_g0_t0.imec0.ap.bin')
+    data = make_imec(bin_file)
+    return (bin_file, data)
+
+
+@pytest.fixture
+def ni_file(tmp_path):
+    bin_file = tmp_path.joinpath('rec_g0', 'rec_g0_t0.nidq.bin')
+    data = make_ni(bin_file)
+    return (bin_file, data)
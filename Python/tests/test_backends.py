@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from spikeglx_tools import datafile, export, qc_stats
+from spikeglx_tools.datafile_ben import read_bin_ben
+
+
+@pytest.mark.parametrize('mode', ['minmax', 'median', 'percentile'])
+def test_read_bin_ben_backends_match(imec_file, mode):
+    (bin_file, data) = imec_file
+    meta = datafile.readMeta(bin_file)
+    (values, indices) = read_bin_ben(0, data.shape[1], meta, bin_file, samp_per_chunk=100, mode=mode)
+    for (backend, n_workers) in [('thread', 3), ('process', 2)]:
+        (other_values, other_indices) = read_bin_ben(0, data.shape[1], meta, bin_file, samp_per_chunk=100, mode=mode, n_workers=n_workers, backend=backend)
+        assert np.array_equal(other_values, values)
+        assert np.array_equal(other_indices, indices)
+
+
+def test_channel_stats_backends_match(imec_file):
+    (bin_file, _) = imec_file
+    meta = datafile.readMeta(bin_file)
+    expected = qc_stats.channel_stats(bin_file, meta, n_workers=1).summary(meta)
+    summary = qc_stats.channel_stats(bin_file, meta, n_workers=2, samp_per_block=4000, backend='process').summary(meta)
+    for name in expected:
+        assert np.allclose(summary[name], expected[name])
+
+
+@pytest.mark.parametrize('band', [None, (300, None)])
+def test_export_backends_match(imec_file, tmp_path, band):
+    (bin_file, data) = imec_file
+    outputs = []
+    # Different block sizes, and process workers that split each block into pieces.
+    for (backend, samp_per_block) in [('thread', 8000), ('thread', 30000), ('process', 30000)]:
+        out_file = tmp_path.joinpath(f'{backend}_{samp_per_block}.bin')
+        # float32 output shows any difference in FFT rounding.
+        export.export_binary(bin_file, out_file, band=band, car='median', dtype='float32', samp_per_block=samp_per_block, n_workers=3, backend=backend)
+        outputs.append(np.fromfile(out_file, dtype='float32'))
+    for output in outputs[1:]:
+        assert np.array_equal(output, outputs[0])
@@ -0,0 +1,52 @@
+import os
+import numpy as np
+import pytest
+
+from spikeglx_tools import block_cache, blocks, datafile
+
+
+@pytest.fixture
+def cache():
+    block_cache.cache.clear()
+    yield block_cache.cache
+    block_cache.cache.clear()
+
+
+def test_read_window_matches_file(imec_file, cache):
+    (bin_file, data) = imec_file
+    meta = datafile.readMeta(bin_file)
+    chans = [16, 0, 7]
+    values = block_cache.read_window(bin_file, meta, chans, 1000, 29000)
+    assert np.array_equal(values, data[chans, 1000:29000])
+    misses = cache.stats()['misses']
+    again = block_cache.read_window(bin_file, meta, chans, 2000, 3000)
+    assert np.array_equal(again, data[chans, 2000:3000])
+    assert cache.stats()['misses'] == misses
+    assert cache.stats()['hits'] > 0
+
+
+def test_rewritten_file_is_not_served_stale(imec_file, cache):
+    (bin_file, data) = imec_file
+    meta = datafile.readMeta(bin_file)
+    block_cache.read_window(bin_file, meta, [0], 0, 100)
+    changed = data.copy()
+    changed[0] += 1
+    changed.T.tofile(bin_file)
+    stat = bin_file.stat()
+    os.utime(bin_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert np.array_equal(block_cache.read_window(bin_file, meta, [0], 0, 100), changed[[0], :100])
+
+
+def test_set_memory_budget_resizes_cache(imec_file, cache):
+    (bin_file, _) = imec_file
+    meta = datafile.readMeta(bin_file)
+    budget = blocks.memory_budget_bytes
+    try:
+        block_cache.read_window(bin_file, meta)
+        assert cache.n_bytes > 0
+        blocks.set_memory_budget(4 * 1024)
+        assert cache.max_bytes == 1024
+        assert cache.n_bytes <= 1024
+    finally:
+        blocks.set_memory_budget(budget)
+    assert cache.max_bytes == int(budget * block_cache.cache_budget_fraction)
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from spikeglx_tools import blocks, datafile
+
+
+@pytest.mark.parametrize('reader', ['memmap', 'buffered', 'cached'])
+def test_iter_blocks_matches_file(imec_file, reader):
+    (bin_file, data) = imec_file
+    meta = datafile.readMeta(bin_file)
+    pieces = []
+    for (block_samp_0, block) in blocks.iter_blocks(bin_file, meta, 123, 20000, samp_per_block=3000, reader=reader):
+        assert block.shape == (data.shape[0], min(3000, 20123 - block_samp_0))
+        pieces.append(np.array(block))
+    assert np.array_equal(np.concatenate(pieces, axis=1), data[:, 123:20123])
+
+
+def test_buffered_without_readahead_matches_file(imec_file):
+    (bin_file, data) = imec_file
+    meta = datafile.readMeta(bin_file)
+    with blocks.BufferedBlockReader(bin_file, meta, 7000, readahead=False) as reader:
+        values = np.concatenate([np.array(block) for (_, block) in reader.blocks()], axis=1)
+    assert np.array_equal(values, data)
+
+
+@pytest.mark.parametrize('reader', ['memmap', 'buffered'])
+def test_truncated_file_raises(imec_file, reader):
+    (bin_file, data) = imec_file
+    meta = datafile.readMeta(bin_file)
+    with open(bin_file, 'r+b') as f:
+        f.truncate(bin_file.stat().st_size - 2 * data.shape[0] * 500)
+    with pytest.raises(ValueError):
+        for _ in blocks.iter_blocks(bin_file, meta, samp_per_block=4000, reader=reader):
+            pass
+
+
+def test_buffered_short_read_raises(imec_file):
+    (bin_file, data) = imec_file
+    meta = datafile.readMeta(bin_file)
+    with blocks.BufferedBlockReader(bin_file, meta, 4000) as reader:
+        # Truncate after opening, as if the file changed while reading.
+        with open(bin_file, 'r+b') as f:
+            f.truncate(bin_file.stat().st_size // 2)
+        with pytest.raises(ValueError):
+            for _ in reader.blocks():
+                pass
+
+
+def test_samp_per_block_follows_budget(imec_file):
+    (bin_file, _) = imec_file
+    meta = datafile.readMeta(bin_file)
+    assert blocks.samp_per_block_for(meta, block_bytes=17 * 2 * 100) == 100
+    small = blocks.samp_per_block_for(meta, n_blocks=4, work_bytes=4)
+    assert 1 <= small <= blocks.samp_per_block_for(meta)
+
+
+def test_buffered_blocks_budget_for_all_buffers(imec_file, monkeypatch):
+    (bin_file, _) = imec_file
+    meta = datafile.readMeta(bin_file)
+    monkeypatch.setattr(blocks, 'default_reader', 'memmap')
+    monkeypatch.setattr(blocks, 'memory_budget_bytes', 17 * 2 * 3 * 1000)
+    assert blocks.samp_per_block_for(meta) == 3000
+    assert blocks.samp_per_block_for(meta, reader='buffered') == 1000
+    sizes = [block.shape[1] for (_, block) in blocks.iter_blocks(bin_file, meta, 0, 5000, reader='buffered')]
+    assert sizes == [1000] * 5
@@ -0,0 +1,56 @@
+import os
+import numpy as np
+import pytest
+
+from spikeglx_tools import channel_major, datafile
+from spikeglx_tools.datafile_ben import read_bin_ben
+
+
+@pytest.mark.parametrize('tile_samp', [None, 4096])
+def test_round_trip(imec_file, tile_samp):
+    (bin_file, data) = imec_file
+    meta = datafile.readMeta(bin_file)
+    channel_major.write_channel_major(bin_file, meta, tile_samp=tile_samp, samp_per_block=5000)
+    assert channel_major.read_channel_major_info(bin_file, meta) is not None
+    values = channel_major.read_channels(bin_file, meta, [16, 3, 0], 1234, 20000)
+    assert np.array_equal(values, data[[16, 3, 0], 1234:21234])
+    blocks = [block for (_, block) in channel_major.iter_channel_blocks(bin_file, meta, [5, 16], 100, 25000, samp_per_block=3000)]
+    assert np.array_equal(np.concatenate(blocks, axis=1), data[[5, 16], 100:25100])
+
+
+def test_reads_prefer_valid_copy(imec_file):
+    (bin_file, data) = imec_file
+    meta = datafile.readMeta(bin_file)
+    cmbin_file = channel_major.write_channel_major(bin_file, meta)
+
+    # Mark the copy, keeping its size, so reads from it are recognizable.
+    marked = np.full(data.shape, 7, dtype='int16')
+    marked.tofile(cmbin_file)
+    assert np.all(channel_major.read_channels(bin_file, meta, [16]) == 7)
+    (values, _) = read_bin_ben(0, data.shape[1], meta, bin_file, samp_per_chunk=100, chan_list=[2, 16])
+    assert values.shape == (2, 2 * data.shape[1] // 100)
+    assert np.all(values == 7)
+
+
+def test_rewritten_bin_invalidates_copy(imec_file):
+    (bin_file, data) = imec_file
+    meta = datafile.readMeta(bin_file)
+    channel_major.write_channel_major(bin_file, meta)
+
+    # Same size and .meta, new contents and modification time.
+    changed = data.copy()
+    changed[0] += 1
+    changed.T.tofile(bin_file)
+    stat = bin_file.stat()
+    os.utime(bin_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert channel_major.read_channel_major_info(bin_file, meta) is None
+    assert np.array_equal(channel_major.read_channels(bin_file, meta, [0]), changed[[0]])
+
+
+def test_read_bin_ben_chan_list_matches_all_channels(ni_file):
+    (bin_file, data) = ni_file
+    meta = datafile.readMeta(bin_file)
+    (all_values, all_indices) = read_bin_ben(0, data.shape[1], meta, bin_file, samp_per_chunk=250)
+    (values, indices) = read_bin_ben(0, data.shape[1], meta, bin_file, samp_per_chunk=250, chan_list=[1, 0])
+    assert np.array_equal(values, all_values[[1, 0]])
+    assert np.array_equal(indices, all_indices[[1, 0]])
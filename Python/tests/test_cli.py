@@ -0,0 +1,46 @@
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+python_path = Path(__file__).parent.parent
+
+# Budget for importing the command line and printing help, beyond starting Python.
+import_budget_secs = 0.1
+
+heavy_modules = ['numpy', 'matplotlib', 'scipy']
+
+
+def run_python(args):
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable] + args, cwd=python_path, capture_output=True, text=True)
+    return (completed, time.perf_counter() - start)
+
+
+def test_help_imports_nothing_heavy():
+    (completed, _) = run_python(['-X', 'importtime', '-m', 'spikeglx_tools', '--help'])
+    assert completed.returncode == 0
+    assert 'describe' in completed.stdout
+    imported = [line.split('|')[-1].strip() for line in completed.stderr.splitlines() if line.startswith('import time:')]
+    assert not [name for name in imported if name.split('.')[0] in heavy_modules]
+
+    # Cumulative microseconds for importing the command line module itself.
+    cli_micros = [int(line.split('|')[1]) for line in completed.stderr.splitlines() if line.rstrip().endswith('| spikeglx_tools.cli')]
+    assert cli_micros and cli_micros[0] < import_budget_secs * 1e6
+
+
+def test_help_wall_time():
+    # Best of a few runs, to keep the test steady on a busy machine.
+    baseline = min(run_python(['-c', 'pass'])[1] for _ in range(3))
+    help_secs = min(run_python(['-m', 'spikeglx_tools', '--help'])[1] for _ in range(3))
+    assert help_secs - baseline < import_budget_secs
+
+
+def test_describe(imec_file, ni_file, capsys):
+    from spikeglx_tools.cli import main
+
+    (bin_file, _) = imec_file
+    assert main(['describe', str(bin_file.parent.parent)]) == 0
+    output = capsys.readouterr().out
+    assert 'imec probe NP1010' in output
+    assert 'rec_g0_t0.nidq.bin' in output
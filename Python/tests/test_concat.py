@@ -0,0 +1,82 @@
+import os
+import numpy as np
+import pytest
+
+from conftest import make_run
+from spikeglx_tools import concat, datafile
+
+
+def test_segments_fill_gaps_and_trim_overlaps(tmp_path):
+    written = make_run(tmp_path)
+    (t0, t1, t2) = written['imec0.ap']
+    recording = concat.ConcatRecording.from_run(tmp_path, 'rec', 'imec0.ap')
+    # t0 covers 1000-4000, a gap to 4500, then t2 overlaps the end of t1 by 500.
+    assert recording.shape == (3, 9000)
+
+    segments = recording.segments(2900, 3600)
+    assert [(out_samp_0, n) for (out_samp_0, _, n) in segments] == [(2900, 100), (3000, 500), (3500, 100)]
+    assert segments[1][1] is None
+    assert np.array_equal(segments[0][1], t0[:, 2900:3000])
+    assert np.array_equal(segments[2][1], t1[:, :100])
+
+    values = recording[:, :]
+    assert np.array_equal(values[:, :3000], t0)
+    assert not values[:, 3000:3500].any()
+    assert np.array_equal(values[:, 3500:6500], t1)
+    assert np.array_equal(values[:, 6500:], t2[:, 500:])
+
+
+def test_without_fill_gaps_files_are_back_to_back(tmp_path):
+    written = make_run(tmp_path)
+    recording = concat.ConcatRecording.from_run(tmp_path, 'rec', 'imec0.ap', fill_gaps=False)
+    assert [step['out_offset'] for step in recording.plan] == [0, 3000, 6000]
+    assert np.array_equal(recording[:, :], np.concatenate(written['imec0.ap'], axis=1))
+
+
+def test_slice_within_one_file_is_a_view(tmp_path):
+    make_run(tmp_path)
+    recording = concat.ConcatRecording.from_run(tmp_path, 'rec', 'imec0.ap')
+    assert np.shares_memory(recording[:, 3600:4000], recording.memmaps[1])
+    assert not np.shares_memory(recording[:, 2900:3600], recording.memmaps[0])
+
+
+def test_integer_keys_match_numpy_shapes(tmp_path):
+    make_run(tmp_path)
+    recording = concat.ConcatRecording.from_run(tmp_path, 'rec', 'imec0.ap')
+    expected = recording[:, :]
+    keys = [
+        (1, slice(100, 200)),         # Within one file
+        (1, slice(2900, 3600)),       # Across a gap
+        (-1, slice(3100, 3200)),      # Only gap
+        (slice(0, 2), 5000),
+        (2, 3200),
+        (1, slice(None)),
+        0,
+    ]
+    for key in keys:
+        values = recording[key]
+        assert values.shape == expected[key].shape
+        assert np.array_equal(values, expected[key])
+
+
+def test_export_round_trip(tmp_path):
+    make_run(tmp_path)
+    recording = concat.ConcatRecording.from_run(tmp_path, 'rec', 'nidq')
+    out_file = recording.export(tmp_path.joinpath('rec_cat.nidq.bin'))
+
+    meta = datafile.readMeta(out_file)
+    assert 'fileSHA1' not in meta
+    assert int(meta['fileSizeBytes']) == out_file.stat().st_size == 2 * 3 * recording.n_samp
+    assert int(meta['firstSample']) == 500
+    assert np.array_equal(datafile.makeMemMapRaw(out_file, meta), recording[:, :])
+
+
+def test_copy_range_raises_on_short_input(tmp_path):
+    in_file = tmp_path.joinpath('in.bin')
+    in_file.write_bytes(bytes(range(100)))
+    out_file = tmp_path.joinpath('out.bin')
+    with open(in_file, 'rb') as in_f, open(out_file, 'w+b') as out_f:
+        concat.copy_range(in_f.fileno(), out_f.fileno(), 10, 4, 50)
+        assert os.pread(out_f.fileno(), 50, 4) == bytes(range(10, 60))
+        with pytest.raises(ValueError):
+            concat.copy_range(in_f.fileno(), out_f.fileno(), 80, 100, 50)
@@ -0,0 +1,43 @@
+import numpy as np
+
+from spikeglx_tools import datafile, snippets
+from spikeglx_tools.event_average import EventAverager, event_related_average
+
+
+def test_event_average_matches_numpy(imec_file):
+    (bin_file, _) = imec_file
+    meta = datafile.readMeta(bin_file)
+    rng = np.random.default_rng(3)
+    # Include an event near the start, so some samples have fewer events.
+    event_times = np.concatenate([[0.0002], rng.uniform(0.01, 0.99, 40)])
+    conditions = np.array(['a', 'b'])[rng.integers(0, 2, len(event_times))]
+    conditions[0] = 'a'
+    chan_list = [0, 7, 15]
+    window = (-0.001, 0.002)
+
+    result = event_related_average(bin_file, meta, event_times, conditions, chan_list, window, batch_size=7)
+    assert list(result['conditions']) == ['a', 'b']
+
+    all_snippets = snippets.extract_snippets(bin_file, meta, event_times, chan_list, window, pad_value=np.nan)
+    for (index, label) in enumerate(result['conditions']):
+        selected = all_snippets[conditions == label].astype('float64')
+        count = np.sum(~np.isnan(selected[:, 0, :]), axis=0)
+        assert np.array_equal(result['count'][index], count)
+        assert np.allclose(result['mean'][index], np.nanmean(selected, axis=0), atol=0)
+        sem = np.nanstd(selected, axis=0, ddof=1) / np.sqrt(count)
+        assert np.allclose(result['sem'][index], sem, atol=0)
+    assert result['count'][0].min() < result['count'][0].max()
+
+
+def test_merged_averagers_match_one():
+    rng = np.random.default_rng(4)
+    values = rng.normal(size=(10, 2, 5))
+    conditions = rng.integers(0, 3, 10)
+    whole = EventAverager(3, 2, 5)
+    whole.add(values, conditions)
+    first = EventAverager(3, 2, 5)
+    first.add(values[:4], conditions[:4])
+    second = EventAverager(3, 2, 5)
+    second.add(values[4:], conditions[4:])
+    for (merged, expected) in zip(first.merge(second).result(), whole.result()):
+        assert np.allclose(merged, expected, equal_nan=True)
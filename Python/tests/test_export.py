@@ -0,0 +1,46 @@
+import json
+import threading
+import numpy as np
+import pytest
+
+from spikeglx_tools import export, geometry, datafile
+from conftest import make_imec
+
+
+def test_export_round_trip(imec_file, tmp_path):
+    (bin_file, data) = imec_file
+    out_file = tmp_path.joinpath('out.bin')
+    info = export.export_binary(bin_file, out_file, samp_per_block=7000, n_workers=2)
+    exported = np.fromfile(out_file, dtype='int16').reshape(-1, info['n_chan']).T
+    assert info['n_chan'] == data.shape[0] - 1
+    assert np.array_equal(exported, data[:-1])
+
+
+def test_channel_map_rows_match_geometry(tmp_path):
+    n_ap = 8
+    bin_file = tmp_path.joinpath('rec_g0_t0.imec0.ap.bin')
+    make_imec(bin_file, n_ap=n_ap, n_samp=3000, chan_order=list(reversed(range(n_ap))))
+    chan_list = [5, 1, 8, 2]
+    info = export.export_binary(bin_file, tmp_path.joinpath('out.bin'), chan_list=chan_list, samp_per_block=1000, n_workers=1)
+    with open(info['map_file']) as f:
+        probe = json.load(f)
+
+    # Rows 0, 1, and 3 of the export hold neural channels 5, 1, and 2.  Row 2 is SY.
+    expected = geometry.probe_geometry(datafile.readMeta(bin_file))
+    assert probe['chanMap'] == [0, 1, 3]
+    assert probe['chanMap0ind'] == [0, 1, 3]
+    assert probe['xc'] == expected['x'][[5, 1, 2]].tolist()
+    assert probe['yc'] == expected['y'][[5, 1, 2]].tolist()
+    assert probe['n_chan'] == 4
+
+
+def test_compute_error_stops_reader(imec_file, tmp_path, monkeypatch):
+    (bin_file, _) = imec_file
+
+    def fail(*args):
+        raise RuntimeError('compute failed')
+
+    monkeypatch.setattr(export, 'preprocess', fail)
+    with pytest.raises(RuntimeError):
+        export.export_binary(bin_file, tmp_path.joinpath('out.bin'), samp_per_block=500, n_workers=1, max_pending=1)
+    assert not [thread for thread in threading.enumerate() if 'read_blocks' in thread.name]
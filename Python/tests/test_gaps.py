@@ -0,0 +1,50 @@
+import numpy as np
+
+from conftest import make_run
+from spikeglx_tools import catalog, gaps
+from spikeglx_tools.cli_wrappers import read_key_value_pairs
+
+
+def test_catalog_run(tmp_path):
+    make_run(tmp_path)
+    data_path = tmp_path
+    entries = catalog.catalog_run(data_path, 'rec')
+    assert [(entry['stream'], entry['g'], entry['t']) for entry in entries] == [
+        ('imec0.ap', 0, 0), ('imec0.ap', 0, 1), ('imec0.ap', 0, 2), ('nidq', 0, 0), ('nidq', 0, 1)]
+    assert [entry['n_samp'] for entry in entries] == [3000, 3000, 3000, 2000, 2000]
+    assert [entry['first_sample'] for entry in entries] == [1000, 4500, 7000, 500, 2500]
+    assert entries[0]['sample_rate'] == 30000.0
+    assert entries[0]['n_chan'] == 3
+    assert entries[0]['bin_file'].exists()
+
+    # A second catalog reuses the cached parse of unchanged .meta files.
+    again = catalog.catalog_run(data_path, 'rec')
+    assert all(first['meta'] is second['meta'] for (first, second) in zip(entries, again))
+
+
+def test_plan_gaps_and_overlaps(tmp_path):
+    make_run(tmp_path)
+    data_path = tmp_path
+    plans = gaps.plan_run(data_path, 'rec')
+    imec = plans['imec0.ap']
+    assert [step['gap_before'] for step in imec] == [0, 500, -500]
+    assert [step['trim'] for step in imec] == [0, 0, 500]
+    assert [step['out_offset'] for step in imec] == [0, 3500, 6500]
+    assert [step['out_offset'] for step in plans['nidq']] == [0, 2000]
+
+    butted = gaps.plan_run(data_path, 'rec', streams=['imec0.ap'], fill_gaps=False)
+    assert list(butted) == ['imec0.ap']
+    assert [step['out_offset'] for step in butted['imec0.ap']] == [0, 3000, 6000]
+    assert [step['trim'] for step in butted['imec0.ap']] == [0, 0, 0]
+
+
+def test_write_offsets_file(tmp_path):
+    make_run(tmp_path)
+    data_path = tmp_path
+    plans = gaps.plan_run(data_path, 'rec')
+    offsets_file = gaps.write_offsets_file(plans, tmp_path.joinpath('rec_g0_ct_offsets.txt'))
+    offsets = read_key_value_pairs(offsets_file, ':')
+    assert offsets['smp_imec0.ap'].split() == ['0', '3500', '6500']
+    assert np.allclose([float(value) for value in offsets['sec_imec0.ap'].split()], [0, 3500 / 30000, 6500 / 30000], atol=1e-6)
+    assert offsets['smp_nidq'].split() == ['0', '2000']
+    assert np.allclose([float(value) for value in offsets['sec_nidq'].split()], [0, 2000 / 25000], atol=1e-6)
@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+from spikeglx_tools import datafile, pipeline, qc_stats
+from spikeglx_tools.datafile_ben import read_bin_ben
+from spikeglx_tools.digital_events import DigitalEventsConsumer, decode_digital_events
+
+
+@pytest.mark.parametrize('threaded', [True, False])
+@pytest.mark.parametrize('samp_per_block', [None, 2300])
+def test_consumers_match_standalone_readers(imec_file, threaded, samp_per_block):
+    (bin_file, data) = imec_file
+    meta = datafile.readMeta(bin_file)
+    consumers = [
+        pipeline.MinMaxConsumer(samp_per_chunk=100),
+        pipeline.StatsConsumer(),
+        pipeline.DigitalEdgesConsumer(0, 6),
+        DigitalEventsConsumer(),
+    ]
+    (min_max, stats, edges, events) = pipeline.run_pipeline(bin_file, meta, consumers, samp_per_block=samp_per_block, threaded=threaded)
+
+    (values, indices) = read_bin_ben(0, data.shape[1], meta, bin_file, samp_per_chunk=100)
+    assert np.array_equal(min_max[0], values)
+    assert np.array_equal(min_max[1], indices)
+
+    expected = qc_stats.channel_stats(bin_file, meta, n_workers=3).summary(meta)
+    for name in ['n_samp', 'n_low', 'n_high', 'max_flat_secs', 'flat']:
+        assert np.array_equal(stats[name], expected[name])
+    for name in ['mean', 'rms', 'min', 'max']:
+        assert np.allclose(stats[name], expected[name])
+
+    line = (data[-1].astype('uint16') >> 6) & 1
+    steps = np.diff(line.astype('int8'))
+    assert np.array_equal(edges['rising'], np.flatnonzero(steps > 0) + 1)
+    assert np.array_equal(edges['falling'], np.flatnonzero(steps < 0) + 1)
+
+    decoded = decode_digital_events(bin_file, meta)
+    for name in ['sample', 'word', 'line', 'new_state']:
+        assert np.array_equal(events[name], decoded[name])
+    assert np.array_equal(events['sample'][events['line'] == 6], np.flatnonzero(steps != 0) + 1)
+
+
+@pytest.mark.parametrize('threaded', [True, False])
+def test_consumers_share_read_only_pool_buffers(imec_file, threaded):
+    (bin_file, data) = imec_file
+    meta = datafile.readMeta(bin_file)
+
+    def look(block_samp_0, block):
+        assert not block.flags.writeable
+        assert not block.flags.owndata
+        return (block.__array_interface__['data'][0], np.array_equal(block, data[:, block_samp_0:block_samp_0 + block.shape[1]]))
+
+    consumers = [pipeline.CallbackConsumer(look), pipeline.CallbackConsumer(look)]
+    (first, second) = pipeline.run_pipeline(bin_file, meta, consumers, samp_per_block=1000, threaded=threaded, max_pending=2)
+    assert len(first) == 30
+    assert all(matched for (_, matched) in first)
+    # Both consumers get the same buffers, reused from a small pool.
+    assert [address for (address, _) in first] == [address for (address, _) in second]
+    assert len(set(address for (address, _) in first)) <= 3
+
+
+def test_consumer_must_implement_consume():
+    class Incomplete(pipeline.BlockConsumer):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_digital_edges_missing_word_is_quiet(ni_file, capsys):
+    (bin_file, data) = ni_file
+    meta = datafile.readMeta(bin_file)
+    (present, missing) = pipeline.run_pipeline(bin_file, meta, [pipeline.DigitalEdgesConsumer(0, 3), pipeline.DigitalEdgesConsumer(1, 0)], samp_per_block=1000)
+    assert capsys.readouterr().out == ''
+    assert present['channel'] == 2
+    steps = np.diff(((data[2] >> 3) & 1).astype('int8'))
+    assert np.array_equal(present['rising'], np.flatnonzero(steps > 0) + 1)
+    assert missing['channel'] is None
+    assert not missing['rising'].size and not missing['falling'].size
+
+
+def test_consumer_error_stops_pass(imec_file):
+    (bin_file, _) = imec_file
+    meta = datafile.readMeta(bin_file)
+
+    def fail(block_samp_0, block):
+        raise RuntimeError('consumer failed')
+
+    with pytest.raises(RuntimeError):
+        pipeline.run_pipeline(bin_file, meta, [pipeline.CallbackConsumer(fail), pipeline.MinMaxConsumer()], samp_per_block=1000)
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from spikeglx_tools import datafile
+from spikeglx_tools.datafile_ben import chan_conv_factors
+from spikeglx_tools.psd import welch_psd
+
+
+@pytest.mark.parametrize('samp_per_block', [1000, 4567, None])
+def test_psd_matches_scipy_welch(imec_file, samp_per_block):
+    signal = pytest.importorskip('scipy.signal')
+    (bin_file, data) = imec_file
+    meta = datafile.readMeta(bin_file)
+    chan_list = [0, 5, 9]
+    result = welch_psd(bin_file, meta, chan_list=chan_list, nfft=512, overlap=0.5, samp_per_block=samp_per_block, chans_per_group=2)
+
+    volts = data[chan_list].astype('float64') * chan_conv_factors(chan_list, meta)[:, None]
+    window = np.hanning(512 + 2)[1:-1]
+    (freqs, psd) = signal.welch(volts, fs=30000.0, window=window, nperseg=512, noverlap=256, detrend='constant', scaling='density', axis=1)
+    assert np.allclose(result['freqs'], freqs)
+    assert result['n_segments'] == (data.shape[1] - 512) // 256 + 1
+    assert np.allclose(result['psd'], psd, rtol=1e-4, atol=0)
+
+
+def test_psd_finds_sine_and_spectrogram_averages(imec_file):
+    (bin_file, data) = imec_file
+    meta = datafile.readMeta(bin_file)
+    # Replace channel 0 with a 60 Hz sine.
+    data[0] = (1000 * np.sin(2 * np.pi * 60.0 * np.arange(data.shape[1]) / 30000.0)).astype('int16')
+    data.T.copy().tofile(bin_file)
+
+    result = welch_psd(bin_file, meta, chan_list=[0, 1], nfft=3000, spectrogram_secs=0.25, samp_per_block=2000)
+    assert result['freqs'][np.argmax(result['psd'][0])] == 60.0
+    assert np.argmax(result['psd'][1]) != 6
+    assert result['spectrogram'].shape == (4, 2, 1501)
+    assert np.allclose(result['spectrogram_times'], [0, 0.25, 0.5, 0.75])
+    # Segments are centered at 1500, 3000, ... 28500, so bins of 7500 samples have 4, 5, 5, and 5 of them.
+    counts = np.array([4, 5, 5, 5])
+    weighted = np.tensordot(counts, result['spectrogram'], axes=1) / counts.sum()
+    assert np.allclose(weighted, result['psd'], rtol=1e-4, atol=0)
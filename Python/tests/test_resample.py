@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from spikeglx_tools import datafile, verify
+from spikeglx_tools.filters import fir_taps, StreamingDecimator, StreamingFir
+from spikeglx_tools.resample import decimate_bin
+
+
+@pytest.mark.parametrize('factor, phase', [(12, 0), (12, 5), (250, 7)])
+def test_streaming_decimator_matches_decimated_fir(factor, phase):
+    rng = np.random.default_rng(7)
+    data = (100 * rng.normal(size=(3, 10007))).astype('float32')
+    taps = fir_taps(30000.0, high_hz=1000.0)
+    fir = StreamingFir(taps, 3)
+    expected = np.concatenate([fir.process(data), fir.flush()], axis=1)[:, phase::factor]
+    for samp_per_block in [1, 100, 20000]:
+        decimator = StreamingDecimator(taps, 3, factor, phase)
+        pieces = [decimator.process(data[:, start:start + samp_per_block]) for start in range(0, data.shape[1], samp_per_block)]
+        decimated = np.concatenate(pieces + [decimator.flush()], axis=1)
+        assert decimated.shape == expected.shape
+        assert np.allclose(decimated, expected, atol=1e-2)
+
+
+def test_decimate_bin_reads_back(imec_file, capsys):
+    (bin_file, data) = imec_file
+    meta = datafile.readMeta(bin_file)
+    # firstSample is 1000, so keep samples 8, 20, 32, ... at stream samples 1008, 1020, 1032, ...
+    assert int(meta['firstSample']) == 1000
+    out_files = [decimate_bin(bin_file, factor=12, out_file=bin_file.with_name(f'ds{samp_per_block}.bin'), samp_per_block=samp_per_block, chans_per_group=5)
+                 for samp_per_block in [1000, 4321, None]]
+
+    out_meta = datafile.readMeta(out_files[0])
+    assert datafile.SampRate(out_meta) == 2500.0
+    assert int(out_meta['nSavedChans']) == data.shape[0]
+    assert int(out_meta['firstSample']) == 84
+    assert out_meta['snsApLfSy'] == meta['snsApLfSy']
+    out_data = datafile.makeMemMapRaw(out_files[0], out_meta)
+    assert out_data.shape == (data.shape[0], 2500)
+    assert verify.verify_bin(out_files[0], progress_secs=None)['ok']
+
+    # The sync channel is decimated without filtering.
+    assert np.array_equal(out_data[16], data[16, 8::12])
+
+    # Neural channels match a low-pass of the whole recording, decimated.
+    taps = fir_taps(30000.0, high_hz=1000.0)
+    fir = StreamingFir(taps, 16)
+    filtered = np.concatenate([fir.process(data[:16]), fir.flush()], axis=1)[:, 8::12]
+    assert np.abs(out_data[:16].astype('float64') - filtered).max() <= 0.51
+
+    # The output doesn't depend on block size.
+    for out_file in out_files[1:]:
+        assert out_file.read_bytes() == out_files[0].read_bytes()
+
+
+def test_decimate_bin_channel_subset(imec_file, capsys):
+    (bin_file, data) = imec_file
+    out_file = decimate_bin(bin_file, factor=10, chan_list=[3, 16], samp_per_block=3000)
+    assert out_file.name == 'rec_g0_t0.imec0.ap.ds10.bin'
+    out_meta = datafile.readMeta(out_file)
+    assert out_meta['snsApLfSy'] == '1,0,1'
+    assert int(out_meta['firstSample']) == 100
+    out_data = datafile.makeMemMapRaw(out_file, out_meta)
+    assert out_data.shape == (2, 3000)
+    assert np.array_equal(out_data[1], data[16, ::10])
+
+
+def test_decimate_bin_rejects_empty_chan_list(imec_file):
+    (bin_file, _) = imec_file
+    with pytest.raises(ValueError):
+        decimate_bin(bin_file, chan_list=[])
@@ -0,0 +1,100 @@
+import os
+import threading
+import time
+
+from spikeglx_tools import cli_wrappers, scheduler
+from conftest import make_imec, make_ni
+
+
+def make_session(data_path, g):
+    make_ni(data_path.joinpath(f'rec_g{g}', f'rec_g{g}_t0.nidq.bin'), n_samp=5000)
+    make_imec(data_path.joinpath(f'rec_g{g}', f'rec_g{g}_imec0', f'rec_g{g}_t0.imec0.ap.bin'), n_ap=4, n_samp=6000)
+    return {'data_path': str(data_path), 'run_name': 'rec', 'g': str(g), 't': '0', 'streams': '-ni -ap'}
+
+
+class FakeTool():
+    """ Stand in for cli_wrappers.catgt or tprime, counting calls and concurrent runs."""
+
+    def __init__(self, result):
+        self.result = result
+        self.lock = threading.Lock()
+        self.n_calls = 0
+        self.n_running = 0
+        self.max_running = 0
+
+    def __call__(self, *args, **kwargs):
+        with self.lock:
+            self.n_calls += 1
+            self.n_running += 1
+            self.max_running = max(self.max_running, self.n_running)
+        time.sleep(0.05)
+        with self.lock:
+            self.n_running -= 1
+        return dict(self.result)
+
+
+def test_batch_runs_resumes_and_limits_tools(tmp_path, monkeypatch):
+    fyi = {'sync_imec0': 'imec0.txt', 'sync_ni': 'ni.txt', 'times_ni_0': 'events.txt'}
+    catgt = FakeTool({'fyi': fyi})
+    tprime = FakeTool({'ok': True})
+    monkeypatch.setattr(cli_wrappers, 'catgt', catgt)
+    monkeypatch.setattr(cli_wrappers, 'tprime', tprime)
+    sessions = [make_session(tmp_path.joinpath('data'), g) for g in range(3)]
+    state_file = tmp_path.joinpath('batch', 'state.json')
+
+    counts = scheduler.BatchScheduler(state_file, io_slots=4, cpu_slots=4).run(sessions)
+    assert counts == {'done': 3 * 8, 'skipped': 0, 'failed': 0, 'blocked': 0}
+    assert catgt.n_calls == 3 and catgt.max_running == 1
+    assert tprime.n_calls == 3 and tprime.max_running == 1
+    assert tmp_path.joinpath('batch', 'rec_g0_t0', 'qc', 'rec_g0_t0.nidq.qc.json').exists()
+
+    # Nothing changed, so nothing runs again.
+    counts = scheduler.BatchScheduler(state_file, io_slots=4, cpu_slots=4).run(sessions)
+    assert counts['skipped'] == 3 * 8 and counts['done'] == 0
+
+    # A rewritten .meta reruns CatGT and what depends on it, plus that file's own stages.
+    meta_file = tmp_path.joinpath('data', 'rec_g1', 'rec_g1_t0.nidq.meta')
+    stat = meta_file.stat()
+    os.utime(meta_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    counts = scheduler.BatchScheduler(state_file, io_slots=4, cpu_slots=4).run(sessions)
+    assert counts['done'] == 5
+    assert catgt.n_calls == 4
+
+
+def test_failed_stage_blocks_dependents_and_retries(tmp_path, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError('CatGT failed')
+
+    monkeypatch.setattr(cli_wrappers, 'catgt', fail)
+    sessions = [make_session(tmp_path.joinpath('data'), 0)]
+    state_file = tmp_path.joinpath('state.json')
+    counts = scheduler.BatchScheduler(state_file).run(sessions)
+    assert counts == {'done': 6, 'skipped': 0, 'failed': 1, 'blocked': 1}
+
+    monkeypatch.setattr(cli_wrappers, 'catgt', FakeTool({}))
+    counts = scheduler.BatchScheduler(state_file).run(sessions)
+    assert counts == {'done': 2, 'skipped': 6, 'failed': 0, 'blocked': 0}
+
+
+def test_state_is_only_used_on_main_thread(tmp_path, monkeypatch):
+    fyi = {'sync_imec0': 'imec0.txt', 'sync_ni': 'ni.txt', 'times_ni_0': 'events.txt'}
+    monkeypatch.setattr(cli_wrappers, 'catgt', FakeTool({'fyi': fyi}))
+    tprime_args = []
+    monkeypatch.setattr(cli_wrappers, 'tprime', lambda *args, **kwargs: tprime_args.append(args) or {})
+    record_threads = set()
+    record = scheduler.BatchScheduler.record
+
+    def check_record(self, session_name, stage_name):
+        record_threads.add(threading.current_thread())
+        return record(self, session_name, stage_name)
+
+    monkeypatch.setattr(scheduler.BatchScheduler, 'record', check_record)
+    batch = scheduler.BatchScheduler(tmp_path.joinpath('state.json'), io_slots=4, cpu_slots=4)
+    assert batch.record('nobody', 'catgt') is None
+    assert batch.state == {'sessions': {}}
+
+    counts = batch.run([make_session(tmp_path.joinpath('data'), 0)])
+    assert counts['done'] == 8
+    assert record_threads == {threading.main_thread()}
+    # TPrime still gets the CatGT results it depends on.
+    assert tprime_args == [('imec0.txt', [('ni.txt', 'events.txt', None)])]
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from spikeglx_tools import datafile, snippets
+from spikeglx_tools.datafile_ben import chan_conv_factors
+
+
+def test_snippets_pad_at_file_edges(imec_file):
+    (bin_file, data) = imec_file
+    meta = datafile.readMeta(bin_file)
+    n_file_samp = data.shape[1]
+    # Events at the very start and end, so windows of [-10, 10) samples run off the file.
+    event_times = np.array([5, n_file_samp - 3]) / 30000.0
+    values = snippets.extract_snippets(bin_file, meta, event_times, chan_list=[0, 3], window=(-10 / 30000, 10 / 30000), pad_value=-99, volts=False)
+    assert values.shape == (2, 2, 20)
+
+    assert np.all(values[0, :, :5] == -99)
+    assert np.array_equal(values[0, :, 5:], data[[0, 3], :15])
+    assert np.array_equal(values[1, :, :13], data[[0, 3], n_file_samp - 13:])
+    assert np.all(values[1, :, 13:] == -99)
+
+
+def test_snippets_keep_event_order_and_convert_to_volts(imec_file):
+    (bin_file, data) = imec_file
+    meta = datafile.readMeta(bin_file)
+    event_samples = np.array([20000, 100, 15000, 100, 7000])
+    chan_list = [2, 5, 16]
+    values = snippets.extract_snippets(bin_file, meta, event_samples / 30000.0, chan_list=chan_list, window=(-0.001, 0.002), batch_size=2)
+    convs = chan_conv_factors(chan_list, meta)
+    offsets = snippets.window_offsets(meta, (-0.001, 0.002))
+    assert len(offsets) == 90
+    for (event, sample) in enumerate(event_samples):
+        expected = data[chan_list][:, sample + offsets] * convs[:, None]
+        assert np.allclose(values[event], expected, rtol=1e-6, atol=0)
+
+
+def test_snippet_batches_are_in_time_order(imec_file):
+    (bin_file, _) = imec_file
+    meta = datafile.readMeta(bin_file)
+    event_times = np.array([0.5, 0.1, 0.9, 0.3])
+    batches = list(snippets.iter_snippet_batches(bin_file, meta, event_times, chan_list=[0], batch_size=3))
+    assert [list(event_indices) for (event_indices, _) in batches] == [[1, 3, 0], [2]]
+
+
+@pytest.mark.parametrize('bad_time', [np.nan, np.inf])
+def test_snippets_reject_non_finite_times(imec_file, bad_time):
+    (bin_file, _) = imec_file
+    meta = datafile.readMeta(bin_file)
+    with pytest.raises(ValueError):
+        snippets.extract_snippets(bin_file, meta, [0.1, bad_time, 0.2])
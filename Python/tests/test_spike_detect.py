@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from conftest import make_imec
+from spikeglx_tools import datafile
+from spikeglx_tools.filters import fir_taps, StreamingFir
+from spikeglx_tools.spike_detect import detect_spikes
+
+# (channel, peak sample) of spikes to inject.  Channel 1 has a pair 20 samples
+# apart, within the 1ms refractory period, across the block boundary at 5000.
+spikes = [(0, 1200), (0, 9995), (1, 4990), (1, 5010), (2, 20000), (3, 5001), (3, 27000)]
+
+
+@pytest.fixture
+def spikes_file(tmp_path):
+    bin_file = tmp_path.joinpath('spikes_g0_t0.imec0.ap.bin')
+    data = make_imec(bin_file, n_ap=4)
+    rng = np.random.default_rng(5)
+    data[:4] = rng.normal(0, 5, (4, data.shape[1])).astype('int16')
+    shape = (-300 * np.exp(-0.5 * (np.arange(-10, 11) / 2.0) ** 2)).astype('int16')
+    for (chan, sample) in spikes:
+        data[chan, sample - 10:sample + 11] += shape
+    # Same size as before, so the .meta still fits.
+    data.T.copy().tofile(bin_file)
+    return (bin_file, data)
+
+
+@pytest.mark.parametrize('samp_per_block', [5000, 7777, None])
+def test_detects_injected_spikes(spikes_file, samp_per_block, capsys):
+    (bin_file, _) = spikes_file
+    meta = datafile.readMeta(bin_file)
+    result = detect_spikes(bin_file, meta, threshold=8.0, samp_per_block=samp_per_block, chans_per_group=3, n_workers=2)
+
+    # The second spike of the close pair on channel 1 falls in the refractory period.
+    expected = sorted([spike for spike in spikes if spike != (1, 5010)], key=lambda spike: spike[1])
+    assert list(result['channels']) == [chan for (chan, _) in expected]
+    assert np.all(np.abs(result['samples'] - [sample for (_, sample) in expected]) <= 1)
+    assert np.all(result['amplitudes'] < 0)
+    assert list(result['chan_list']) == [0, 1, 2, 3]
+
+
+def test_streaming_fir_matches_whole_recording():
+    rng = np.random.default_rng(6)
+    data = rng.normal(size=(3, 5000)).astype('float32')
+    taps = fir_taps(30000.0, 300.0, 6000.0)
+    fir = StreamingFir(taps, 3)
+    pieces = [fir.process(data[:, start:start + 700]) for start in range(0, 5000, 700)]
+    streamed = np.concatenate(pieces + [fir.flush()], axis=1)
+    assert streamed.shape == data.shape
+
+    delay = (len(taps) - 1) // 2
+    padded = np.concatenate([np.zeros((3, delay)), data, np.zeros((3, delay))], axis=1)
+    expected = np.stack([np.convolve(row, taps, mode='valid') for row in padded])
+    assert np.allclose(streamed, expected, atol=1e-4)
+
+
+def test_short_refractory_keeps_close_spikes(spikes_file, capsys):
+    (bin_file, _) = spikes_file
+    meta = datafile.readMeta(bin_file)
+    result = detect_spikes(bin_file, meta, threshold=8.0, refractory_secs=0.0002, samp_per_block=5000)
+    close = result['samples'][result['channels'] == 1]
+    assert np.all(np.abs(close - [4990, 5010]) <= 1)
@@ -0,0 +1,93 @@
+import os
+import numpy as np
+import pytest
+
+from spikeglx_tools import summary
+
+
+@pytest.fixture
+def counted(monkeypatch):
+    """ Count calls to summarize_file, which only happen on cache misses."""
+    calls = []
+    summarize_file = summary.summarize_file
+
+    def count(*args, **kwargs):
+        calls.append(args)
+        return summarize_file(*args, **kwargs)
+
+    monkeypatch.setattr(summary, 'summarize_file', count)
+    return calls
+
+
+def assert_same_products(products, expected):
+    assert products.keys() == expected.keys()
+    for (name, value) in expected.items():
+        if name == 'event_times':
+            assert len(products[name]) == len(value)
+            for (times, expected_times) in zip(products[name], value):
+                assert np.array_equal(times, expected_times)
+        elif isinstance(value, np.ndarray):
+            assert products[name].dtype == value.dtype
+            assert np.array_equal(products[name], value)
+        else:
+            assert products[name] == value
+
+
+@pytest.mark.parametrize('file_fixture', ['imec_file', 'ni_file'])
+def test_cache_hit_matches_uncached(file_fixture, request, tmp_path, counted):
+    (bin_file, _) = request.getfixturevalue(file_fixture)
+    rec_path = bin_file.parent.parent if file_fixture == 'imec_file' else bin_file.parent
+    bin_file.parent.joinpath(f'{bin_file.stem}.events.txt').write_text('0.25\n0.5\n')
+    cache_dir = tmp_path.joinpath('cache')
+
+    expected = summary.summarize_file(rec_path, bin_file, 0, 0.5, samp_per_chunk=100)
+    first = summary.cached_file_summary(rec_path, bin_file, 0, 0.5, cache_dir, samp_per_chunk=100)
+    second = summary.cached_file_summary(rec_path, bin_file, 0, 0.5, cache_dir, samp_per_chunk=100)
+    assert len(counted) == 2
+    assert_same_products(first, expected)
+    assert_same_products(second, expected)
+    assert len(list(cache_dir.glob('*.npz'))) == 1
+
+
+def test_changes_miss_and_replace_stale_cache(imec_file, tmp_path, counted):
+    (bin_file, _) = imec_file
+    rec_path = bin_file.parent.parent
+    cache_dir = tmp_path.joinpath('cache')
+
+    summary.cached_file_summary(rec_path, bin_file, 0, 0.5, cache_dir, samp_per_chunk=100)
+    [first_file] = cache_dir.glob('*.npz')
+
+    # Other parameters miss, and replace the cache file.
+    summary.cached_file_summary(rec_path, bin_file, 0, 0.25, cache_dir, samp_per_chunk=100)
+    assert len(counted) == 2
+    [second_file] = cache_dir.glob('*.npz')
+    assert second_file != first_file
+
+    # So does a rewritten .meta file, or a new event file.
+    meta_file = bin_file.with_suffix('.meta')
+    stat = meta_file.stat()
+    os.utime(meta_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    summary.cached_file_summary(rec_path, bin_file, 0, 0.25, cache_dir, samp_per_chunk=100)
+    bin_file.parent.joinpath(f'{bin_file.stem}.events.txt').write_text('0.1\n')
+    products = summary.cached_file_summary(rec_path, bin_file, 0, 0.25, cache_dir, samp_per_chunk=100)
+    assert len(counted) == 4
+    assert np.array_equal(products['event_times'][0], [0.1])
+    assert len(list(cache_dir.glob('*.npz'))) == 1
+
+    summary.cached_file_summary(rec_path, bin_file, 0, 0.25, cache_dir, samp_per_chunk=100)
+    assert len(counted) == 4
+
+
+def test_same_name_in_other_folder_keeps_its_cache(imec_file, tmp_path, counted):
+    (bin_file, _) = imec_file
+    other_file = tmp_path.joinpath('copy', bin_file.name)
+    other_file.parent.mkdir()
+    other_file.write_bytes(bin_file.read_bytes())
+    other_file.with_suffix('.meta').write_bytes(bin_file.with_suffix('.meta').read_bytes())
+    cache_dir = tmp_path.joinpath('cache')
+
+    summary.cached_file_summary(bin_file.parent, bin_file, 0, 0.5, cache_dir, samp_per_chunk=100)
+    summary.cached_file_summary(other_file.parent, other_file, 0, 0.5, cache_dir, samp_per_chunk=100)
+    assert len(list(cache_dir.glob('*.npz'))) == 2
+    summary.cached_file_summary(bin_file.parent, bin_file, 0, 0.5, cache_dir, samp_per_chunk=100)
+    assert len(counted) == 2
@@ -0,0 +1,129 @@
+import json
+import struct
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+import numpy as np
+import pytest
+
+from conftest import make_imec
+from spikeglx_tools import tile_server
+
+
+def test_etag_matches():
+    etag = '"abc123"'
+    assert tile_server.etag_matches('"abc123"', etag)
+    assert tile_server.etag_matches('"other", W/"abc123"', etag)
+    assert tile_server.etag_matches('*', etag)
+    assert not tile_server.etag_matches('"abc1234"', etag)
+    assert not tile_server.etag_matches('"xabc123", "abc12"', etag)
+    assert not tile_server.etag_matches('', etag)
+
+
+@pytest.fixture
+def start_server():
+    """ Start servers with make_handler(tiles, allow_origin), returning their URLs, and stop them afterwards."""
+    running = []
+
+    def start(tiles, allow_origin=None):
+        httpd = ThreadingHTTPServer(('127.0.0.1', 0), tile_server.make_handler(tiles, allow_origin))
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        running.append((httpd, tiles))
+        return f'http://127.0.0.1:{httpd.server_port}'
+
+    yield start
+    for (httpd, tiles) in running:
+        httpd.shutdown()
+        httpd.server_close()
+        tiles.close()
+
+
+@pytest.fixture
+def server_url(imec_file, start_server):
+    (bin_file, _) = imec_file
+    return start_server(tile_server.TileServer([bin_file], n_workers=2))
+
+
+def get(url, headers={}):
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers)) as response:
+            return (response.status, response.headers, response.read())
+    except urllib.error.HTTPError as e:
+        return (e.code, e.headers, e.read())
+
+
+def test_tiles_and_etags(server_url, imec_file):
+    (_, data) = imec_file
+    (status, _, body) = get(f'{server_url}/files')
+    assert status == 200
+    [info] = json.loads(body)
+    assert info['n_chan'] == data.shape[0]
+
+    (status, headers, body) = get(f'{server_url}/tiles/0/0/0.bin?chans=0:1')
+    assert status == 200
+    (magic, n_chan, n_values, samp_per_chunk, samp_0) = struct.unpack_from(tile_server.tile_header_format, body)
+    assert (magic, n_chan, samp_0) == (b'SGT1', 2, 0)
+    values = np.frombuffer(body, dtype='<i2', offset=struct.calcsize(tile_server.tile_header_format)).reshape(n_chan, n_values)
+    assert values[0, 0] == data[0, :samp_per_chunk].min()
+    assert values[0, 1] == data[0, :samp_per_chunk].max()
+
+    etag = headers['ETag']
+    assert get(f'{server_url}/tiles/0/0/0.bin?chans=0:1', {'If-None-Match': etag})[0] == 304
+    assert get(f'{server_url}/tiles/0/0/0.bin?chans=0:1', {'If-None-Match': etag[:-2] + '"'})[0] == 200
+    # A different tag that contains this one as a substring.
+    assert get(f'{server_url}/tiles/0/0/0.bin?chans=0:1', {'If-None-Match': '"v2' + etag})[0] == 200
+    assert get(f'{server_url}/tiles/0/9/0.bin')[0] == 404
+    assert get(f'{server_url}/tiles/0/0/0.bin?chans=0:99')[0] == 404
+    assert get(f'{server_url}/tiles/0/0/0.gif')[0] == 404
+    assert get(f'{server_url}/tiles/1/0/0.bin')[0] == 404
+
+
+def test_allow_origin_is_opt_in(imec_file, server_url, start_server):
+    (bin_file, _) = imec_file
+    (_, headers, _) = get(f'{server_url}/files')
+    assert 'Access-Control-Allow-Origin' not in headers
+
+    url = start_server(tile_server.TileServer([bin_file], n_workers=2), allow_origin='http://localhost:3000')
+    (_, headers, _) = get(f'{url}/tiles/0/0/0.bin')
+    assert headers['Access-Control-Allow-Origin'] == 'http://localhost:3000'
+
+
+def test_unexpected_error_is_500(imec_file, server_url, start_server, capsys):
+    (bin_file, _) = imec_file
+    tiles = tile_server.TileServer([bin_file], n_workers=2)
+
+    def fail(info, level, index):
+        raise OSError('disk went away')
+
+    tiles.service.compute_tile = fail
+    url = start_server(tiles)
+    (status, _, body) = get(f'{url}/tiles/0/0/0.png')
+    assert status == 500
+    assert b'OSError' in body
+    assert 'disk went away' in capsys.readouterr().err
+    # The server keeps serving after an error.
+    assert get(f'{url}/files')[0] == 200
+
+
+def test_precompute_coarse_levels(tmp_path):
+    # Long enough for three levels of default tiles.
+    bin_file = tmp_path.joinpath('long_g0_t0.imec0.ap.bin')
+    make_imec(bin_file, n_ap=2, n_samp=140000)
+    tiles = tile_server.TileServer([bin_file], n_workers=2)
+    try:
+        info = tiles.service.open(bin_file)
+        n_levels = info['n_levels']
+        assert n_levels == 3
+        # Room for the top two levels only.
+        n_bytes = sum(2 * int(np.ceil(info['n_file_samp'] / tiles.service.samp_per_chunk(level))) * info['n_chan'] * 2
+                      for level in [n_levels - 1, n_levels - 2])
+        assert tiles.precompute(n_bytes).result() == [[n_levels - 2, n_levels - 1]]
+        stats = tiles.service.stats()
+        assert stats['misses'] == stats['n_entries'] > 0
+
+        (body, _) = tiles.tile(0, n_levels - 1, 0, 'bin')
+        assert tiles.service.stats()['misses'] == stats['misses']
+        assert tiles.precompute(0).result() == [[]]
+    finally:
+        tiles.close()
@@ -0,0 +1,31 @@
+import os
+import numpy as np
+
+from spikeglx_tools import timebase
+
+
+def test_time_base_maps_between_streams(imec_file, ni_file):
+    (imec_bin, imec_data) = imec_file
+    (ni_bin, _) = ni_file
+    time_base = timebase.time_base_for([imec_bin, ni_bin])
+    assert time_base.reference == 'imec0.ap'
+    assert time_base is timebase.time_base_for([imec_bin, ni_bin])
+
+    # Both fake streams share a clock, so mapping is the identity at sync edges.
+    edge_times = time_base.streams['nidq']['matched']
+    assert len(edge_times) > 0
+    assert np.allclose(time_base.to_reference('nidq', edge_times), edge_times)
+
+    windows = time_base.read_windows([0.1], [0.2], streams=['imec0.ap'], chan_lists={'imec0.ap': [16]})
+    [(samp_0, data)] = windows['imec0.ap']
+    assert np.array_equal(data, imec_data[[16], samp_0:samp_0 + data.shape[1]])
+
+
+def test_changed_meta_rebuilds_time_base(imec_file, ni_file):
+    (imec_bin, _) = imec_file
+    (ni_bin, _) = ni_file
+    time_base = timebase.time_base_for([imec_bin, ni_bin])
+    meta_file = ni_bin.with_suffix('.meta')
+    stat = meta_file.stat()
+    os.utime(meta_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert timebase.time_base_for([imec_bin, ni_bin]) is not time_base
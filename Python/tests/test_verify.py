@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from spikeglx_tools import blocks, datafile, pipeline, verify
+
+
+def test_good_file_verifies(imec_file):
+    (bin_file, _) = imec_file
+    result = verify.verify_bin(bin_file, progress_secs=None)
+    assert result['ok'] and result['size_ok'] and result['sha1_ok']
+
+    meta = datafile.readMeta(bin_file)
+    [piped] = pipeline.run_pipeline(bin_file, meta, [verify.Sha1Consumer(bin_file)], samp_per_block=7000)
+    assert piped['ok']
+    assert piped['sha1'] == result['sha1']
+
+
+def test_truncated_file_fails(imec_file):
+    (bin_file, data) = imec_file
+    with open(bin_file, 'r+b') as f:
+        f.truncate(bin_file.stat().st_size - 2 * data.shape[0] * 10)
+    result = verify.verify_bin(bin_file, progress_secs=None)
+    assert not result['ok']
+    assert not result['size_ok']
+    assert result['actual_size'] == result['expected_size'] - 2 * data.shape[0] * 10
+
+    meta = datafile.readMeta(bin_file)
+    with pytest.raises(ValueError):
+        blocks.memmap_bin(bin_file, meta)
+
+
+def test_padded_file_fails(imec_file):
+    (bin_file, data) = imec_file
+    with open(bin_file, 'ab') as f:
+        f.write(b'\0' * 100)
+    result = verify.verify_bin(bin_file, progress_secs=None)
+    assert not result['ok']
+    assert not result['size_ok']
+    assert result['actual_size'] == result['expected_size'] + 100
+
+    meta = datafile.readMeta(bin_file)
+    with pytest.warns(UserWarning):
+        raw_data = blocks.memmap_bin(bin_file, meta)
+    assert np.array_equal(raw_data, data)
+
+
+def test_wrong_sha1_fails(imec_file):
+    (bin_file, _) = imec_file
+    meta_file = bin_file.with_suffix('.meta')
+    meta_file.write_text(meta_file.read_text().replace('fileSHA1=', 'fileSHA1=0'))
+    result = verify.verify_bin(bin_file, progress_secs=None)
+    assert result['size_ok']
+    assert not result['sha1_ok']
+    assert not result['ok']
+
+
+def test_main_reports_failures(imec_file, ni_file):
+    (bin_file, _) = ni_file
+    with open(bin_file, 'ab') as f:
+        f.write(b'\0\0')
+    assert verify.main([str(imec_file[0])]) == 0
+    assert verify.main([str(imec_file[0]), str(bin_file)]) == 1
@@ -0,0 +1,89 @@
+import asyncio
+import numpy as np
+import pytest
+
+from spikeglx_tools import datafile, window_service
+from spikeglx_tools.datafile_ben import read_bin_ben
+
+
+@pytest.fixture
+def service():
+    # Tiles of 16 chunks, so a 30000 sample file has levels of 512, 2048, 8192, and 32768 samples per tile.
+    service = window_service.WindowService(n_workers=2, base_samp_per_chunk=32, zoom_factor=4, tile_chunks=16)
+    yield service
+    service.close()
+
+
+def all_tiles(service, info, level):
+    n_tiles = int(np.ceil(info['n_file_samp'] / (service.tile_chunks * service.samp_per_chunk(level))))
+
+    async def gather():
+        return await asyncio.gather(*[service.tile(info, level, index) for index in range(n_tiles)])
+
+    return np.concatenate(asyncio.run(gather()), axis=1)
+
+
+def test_pyramid_levels_match_read_bin_ben(imec_file, service):
+    (bin_file, data) = imec_file
+    meta = datafile.readMeta(bin_file)
+    info = service.open(bin_file)
+    assert info['n_levels'] == 4
+    for level in range(info['n_levels']):
+        samp_per_chunk = service.samp_per_chunk(level)
+        (values, _) = read_bin_ben(0, data.shape[1], meta, bin_file, samp_per_chunk=samp_per_chunk)
+        assert np.array_equal(all_tiles(service, info, level), values)
+
+
+def test_combined_tiles_match_computed_tiles(imec_file, service):
+    (bin_file, _) = imec_file
+    info = service.open(bin_file)
+    # With every level 0 tile cached, level 1 tiles are combined from them rather than read.
+    base = all_tiles(service, info, 0)
+    combined = all_tiles(service, info, 1)
+    assert service.stats()['n_entries'] == len(range(0, 30000, 512)) + len(range(0, 30000, 2048))
+
+    fresh = window_service.WindowService(n_workers=2, base_samp_per_chunk=32, zoom_factor=4, tile_chunks=16)
+    try:
+        assert np.array_equal(combined, all_tiles(fresh, fresh.open(bin_file), 1))
+    finally:
+        fresh.close()
+    assert np.array_equal(combined[:, 0::2], np.minimum.reduceat(base[:, 0::2], np.arange(0, base.shape[1] // 2, 4), axis=1))
+
+
+def test_query_chooses_level_and_window(imec_file, service):
+    (bin_file, data) = imec_file
+    meta = datafile.readMeta(bin_file)
+    chans = [3, 0, 16]
+    result = asyncio.run(service.query(bin_file, chans, t0=0.1, t1=0.9, n_points=1000))
+    # 24000 samples in 1000 points needs at least 48 samples per chunk, so level 1, with 128.
+    assert (result['level'], result['samp_per_chunk']) == (1, 128)
+    chunk_0 = 3000 // 128
+    chunk_end = int(np.ceil(27000 / 128))
+    assert result['samp_0'] == chunk_0 * 128
+    assert np.allclose(result['times'], np.arange(chunk_0, chunk_end) * 128 / 30000.0, atol=0)
+    (values, _) = read_bin_ben(chunk_0 * 128, (chunk_end - chunk_0) * 128, meta, bin_file, samp_per_chunk=128, chan_list=chans)
+    assert np.array_equal(result['values'], values)
+    assert np.array_equal(result['convs'], service.open(bin_file)['convs'][chans])
+
+
+def test_zoomed_in_query_is_raw(imec_file, service):
+    (bin_file, data) = imec_file
+    result = asyncio.run(service.query(bin_file, [1, 2], t0=0.5, t1=0.51, n_points=2000))
+    assert (result['level'], result['samp_per_chunk'], result['samp_0']) == (None, 1, 15000)
+    assert np.array_equal(result['values'], data[[1, 2], 15000:15300])
+
+
+def test_small_cache_evicts_and_stays_correct(imec_file):
+    (bin_file, data) = imec_file
+    meta = datafile.readMeta(bin_file)
+    service = window_service.WindowService(n_workers=2, base_samp_per_chunk=32, zoom_factor=4, tile_chunks=16, cache_bytes=17 * 2 * 2 * 16 * 4)
+    try:
+        info = service.open(bin_file)
+        (values, _) = read_bin_ben(0, data.shape[1], meta, bin_file, samp_per_chunk=32)
+        assert np.array_equal(all_tiles(service, info, 0), values)
+        stats = service.stats()
+        assert stats['n_bytes'] <= stats['max_bytes']
+        assert stats['evictions'] > 0
+        assert stats['n_pending'] == 0
+    finally:
+        service.close()